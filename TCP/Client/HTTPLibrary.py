@@ -1,5 +1,7 @@
 import socket
+import gzip
 from urllib.parse import urlparse
+from HTTPParser import HTTPParser, HTTPParseError
 
 class HTTPLibrary:
         
@@ -32,11 +34,12 @@ class HTTPLibrary:
 
                 request = self.__prepareRequest(HOST, HTTP_METHOD, PATH, HEADERS, BODY_DATA)    
                 TCPSocket.sendall(request)
-                responseHeader, responseBody = self.__receiveResponse(TCPSocket)
+                response = self.__receiveResponse(TCPSocket, HTTP_METHOD)
+                self.__decodeBody(response)
 
                 '''Check if the response is 302: redirect'''
-                if (self.__responseHeaderContainsRedirection(responseHeader)):
-                    redirectURL = self.__findRedirectURL(responseHeader)
+                if (self.__responseContainsRedirection(response)):
+                    redirectURL = self.__findRedirectURL(response)
 
                     if redirectURL == "":
                         print("Received 302 response code but didn't find the redirection URL")
@@ -51,15 +54,15 @@ class HTTPLibrary:
 
                 else:
                     if VERBOSE:
-                        print(responseHeader)
+                        print(response.rawHeader)
 
                     if OUTPUT_FILE is not None:
-                        file = open(OUTPUT_FILE, "w")
-                        file.write(responseBody)
+                        file = open(OUTPUT_FILE, "wb")
+                        file.write(response.body)
                         file.close()
                     
                     else:
-                        print(responseBody)
+                        print(response.text())
 
     '''
         Internal Method
@@ -68,9 +71,8 @@ class HTTPLibrary:
 
         Note: 
                 - Each line must be seperated by the '\r\n' delimiter
-                - Body must be seperated by an extra '\r\n' delimiter
-                - Body requires the Content-length Header
-                - The request must end with an extra '\r\n' delimiter
+                - The header block ends with an extra '\r\n' delimiter
+                - Body requires the Content-length Header (length in bytes) and is sent as-is after the header block
     '''
     def __prepareRequest(self, HOST, HTTP_METHOD, PATH, HEADERS, BODY_DATA):
         request = ''
@@ -81,55 +83,63 @@ class HTTPLibrary:
         for HEADER in HEADERS:
             request += HEADER + "\r\n"
 
+        '''One request per connection: let the server close once the response is sent'''
+        if not any(HEADER.lower().startswith('connection') for HEADER in HEADERS):
+            request += "Connection: close\r\n"
+
+        '''Ask for compressed bodies unless the user chose an encoding; they are decoded on receipt'''
+        if not any(HEADER.lower().startswith('accept-encoding') for HEADER in HEADERS):
+            request += "Accept-Encoding: gzip\r\n"
+
+        BODY = b''
         if BODY_DATA is not None:
-            request += "Content-Length: " + str(len(BODY_DATA)) + "\r\n"
-            request += "\r\n"
-            request += BODY_DATA + "\r\n"
+            BODY = BODY_DATA if isinstance(BODY_DATA, bytes) else BODY_DATA.encode()
+            request += "Content-Length: " + str(len(BODY)) + "\r\n"
 
         request += "\r\n"
-        return request.encode()
+        return request.encode() + BODY
 
 
     '''
         Internal Method 
         Description: Receives the response from the socket
-        Return: responseHeader, responseBody
+        Return: HTTPMessage with statusCode, headers and body (bytes)
 
-        Note: Splits the Header and Body using the '\r\n\r\n' delimiter
+        Note: The body is framed by Content-Length, chunked transfer-encoding or the server closing the connection
     '''
-    def __receiveResponse(self, socket):
-        BUFFER_SIZE = 1024
-        response = b''
+    def __receiveResponse(self, socket, HTTP_METHOD):
+        BUFFER_SIZE = 65536
+        parser = HTTPParser(isResponse = True)
+        parser.requestMethod = HTTP_METHOD
 
-        '''Reads data in packets of length BUFFER_SIZE from the kernel buffer'''
+        '''Reads data from the kernel buffer until a full response has been parsed'''
         while True:
             packet = socket.recv(BUFFER_SIZE)
-            response += packet
-            if len(packet) < BUFFER_SIZE: break   # Last packet
-        
-        response = response.decode('utf-8')
 
-        '''If responseBody does not exists'''
-        if response.count('\r\n\r\n') < 1:
-            return response, ""
-        
-        else:
-            responseHeader, responseBody = response.split('\r\n\r\n', 1)
-            return responseHeader, responseBody
+            if not packet:
+                responses = parser.feedEOF()
+                if not responses:
+                    raise HTTPParseError('Connection closed before a response was received.')
+                return responses[0]
 
+            responses = parser.feed(packet)
+            if responses:
+                return responses[0]
 
-    def __responseHeaderContainsRedirection(self, responseHeaderString):
-        HEADERS = responseHeaderString.split('\r\n')
-        return '302' in HEADERS[0]
 
+    '''
+        Internal Method
+        Description: Replaces a gzip-encoded body with the decompressed bytes
+    '''
+    def __decodeBody(self, response):
+        if response.header('content-encoding', '').strip().lower() in ('gzip', 'x-gzip') and response.body:
+            response.body = bytearray(gzip.decompress(bytes(response.body)))
+
+
+    def __responseContainsRedirection(self, response):
+        return response.statusCode == 302
 
-    def __findRedirectURL(self, responseHeaderString):
-        HEADERS = responseHeaderString.split('\r\n')
 
+    def __findRedirectURL(self, response):
         '''Find the Location header and get the redirect URL'''
-        for HEADER in HEADERS:
-            if 'location' in HEADER.lower():
-                key, value = HEADER.split(':', 1)                
-                return value.strip()
-                
-        return ""
\ No newline at end of file
+        return response.header('location', '').strip()
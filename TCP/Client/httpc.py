@@ -18,7 +18,7 @@ TESTING
   in the terminal. It should print out the arguments stored.
 
 REQUEST REFERENCE
-- httpc (get|post) [-v] (-h "k:v")* [-d inline-data] [-f file] URL
+- httpc (get|head|post) [-v] (-h "k:v")* [-d inline-data] [-f file] URL
 '''
 import argparse
 from enum import Enum
@@ -28,6 +28,7 @@ from HTTPLibrary import HTTPLibrary
 # Enum for HTTP methods
 class HTTPMethod(Enum):
     GET = 'GET'
+    HEAD = 'HEAD'
     POST = 'POST'
 
 class HTTPC:
@@ -101,9 +102,10 @@ class HTTPC:
     
     # Read data from file to send as data
     def __read_file_data(self, path):
-        txt_data = ''
+        txt_data = b''
         print(path)
-        with open(path, 'r') as reader:
+        # Binary mode so any file (not only UTF-8 text) can be sent as-is
+        with open(path, 'rb') as reader:
             # Read entire file
             txt_data = reader.read(-1)
         
@@ -0,0 +1,571 @@
+'''
+loadgen is a closed-loop load generator for httpfs.
+usage: loadgen [-c N] [-t SECONDS] [--warmup SECONDS] [--mix SPEC] [--file-size SIZES] [--post-size SIZES]
+               [--path PATH] [-h "k:v"]* [--no-keep-alive] [--pipeline N] [--transport tcp|udp] [--router HOST:PORT]
+               [--seed N] [--label TEXT] [-o FILE] [--compare FILE] URL
+-c Number of concurrent clients. Each one sends its next request as soon as
+the previous response is in (closed loop). Default is 8.
+-t Seconds the load is measured for. Default is 10.
+--warmup Seconds of load before measuring starts. Default is 1.
+--mix Relative weights of the operations, as name=weight pairs: 'list'
+(GET /), 'file' (GET of a file) and 'post' (POST of a file). Default is
+list=1,file=8,post=1.
+--file-size Comma separated sizes (optional K/M/G suffix) of the files read by
+'file'. One file per size is uploaded before the run. Default is 4K.
+--post-size Comma separated sizes of the bodies sent by 'post'. Default is 4K.
+--path Read this existing file for 'file' instead of uploading test files.
+-h Extra request header, e.g. -h "Accept-Encoding: gzip". Repeatable.
+--no-keep-alive Open a new connection for every request (TCP).
+--pipeline Requests each client sends back to back before reading their
+responses (HTTP/1.1 pipelining, TCP). Their latency runs from the batch being
+sent to each response. Default is 1.
+--transport 'tcp' (TCP/Server) or 'udp' (UDP/Server, through the router).
+Default is tcp.
+--router Router the UDP transport sends through. Default is localhost:3000.
+--seed Seed of the request mix, so two runs send the same requests. Default is 1.
+--label Name of the run in the results. Default is the current git commit.
+-o Write the results to FILE as JSON.
+--compare Print the change against the results of an earlier run (JSON).
+
+Throughput counts the requests completed during the measured window; latency
+is from the first byte of the request being sent to the last byte of the
+response being read, reported as min/mean/p50/p95/p99/p99.9/max.
+'''
+import os
+import sys
+import json
+import math
+import time
+import random
+import socket
+import argparse
+import threading
+import subprocess
+from collections import deque
+from urllib.parse import urlparse
+from HTTPParser import HTTPParser, HTTPParseError
+
+OPERATIONS = ['list', 'file', 'post']
+TRANSPORTS = ['tcp', 'udp']
+PERCENTILES = [50, 95, 99, 99.9]
+
+UDP_CLIENT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'UDP', 'Client')
+
+
+class DiscardSink(object):
+    """ Response body sink that drops the data: bodies are read but not kept. """
+
+    def write(self, data):
+        pass
+
+
+class TCPTransport(object):
+    """ One client's connection to the TCP server, reused between requests
+        unless keep-alive is off or the server closes it.
+    """
+
+    BUFFER_SIZE = 65536
+
+    def __init__(self, host, port, keep_alive=True):
+        self.address = (host, port)
+        self.host = host + ':' + str(port)
+        self.keep_alive = keep_alive
+        self.socket = None
+        self.parser = None
+        self.responses = deque()
+
+
+    def request(self, method, path, headers, body=b''):
+        """ Send one request and read the whole response.
+            Returns (status, bytes received, bytes sent).
+        """
+        return self.pipeline([(method, path, body)], headers)[0][:3]
+
+
+    def pipeline(self, requests, headers):
+        """ Send `requests` ((method, path, body) tuples) back to back and
+            read their responses in order. The requests the server did not
+            answer before closing the connection are sent again on a new one.
+            Returns (status, bytes received, bytes sent, perf_counter time
+            the response was complete) for each request.
+        """
+        results = []
+
+        while len(results) < len(requests):
+            if self.socket is None:
+                self.socket = socket.create_connection(self.address)
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.parser = HTTPParser(isResponse=True, onHeaders=self.__discardBody)
+                self.responses.clear()
+
+            encoded = [self.__encode(method, path, headers, body) for method, path, body in requests[len(results):]]
+
+            try:
+                self.socket.sendall(b''.join(encoded))
+                for request in encoded:
+                    response = self.__receive()
+                    received = len(response.rawHeader) + 4 + response.bodyLength
+                    results.append((response.statusCode, received, len(request), time.perf_counter()))
+
+                    if not self.keep_alive or response.header('connection', '').lower() == 'close':
+                        self.close()
+                        break
+            except BaseException:
+                self.close()
+                raise
+
+        return results
+
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+    def __encode(self, method, path, headers, body):
+        lines = [method + ' ' + path + ' HTTP/1.1', 'Host: ' + self.host]
+        lines.extend(headers)
+        if not self.keep_alive:
+            lines.append('Connection: close')
+        if body or method == 'POST':
+            lines.append('Content-Length: ' + str(len(body)))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode() + body
+
+
+    def __receive(self):
+        while not self.responses:
+            data = self.socket.recv(self.BUFFER_SIZE)
+            self.responses.extend(self.parser.feed(data) if data else self.parser.feedEOF())
+            if not data and not self.responses:
+                raise HTTPParseError('Connection closed before a response was received.')
+
+        return self.responses.popleft()
+
+
+    def __discardBody(self, message):
+        message.bodySink = DiscardSink()
+
+
+class UDPTransport(object):
+    """ Requests to the UDP server through the router, one UDP connection
+        (handshake included) per request, as the UDP client makes them.
+    """
+
+    def __init__(self, host, port, router, keep_alive=True):
+        if UDP_CLIENT_DIRECTORY not in sys.path:
+            sys.path.append(UDP_CLIENT_DIRECTORY)
+        from HTTPClientLibrary import HTTPClientLibrary
+
+        self.library = HTTPClientLibrary
+        self.host = host + ':' + str(port)
+        self.router = router
+
+
+    def request(self, method, path, headers, body=b''):
+        library = self.library()
+        library.router_addr, library.router_port = self.router
+        response = library.fetch(self.host, method, path, headers, body if method == 'POST' else None)
+
+        received = len(response.rawHeader) + 4 + response.bodyLength
+        return response.statusCode, received, len(body)
+
+
+    def pipeline(self, requests, headers):
+        """ One request after the other: the UDP server takes one request per connection. """
+        return [self.request(method, path, headers, body) + (time.perf_counter(),) for method, path, body in requests]
+
+
+    def close(self):
+        pass
+
+
+class Client(threading.Thread):
+    """ One closed-loop client: sends a request (or with --pipeline, a batch
+        of them), waits for the responses, records them and sends the next
+        until the run is over.
+    """
+
+    def __init__(self, number, run, transport):
+        threading.Thread.__init__(self, name='loadgen-client-%d' % number, daemon=True)
+        self.number = number
+        self.run_info = run
+        self.transport = transport
+        self.random = random.Random(run.seed + number)
+
+        # Per operation: latencies (seconds) and {status: count} of the measured requests
+        self.latencies = {operation: [] for operation in OPERATIONS}
+        self.statuses = {operation: {} for operation in OPERATIONS}
+        self.errors = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.in_flight = False
+
+
+    def run(self):
+        run = self.run_info
+        operations = [operation for operation in OPERATIONS if run.mix.get(operation)]
+        weights = [run.mix[operation] for operation in operations]
+        post_path = '/loadgen-post-%d.bin' % self.number
+
+        while True:
+            batch = []
+            for operation in self.random.choices(operations, weights, k=run.pipeline):
+                if operation == 'list':
+                    batch.append((operation, 'GET', '/', b''))
+                elif operation == 'file':
+                    batch.append((operation, 'GET', self.random.choice(run.file_paths), b''))
+                else:
+                    batch.append((operation, 'POST', post_path, run.payloads[self.random.choice(run.post_sizes)]))
+
+            started = time.perf_counter()
+            if started >= run.stop_time: break
+
+            self.in_flight = True
+            try:
+                results = self.transport.pipeline([request[1:] for request in batch], run.headers)
+            except (OSError, HTTPParseError) as e:
+                if time.perf_counter() >= run.start_time:
+                    name = type(e).__name__
+                    self.errors[name] = self.errors.get(name, 0) + 1
+                # Don't spin on a server that refuses connections
+                time.sleep(0.01)
+                continue
+            finally:
+                self.in_flight = False
+
+            # Each request's latency runs from the batch being sent to its own response
+            for (operation, _, _, _), (status, received, sent, finished) in zip(batch, results):
+                if started < run.start_time or finished > run.stop_time: continue
+
+                self.latencies[operation].append(finished - started)
+                statuses = self.statuses[operation]
+                statuses[status] = statuses.get(status, 0) + 1
+                self.bytes_received += received
+                self.bytes_sent += sent
+
+        self.transport.close()
+
+
+class Run(object):
+    """ Settings shared by the clients of one run. """
+
+    def __init__(self, args):
+        self.mix = args.mix
+        self.headers = args.headers
+        self.post_sizes = args.post_size
+        self.seed = args.seed
+        self.pipeline = args.pipeline
+        self.payloads = {size: payload(size) for size in args.post_size}
+        self.file_paths = [args.path] if args.path else ['/loadgen-%d.bin' % size for size in args.file_size]
+        self.start_time = None
+        self.stop_time = None
+
+
+def payload(size):
+    """ `size` random lowercase letters. """
+    return bytes(random.choices(range(97, 123), k=size))
+
+
+def percentile(sorted_values, p):
+    """ Nearest-rank percentile of an already sorted list. """
+    if not sorted_values: return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, statuses, seconds):
+    """ Request count, throughput and latency distribution (milliseconds). """
+    latencies = sorted(latencies)
+    summary = {
+        'requests': len(latencies),
+        'throughput_rps': len(latencies) / seconds,
+        'status': {str(status): count for status, count in sorted(statuses.items())},
+        'latency_ms': None
+    }
+
+    if latencies:
+        latency = {
+            'min': latencies[0] * 1000,
+            'mean': sum(latencies) / len(latencies) * 1000
+        }
+        for p in PERCENTILES:
+            latency['p%g' % p] = percentile(latencies, p) * 1000
+        latency['max'] = latencies[-1] * 1000
+        summary['latency_ms'] = latency
+
+    return summary
+
+
+def collect(clients, args, seconds):
+    """ The results of a run as a JSON-serializable dict. """
+    operations = {}
+    all_latencies = []
+    all_statuses = {}
+    errors = {}
+
+    for operation in OPERATIONS:
+        if not args.mix.get(operation): continue
+        latencies = []
+        statuses = {}
+        for client in clients:
+            latencies.extend(client.latencies[operation])
+            for status, count in client.statuses[operation].items():
+                statuses[status] = statuses.get(status, 0) + count
+        operations[operation] = summarize(latencies, statuses, seconds)
+
+        all_latencies.extend(latencies)
+        for status, count in statuses.items():
+            all_statuses[status] = all_statuses.get(status, 0) + count
+
+    for client in clients:
+        for name, count in client.errors.items():
+            errors[name] = errors.get(name, 0) + count
+
+    results = {
+        'label': args.label,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - seconds)),
+        'config': {
+            'url': args.url,
+            'transport': args.transport,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'mix': args.mix,
+            'file_size': [] if args.path else args.file_size,
+            'path': args.path,
+            'post_size': args.post_size,
+            'headers': args.headers,
+            'keep_alive': args.keep_alive,
+            'pipeline': args.pipeline
+        },
+        'seconds': seconds,
+        'bytes_received': sum(client.bytes_received for client in clients),
+        'bytes_sent': sum(client.bytes_sent for client in clients),
+        'errors': errors,
+        # Clients still waiting for a response when the run ended (a stuck UDP transfer)
+        'unfinished': sum(1 for client in clients if client.is_alive() and client.in_flight)
+    }
+    results.update(summarize(all_latencies, all_statuses, seconds))
+    results['operations'] = operations
+    return results
+
+
+def report(results):
+    print('%s: %d clients, %.1f s, %s over %s' % (results['label'], results['config']['concurrency'],
+          results['seconds'], results['config']['transport'], results['config']['url']))
+    print('%-6s %9s %10s %9s %9s %9s %9s %9s %9s  %s' % ('', 'requests', 'req/s', 'mean', 'p50', 'p95', 'p99', 'p99.9', 'max', 'status'))
+
+    rows = [(name, results['operations'][name]) for name in OPERATIONS if name in results['operations']]
+    for name, summary in rows + [('total', results)]:
+        latency = summary['latency_ms'] or {}
+        columns = ['%9.2f' % latency[key] if key in latency else '%9s' % '-' for key in ('mean', 'p50', 'p95', 'p99', 'p99.9', 'max')]
+        statuses = ' '.join('%s:%d' % item for item in summary['status'].items())
+        print('%-6s %9d %10.1f %s  %s' % (name, summary['requests'], summary['throughput_rps'], ' '.join(columns), statuses))
+
+    print('latency in ms; %.1f MB/s received, %.1f MB/s sent' % (
+        results['bytes_received'] / results['seconds'] / 1e6, results['bytes_sent'] / results['seconds'] / 1e6))
+    if results['errors']:
+        print('errors: ' + ', '.join('%s: %d' % item for item in sorted(results['errors'].items())))
+    if results['unfinished']:
+        print('unfinished requests: %d' % results['unfinished'])
+
+
+def compare(baseline, results):
+    """ Print each number of `results` next to the same one in `baseline`. """
+    print('\nchange against %s:' % baseline.get('label'))
+    print('%-6s %-9s %12s %12s %9s' % ('', '', 'before', 'after', 'change'))
+
+    names = [name for name in OPERATIONS if name in results['operations'] and name in baseline.get('operations', {})]
+    for name, before, after in [(name, baseline['operations'][name], results['operations'][name]) for name in names] + \
+                               [('total', baseline, results)]:
+        rows = [('req/s', before['throughput_rps'], after['throughput_rps'])]
+        if before.get('latency_ms') and after.get('latency_ms'):
+            rows += [(key, before['latency_ms'][key], after['latency_ms'][key])
+                     for key in ('p50', 'p95', 'p99', 'p99.9') if key in before['latency_ms']]
+
+        for key, old, new in rows:
+            change = '%+8.1f%%' % ((new - old) / old * 100) if old else '%9s' % '-'
+            print('%-6s %-9s %12.2f %12.2f %s' % (name, key, old, new, change))
+            name = ''
+
+
+def prepare(transport, run, args):
+    """ Upload the files the 'file' operation reads. """
+    if args.path or not args.mix.get('file'): return
+
+    for size, path in zip(args.file_size, run.file_paths):
+        status, _, _ = transport.request('POST', path, [], payload(size))
+        if status >= 300:
+            raise SystemExit('Could not upload %s: status %d' % (path, status))
+
+
+def git_commit():
+    try:
+        output = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return output.stdout.decode().strip()
+
+
+def validate_size(value, parser):
+    UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    multiplier = UNITS.get(value[-1:].upper(), 1)
+    number = value[:-1] if multiplier > 1 else value
+
+    if not number.isnumeric():
+        parser.error("Please input sizes in bytes (optionally with a K/M/G suffix).")
+
+    return int(number) * multiplier
+
+def validate_sizes(value, parser):
+    return [validate_size(size.strip(), parser) for size in value.split(',')]
+
+def validate_mix(value, parser):
+    mix = {}
+    for pair in value.split(','):
+        name, _, weight = pair.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS or not weight.strip().isnumeric():
+            parser.error("Please input the mix as name=weight pairs, with names among " + ', '.join(OPERATIONS) + ".")
+        mix[name] = int(weight)
+
+    if not any(mix.values()):
+        parser.error("At least one operation of the mix needs a positive weight.")
+
+    return mix
+
+def validate_seconds(value, parser, name):
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = -1
+
+    if seconds < 0:
+        parser.error("Please input a non-negative number of seconds for " + name + ".")
+
+    return seconds
+
+def validate_positive_int(value, parser, name):
+    if not value.isnumeric() or int(value) < 1:
+        parser.error("Please input a positive integer for " + name + ".")
+
+    return int(value)
+
+def validate_header(header, parser):
+    if ':' not in header:
+        parser.error("Please input headers in the format headerName:valueName.")
+
+    return header
+
+def validate_address(value, parser):
+    host, _, port = value.rpartition(':')
+    if not host or not port.isnumeric():
+        parser.error("Please input the router as HOST:PORT.")
+
+    return host, int(port)
+
+def main():
+    parser = argparse.ArgumentParser(add_help=False)
+
+    parser.add_argument('-help', action='help', help='Show this help message and exit')
+    parser.add_argument('url', help='URL of the httpfs server, e.g. http://localhost:8080.')
+    parser.add_argument('-c', dest='concurrency', help='Number of concurrent clients. Default is 8.',
+                        type=lambda value: validate_positive_int(value, parser, '-c'), default='8')
+    parser.add_argument('-t', dest='duration', help='Seconds the load is measured for. Default is 10.',
+                        type=lambda value: validate_seconds(value, parser, '-t'), default='10')
+    parser.add_argument('--warmup', dest='warmup', help='Seconds of load before measuring starts. Default is 1.',
+                        type=lambda value: validate_seconds(value, parser, '--warmup'), default='1')
+    parser.add_argument('--mix', dest='mix', help='Relative weights of the operations list (GET /), file (GET of a file)\
+                        and post (POST of a file). Default is list=1,file=8,post=1.',
+                        type=lambda value: validate_mix(value, parser), default='list=1,file=8,post=1')
+    parser.add_argument('--file-size', dest='file_size', help='Comma separated sizes of the files read by "file",\
+                        with an optional K/M/G suffix. Default is 4K.',
+                        type=lambda value: validate_sizes(value, parser), default='4K')
+    parser.add_argument('--post-size', dest='post_size', help='Comma separated sizes of the bodies sent by "post".\
+                        Default is 4K.', type=lambda value: validate_sizes(value, parser), default='4K')
+    parser.add_argument('--path', dest='path', help='Read this existing file for "file" instead of uploading test files.')
+    parser.add_argument('-h', dest='headers', help='Extra request header in the format headerName:valueName. Repeatable.',
+                        action='append', type=lambda value: validate_header(value, parser), default=[])
+    parser.add_argument('--no-keep-alive', dest='keep_alive', help='Open a new connection for every request (TCP).',
+                        default=True, action='store_false')
+    parser.add_argument('--pipeline', dest='pipeline', help='Requests each client sends back to back on its connection\
+                        before reading the responses (TCP). Default is 1.',
+                        type=lambda value: validate_positive_int(value, parser, '--pipeline'), default='1')
+    parser.add_argument('--transport', dest='transport', help='"tcp" for TCP/Server or "udp" for UDP/Server through the\
+                        router. Default is tcp.', choices=TRANSPORTS, default='tcp')
+    parser.add_argument('--router', dest='router', help='Router the UDP transport sends through. Default is localhost:3000.',
+                        type=lambda value: validate_address(value, parser), default='localhost:3000')
+    parser.add_argument('--seed', dest='seed', help='Seed of the request mix, so runs send the same requests. Default is 1.',
+                        type=int, default=1)
+    parser.add_argument('--label', dest='label', help='Name of the run in the results. Default is the current git commit.')
+    parser.add_argument('-o', dest='output', help='Write the results to this file as JSON.')
+    parser.add_argument('--compare', dest='compare', help='Results (JSON) of an earlier run to compare against.')
+
+    args = parser.parse_args()
+    if args.duration == 0:
+        parser.error("Please input a positive number of seconds for -t.")
+    if args.pipeline > 1 and args.transport == 'udp':
+        parser.error("--pipeline needs the TCP transport.")
+
+    url = urlparse(args.url if '://' in args.url else 'http://' + args.url)
+    if not url.hostname:
+        parser.error("Please enter a valid URL.")
+    host, port = url.hostname, url.port or 80
+    args.label = args.label or git_commit()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    def transport():
+        if args.transport == 'udp':
+            return UDPTransport(host, port, args.router)
+        return TCPTransport(host, port, args.keep_alive)
+
+    # The UDP client prints every packet it handles
+    stdout = sys.stdout
+    if args.transport == 'udp':
+        sys.stdout = open(os.devnull, 'w')
+
+    try:
+        run = Run(args)
+        setup = transport()
+        try:
+            prepare(setup, run, args)
+        except (OSError, HTTPParseError) as e:
+            raise SystemExit('Could not upload the test files: ' + str(e))
+        setup.close()
+
+        clients = [Client(number, run, transport()) for number in range(args.concurrency)]
+        run.start_time = time.perf_counter() + args.warmup
+        run.stop_time = run.start_time + args.duration
+        for client in clients:
+            client.start()
+
+        # A client blocked on a lost UDP transfer is given up on (and reported as unfinished)
+        for client in clients:
+            client.join(max(0, run.stop_time - time.perf_counter()) + 5)
+    finally:
+        sys.stdout = stdout
+
+    results = collect(clients, args, args.duration)
+    report(results)
+
+    if baseline is not None:
+        compare(baseline, results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('\nresults written to ' + args.output)
+
+    # The selective repeat threads of a stuck UDP transfer never end on their own
+    if results['unfinished']:
+        sys.stdout.flush()
+        os._exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,81 @@
 import os
+import json
+import stat
+import uuid
+import gzip
+import bisect
 import shutil
+import fnmatch
+import itertools
 import mimetypes
+from urllib.parse import quote
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
 from pathlib import Path
-from Modules.FileLock import FileLock
+from Modules.FileLock import FileLock, FileLockException
+from Modules.FileCache import FileCache
+from Modules.DirectoryIndex import DirectoryIndex
+from Modules.Upload import Upload, UploadError, PartialUpload, BatchUpload
+from Modules.Multipart import header_param
+from Modules.MappedFile import MAPPED_FILES
+from Modules.ContentStore import ContentStore, BlobUpload
+
+# Types worth compressing; everything else (images, archives, documents) is already compressed
+COMPRESSIBLE_TYPES = {'application/json', 'application/xml', 'application/javascript', 'application/xhtml+xml', 'image/svg+xml'}
+
+# Listings are one path per line, or JSON with each file's size and modification time
+LISTING_FORMATS = ['text', 'json']
+
+# Files of a batch request (see getFiles), and how many of them are read or written at the same time
+MAX_BATCH_FILES = 1000
+BATCH_THREADS = 8
+
+# Largest slice of a memory-mapped file handed to the sender at once
+MAP_SLICE = 1024 * 1024
+
+# Where files are kept: as they are named in the directory, or deduplicated in a content-addressed store
+# (see Modules/ContentStore.py) inside STORE_DIRECTORY of it
+STORAGE_BACKENDS = ['files', 'cas']
+STORE_DIRECTORY = '.cas'
+
+# What the validators of a file (ETag, Last-Modified, If-Range) are built from when its stat can't tell
+FileVersion = namedtuple('FileVersion', ['st_size', 'st_mtime', 'st_mtime_ns'])
 
 class FileHandler:
 
     def __init__(self):
         self.defaultDirectory = 'Data'
+        self.cache = FileCache()
+        self.index = None
+        self.maxUploadSize = 1024 ** 3
+        self.fsync = 'never'
+        self.store = None
+        self.batchExecutor = ThreadPoolExecutor(max_workers = BATCH_THREADS, thread_name_prefix = 'httpfs-batch')
+
+    # Bytes of file content kept in memory for hot GETs (0 disables the cache)
+    def setCacheSize(self, maxBytes):
+        self.cache = FileCache(maxBytes)
+
+    '''
+        maxBytes: largest body accepted by a write (0 for no limit)
+        fsync:    one of FSYNC_POLICIES (see Modules/Upload.py)
+    '''
+    def setUploadPolicy(self, maxBytes, fsync):
+        self.maxUploadSize = maxBytes
+        self.fsync = fsync
+
+    '''
+        STORAGE: one of STORAGE_BACKENDS. 'cas' opens the content-addressed store of the default
+        directory, created empty the first time: files already in the directory are not part of it.
+        Call it after setDefaultDirectory and setUploadPolicy.
+    '''
+    def setStorage(self, STORAGE):
+        if STORAGE not in STORAGE_BACKENDS:
+            raise ValueError('Unknown storage backend: ' + str(STORAGE))
+
+        if STORAGE == 'cas':
+            self.store = ContentStore(os.path.join(self.defaultDirectory, STORE_DIRECTORY), self.fsync)
 
     def setDefaultDirectory(self, dirName):
         self.defaultDirectory = dirName        
@@ -18,14 +86,82 @@ class FileHandler:
 
         # Path(absolutePath).mkdir(parents=True)
 
-    def getNamesOfAllFiles(self):
-        absolutePath = os.path.join(os.getcwd(), self.defaultDirectory)
+    '''
+        Builds the index of the default directory used to answer listings (see DirectoryIndex).
+        With a snapshot path, the index is saved there and reloaded on the next start if the
+        directory has not changed in between.
+    '''
+    def buildIndex(self, snapshotPath = None):
+        # The content-addressed store is its own index
+        if self.store is not None: return
+        self.index = DirectoryIndex(os.path.join(os.getcwd(), self.defaultDirectory), snapshotPath, Upload.is_temporary)
+
+    '''
+        Lists the files of the default directory, or of DIRECTORY (a path inside it ending with '/').
+        QUERY (the request's query parameters) narrows the listing down on the server, so a client
+        only receives the part it asked for:
+        - prefix:    only paths starting with it
+        - glob:      only paths matching the pattern (fnmatch, where '*' also matches '/')
+        - recursive: 1 also lists the files of subdirectories, as paths relative to the listed directory
+        - limit:     at most this many paths. When more follow, the X-Next-Cursor header (and the JSON
+                     body's next_cursor) is the cursor of the next page
+        - cursor:    resume after this path: paths are listed in order of their components
+        - format:    'json' for {"files": [{"name", "size", "mtime"}...], "next_cursor"}, otherwise
+                     one path per line
+        Without a limit the listing is streamed as the directory is read.
+    '''
+    def getNamesOfAllFiles(self, DIRECTORY = '', QUERY = {}):
+        # If user tries to access outside of default directory
+        absolutePath = self.__listedDirectory(DIRECTORY)
+        if absolutePath is None:
+            return {
+                'statusCode': 403,
+                'data': 'Forbidden access.'
+            }
+
+        try:
+            PREFIX, GLOB, RECURSIVE, LIMIT, CURSOR, FORMAT = self.__listingOptions(QUERY)
+        except ValueError as e:
+            return {
+                'statusCode': 400,
+                'data': f'Bad listing parameters: {e}'
+            }
+
         try:
-            # Array of file names
-            files = [f for f in os.listdir(absolutePath) if os.path.isfile(os.path.join(absolutePath, f))]
+            if self.store is not None:
+                names = self.__storedNames(DIRECTORY, RECURSIVE, PREFIX, CURSOR)
+                if GLOB is not None:
+                    names = (name for name in names if fnmatch.fnmatchcase(name, GLOB))
+
+            elif self.index is not None and DIRECTORY == '' and not RECURSIVE:
+                names = self.__indexedNames(self.index.list(), PREFIX, GLOB, CURSOR)
+            else:
+                # The directory is opened now so errors are still reported with a status code;
+                # the names are produced lazily while the response is being sent
+                try:
+                    entries = os.scandir(absolutePath)
+                except (FileNotFoundError, NotADirectoryError):
+                    return self.__fileNotFound()
+
+                names = self.__walkFiles(entries, '', RECURSIVE, PREFIX, CURSOR and CURSOR.split('/'))
+                if GLOB is not None:
+                    names = (name for name in names if fnmatch.fnmatchcase(name, GLOB))
+
+            HEADERS = ['Content-Type: application/json' if FORMAT == 'json' else 'Content-Type: text/plain']
+            NEXT_CURSOR = None
+
+            # A page is bounded by its limit, so it is read up front to know whether another one follows
+            if LIMIT is not None:
+                names = list(itertools.islice(names, LIMIT + 1))
+                if len(names) > LIMIT:
+                    names = names[:LIMIT]
+                    NEXT_CURSOR = names[-1]
+                    HEADERS.append('X-Next-Cursor: ' + quote(NEXT_CURSOR, safe = ''))
+
             return {
                 'statusCode': 200,
-                'data': '\n'.join(files)
+                'headers': HEADERS,
+                'stream': self.__streamJSONListing(DIRECTORY, names, NEXT_CURSOR) if FORMAT == 'json' else self.__streamNames(names)
             }
         except Exception as e:
             return {
@@ -33,7 +169,206 @@ class FileHandler:
                 'data': f'Error getting names of files: {e}'
             }
 
-    def getFileContent(self,filename):
+    '''
+        Absolute path of a directory to list ('' or a relative path ending with '/'), or None if it
+        is not inside the default directory: absolute paths, empty or '..' components and symlinks
+        leading out of it are refused.
+    '''
+    def __listedDirectory(self, DIRECTORY):
+        COMPONENTS = DIRECTORY.split('/')[:-1] if DIRECTORY else []
+        if os.path.isabs(DIRECTORY) or '\\' in DIRECTORY or any(c in ('', '.', '..') for c in COMPONENTS):
+            return None
+
+        root = os.path.realpath(self.defaultDirectory)
+        absolutePath = os.path.realpath(os.path.join(root, *COMPONENTS))
+        if os.path.commonpath([root, absolutePath]) != root:
+            return None
+
+        return absolutePath
+
+    '''
+        Parses the query parameters of a listing (see getNamesOfAllFiles). Raises ValueError for
+        one that makes no sense.
+    '''
+    def __listingOptions(self, QUERY):
+        PREFIX = QUERY.get('prefix', '')
+        GLOB = QUERY.get('glob') or None
+        RECURSIVE = QUERY.get('recursive', '').lower() in ('1', 'true', 'yes')
+        CURSOR = QUERY.get('cursor') or None
+        FORMAT = QUERY.get('format', 'text').lower()
+
+        LIMIT = QUERY.get('limit')
+        if LIMIT is not None:
+            if not LIMIT.isdigit() or int(LIMIT) < 1:
+                raise ValueError('limit must be a positive integer.')
+            LIMIT = int(LIMIT)
+
+        if FORMAT not in LISTING_FORMATS:
+            raise ValueError('format must be one of ' + ', '.join(LISTING_FORMATS) + '.')
+
+        return PREFIX, GLOB, RECURSIVE, LIMIT, CURSOR, FORMAT
+
+    '''
+        The top-level names of the index that pass the filters. The index is sorted, so the prefix
+        and the cursor are found by bisection instead of a scan.
+    '''
+    def __indexedNames(self, names, PREFIX, GLOB, CURSOR):
+        start = bisect.bisect_left(names, PREFIX)
+        if CURSOR is not None:
+            start = max(start, bisect.bisect_right(names, CURSOR))
+
+        stop = len(names)
+        if PREFIX:
+            # The first name past every name starting with PREFIX
+            stop = bisect.bisect_left(names, PREFIX[:-1] + chr(ord(PREFIX[-1]) + 1), start)
+
+        if start > 0 or stop < len(names): names = names[start:stop]
+        return fnmatch.filter(names, GLOB) if GLOB is not None else names
+
+    '''
+        Paths of the files under a directory, relative to it, depth first with every directory's
+        entries sorted by name. That is the order of the paths' components, so a cursor (split into
+        its components) resumes the walk, skipping whole subdirectories that come before it.
+        Uploads still being written and symlinked directories are left out.
+    '''
+    def __walkFiles(self, entries, base, RECURSIVE, PREFIX, CURSOR):
+        with entries:
+            entries = sorted(entries, key = lambda entry: entry.name)
+
+        for entry in entries:
+            if Upload.is_temporary(entry.name) or (not base and entry.name == STORE_DIRECTORY): continue
+            path = base + entry.name
+
+            try:
+                if RECURSIVE and entry.is_dir(follow_symlinks = False):
+                    if self.__mayContain(path + '/', PREFIX, CURSOR):
+                        yield from self.__walkFiles(os.scandir(entry.path), path + '/', RECURSIVE, PREFIX, CURSOR)
+
+                elif entry.is_file() and path.startswith(PREFIX) and (CURSOR is None or path.split('/') > CURSOR):
+                    yield path
+            except OSError:
+                # Removed or unreadable since the directory was read
+                continue
+
+    '''
+        Paths of the content-addressed store's files under DIRECTORY, relative to it, in the same
+        order as __walkFiles lists a directory.
+    '''
+    def __storedNames(self, DIRECTORY, RECURSIVE, PREFIX, CURSOR):
+        CURSOR = CURSOR and CURSOR.split('/')
+        for name in self.store.list():
+            if not name.startswith(DIRECTORY): continue
+            path = name[len(DIRECTORY):]
+
+            if path.startswith(PREFIX) and (RECURSIVE or '/' not in path) and (CURSOR is None or path.split('/') > CURSOR):
+                yield path
+
+    def __mayContain(self, DIRECTORY, PREFIX, CURSOR):
+        if not (DIRECTORY.startswith(PREFIX) or PREFIX.startswith(DIRECTORY)):
+            return False
+
+        components = DIRECTORY[:-1].split('/')
+        return CURSOR is None or components >= CURSOR[:len(components)]
+
+    def __streamNames(self, names):
+        BATCH = 1024
+        names = iter(names)
+        separator = ''
+        for batch in iter(lambda: list(itertools.islice(names, BATCH)), []):
+            yield separator + '\n'.join(batch)
+            separator = '\n'
+
+    def __streamJSONListing(self, DIRECTORY, names, NEXT_CURSOR):
+        yield '{"files": ['
+        separator = ''
+        for name in names:
+            file_path, MODIFIED_NS = self.__locate(DIRECTORY + name)
+            if file_path is None: continue
+
+            try:
+                version = self.__version(os.stat(file_path), MODIFIED_NS)
+            except OSError:
+                continue
+
+            yield separator + json.dumps({'name': name, 'size': version.st_size, 'mtime': version.st_mtime})
+            separator = ', '
+
+        yield '], "next_cursor": ' + json.dumps(NEXT_CURSOR) + '}'
+
+    '''
+        Several files in one multipart/mixed response, in the order asked for. Every part has the
+        file's path in Content-Location, its status in X-Status, the headers a GET of the file
+        would get and its content (or the error message).
+        Up to BATCH_THREADS files are opened and read at the same time, a few parts ahead of the
+        one being sent, so a batch of small files costs about one round trip instead of one each.
+    '''
+    def getFiles(self, FILENAMES):
+        if not FILENAMES or len(FILENAMES) > MAX_BATCH_FILES:
+            return {
+                'statusCode': 400,
+                'data': 'Give between 1 and %d paths, as path=... query parameters.' % MAX_BATCH_FILES
+            }
+
+        BOUNDARY = uuid.uuid4().hex
+        return {
+            'statusCode': 200,
+            'headers': ['Content-Type: multipart/mixed; boundary=' + BOUNDARY],
+            'stream': self.__streamFiles(FILENAMES, BOUNDARY)
+        }
+
+    def __streamFiles(self, FILENAMES, BOUNDARY):
+        names = iter(FILENAMES)
+        pending = deque()
+
+        def readAhead():
+            for name in itertools.islice(names, BATCH_THREADS * 2 - len(pending)):
+                pending.append((name, self.batchExecutor.submit(self.getFileContent, name.lstrip('/'))))
+
+        try:
+            readAhead()
+            while pending:
+                name, future = pending.popleft()
+                readAhead()
+                yield from self.__filePart(name, future.result(), BOUNDARY)
+
+            yield '--%s--\r\n' % BOUNDARY
+        finally:
+            # The client went away: close whatever was opened ahead of it
+            for _, future in pending:
+                if not future.cancel():
+                    self.__closeResponse(future.result())
+
+    def __filePart(self, name, RESPONSE, BOUNDARY):
+        HEADERS = ['Content-Location: /' + name.lstrip('/'), 'X-Status: %d' % RESPONSE['statusCode']] + RESPONSE.get('headers', [])
+
+        if 'file' not in RESPONSE:
+            data = RESPONSE.get('data', b'')
+            if isinstance(data, str): data = data.encode()
+            yield '--%s\r\n%s\r\nContent-Length: %d\r\n\r\n' % (BOUNDARY, '\r\n'.join(HEADERS), len(data))
+            yield data
+            yield '\r\n'
+            return
+
+        f = RESPONSE['file']
+        try:
+            with MAPPED_FILES.open(f) as mapped:
+                yield '--%s\r\n%s\r\nContent-Length: %d\r\n\r\n' % (BOUNDARY, '\r\n'.join(HEADERS), RESPONSE['size'])
+                yield from self.__mappedSlices(mapped, RESPONSE.get('offset', 0), RESPONSE.get('offset', 0) + RESPONSE['size'])
+                yield '\r\n'
+        finally:
+            f.close()
+
+    def __closeResponse(self, RESPONSE):
+        if 'file' in RESPONSE:
+            RESPONSE['file'].close()
+
+    '''
+        REQUEST_HEADERS: dict of lower-cased request headers. If-None-Match / If-Modified-Since are
+        checked against the file's ETag and Last-Modified and answered with 304 when the client's
+        copy is current. A Range header is answered with 206 (see __applyRanges). Text files are sent
+        gzip-compressed to clients that accept it (see __compressedContent).
+    '''
+    def getFileContent(self, filename, REQUEST_HEADERS = {}):
         # If user tries to access outside of default directory
         if '..' in filename:
             return {
@@ -41,53 +376,569 @@ class FileHandler:
                 'data': 'Forbidden access.'
             }
 
-        file_path = self.defaultDirectory + '/' + filename
+        file_path, MODIFIED_NS = self.__locate(filename)
+        if file_path is None:
+            return self.__fileNotFound()
+
         try:
-            if not Path(file_path).exists() or not Path(file_path).is_file():
+            try:
+                file_stat = os.stat(file_path)
+            except (FileNotFoundError, NotADirectoryError):
+                return self.__fileNotFound()
+
+            if not stat.S_ISREG(file_stat.st_mode):
+                return self.__fileNotFound()
+
+            # The cache is validated by the file on disk, the client by the version of the name it asked for
+            version = self.__version(file_stat, MODIFIED_NS)
+
+            # The variant is picked before the conditional check, which compares the client's copy with
+            # the ETag of the variant it would get (a file that can't be compressed is sent plain).
+            # Ranges always refer to the uncompressed file
+            compressed = None
+            if 'range' not in REQUEST_HEADERS and self.__compressible(filename) and self.__acceptsGzip(REQUEST_HEADERS):
+                compressed = self.__compressedContent(file_path, filename, file_stat, version)
+            ENCODING = 'gzip' if compressed is not None else None
+
+            if self.__notModified(version, REQUEST_HEADERS, ENCODING):
+                if compressed is not None: self.__closeResponse(compressed)
                 return {
-                    'statusCode': 404,
-                    'data': 'File does not exist.'
+                    'statusCode': 304,
+                    'headers': self.__validatorHeaders(version, ENCODING)
                 }
-                
-            with open(file_path) as f: 
-                file_data = f.read()
 
-            CONTENT_TYPE = 'Content-Type: ' + mimetypes.guess_type(file_path)[0] 
-            CONTENT_DISPOSITION = 'Content-Disposition: inline; filename="' + filename + '"'
+            if compressed is not None:
+                return compressed
 
-            return {
-                'data': file_data,
+            # Hot files are answered from memory as long as they haven't changed on disk
+            entry = self.cache.get(file_path, (file_stat.st_mtime_ns, file_stat.st_size))
+            if entry is not None and entry.data is not None:
+                return self.__applyRanges({
+                    'data': entry.data,
+                    'statusCode': 200,
+                    'headers': self.__entryHeaders(entry, filename, version)
+                }, version, REQUEST_HEADERS)
+
+            '''
+                The file is opened in binary mode. Small files are read and cached; larger ones are handed
+                back unread and the server streams them with sendfile, so memory per request does not grow
+                with the file size. The caller owns the returned file and must close it.
+
+                The stat and the read happen under a shared lock so they never see a write half done.
+                Streamed files are not locked while they are sent, so a slow client can't hold up writers.
+            '''
+            try:
+                f = open(file_path, 'rb')
+            except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+                return self.__fileNotFound()
+
+            file_data = None
+            try:
+                with FileLock(file_path, shared = True, fd = f.fileno()):
+                    file_stat = os.fstat(f.fileno())
+                    if stat.S_ISREG(file_stat.st_mode) and self.cache.cacheable(file_stat.st_size):
+                        file_data = f.read()
+            except BaseException:
+                f.close()
+                raise
+
+            if not stat.S_ISREG(file_stat.st_mode):
+                f.close()
+                return self.__fileNotFound()
+
+            version = self.__version(file_stat, MODIFIED_NS)
+            HEADERS = self.__entryHeaders(entry, filename, version) if entry is not None else self.__fileHeaders(filename, version)
+            validator = (file_stat.st_mtime_ns, file_stat.st_size)
+
+            if file_data is not None:
+                f.close()
+                self.cache.put(file_path, validator, file_data, HEADERS)
+                return self.__applyRanges({
+                    'data': file_data,
+                    'statusCode': 200,
+                    'headers': HEADERS
+                }, version, REQUEST_HEADERS)
+
+            if entry is None: self.cache.put(file_path, validator, None, HEADERS)
+
+            return self.__applyRanges({
+                'file': f,
+                'size': file_stat.st_size,
                 'statusCode': 200,
-                'headers': [CONTENT_TYPE, CONTENT_DISPOSITION]
-            }
+                'headers': HEADERS
+            }, version, REQUEST_HEADERS)
+        except FileLockException:
+            return self.__fileBusy()
         except Exception as e:
             return {
                 'statusCode': 500,
                 'data': f'Error getting file content: {e}'
             }
 
-    def writeToFile(self, filename, filecontent):
-        # If user tries to access outside of default directory
-        if '..' in filename:
+    '''
+        Where a file is on disk, and when its name was last written if its stat can't tell: the path
+        in the default directory and None, or the blob holding its content in the content-addressed
+        store and the name's modification time in nanoseconds (a blob is shared, and may be older
+        than the name). (None, None) if the store has no such file.
+    '''
+    def __locate(self, filename):
+        if self.store is not None:
+            return self.store.lookup(filename) or (None, None)
+        return self.defaultDirectory + '/' + filename, None
+
+    def __version(self, file_stat, MODIFIED_NS):
+        if MODIFIED_NS is None: return file_stat
+        return FileVersion(file_stat.st_size, MODIFIED_NS / 1e9, MODIFIED_NS)
+
+    def __fileHeaders(self, filename, file_stat, ENCODING = None):
+        CONTENT_TYPE = 'Content-Type: ' + (mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        CONTENT_DISPOSITION = 'Content-Disposition: inline; filename="' + filename + '"'
+        HEADERS = [CONTENT_TYPE, CONTENT_DISPOSITION, 'Accept-Ranges: bytes']
+
+        # Caches between us and the client must keep the compressed and plain variants apart
+        if self.__compressible(filename):
+            HEADERS.append('Vary: Accept-Encoding')
+        if ENCODING is not None:
+            HEADERS.append('Content-Encoding: ' + ENCODING)
+
+        return HEADERS + self.__validatorHeaders(file_stat, ENCODING)
+
+    '''
+        The ETag changes whenever the file's size or modification time (in nanoseconds) does,
+        which is the same check the cache relies on. A compressed variant has its own ETag.
+    '''
+    def __etag(self, file_stat, ENCODING = None):
+        if ENCODING is not None:
+            return '"%x-%x-%s"' % (file_stat.st_size, file_stat.st_mtime_ns, ENCODING)
+        return '"%x-%x"' % (file_stat.st_size, file_stat.st_mtime_ns)
+
+    def __validatorHeaders(self, file_stat, ENCODING = None):
+        return ['ETag: ' + self.__etag(file_stat, ENCODING), 'Last-Modified: ' + formatdate(file_stat.st_mtime, usegmt = True)]
+
+    '''
+        The headers of a cached file. Cache entries are per path, and a blob of the content-addressed
+        store is shared by every name holding its content, so its headers are made for the name asked for.
+    '''
+    def __entryHeaders(self, entry, filename, file_stat, ENCODING = None):
+        if self.store is None: return entry.headers
+        return self.__fileHeaders(filename, file_stat, ENCODING)
+
+    def __compressible(self, filename):
+        CONTENT_TYPE = mimetypes.guess_type(filename)[0] or ''
+        return CONTENT_TYPE.startswith('text/') or CONTENT_TYPE in COMPRESSIBLE_TYPES
+
+    '''
+        True if the Accept-Encoding header gives gzip (or *) a non-zero quality.
+    '''
+    def __acceptsGzip(self, REQUEST_HEADERS):
+        ACCEPT_ENCODING = REQUEST_HEADERS.get('accept-encoding')
+        if not ACCEPT_ENCODING:
+            return False
+
+        qualities = {}
+        for ITEM in ACCEPT_ENCODING.split(','):
+            coding, _, params = ITEM.partition(';')
+            quality = 1.0
+            params = params.strip().lower()
+            if params.startswith('q='):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.0
+            qualities[coding.strip().lower()] = quality
+
+        return qualities.get('gzip', qualities.get('x-gzip', qualities.get('*', 0.0))) > 0
+
+    '''
+        Returns the gzip variant of a file, or None to send it uncompressed.
+        - A sibling FILE.gz at least as new as FILE is sent as-is with sendfile
+        - Otherwise the file is compressed once per version and kept in the cache under (path, 'gzip'),
+          validated by the same (mtime, size) as the plain file. Files too large for the cache are
+          sent uncompressed rather than recompressed on every request, as are files that gzip
+          does not make smaller
+        The validator headers are those of `version` (see __locate).
+    '''
+    def __compressedContent(self, file_path, filename, file_stat, version):
+        KEY = (file_path, 'gzip')
+        validator = (file_stat.st_mtime_ns, file_stat.st_size)
+
+        entry = self.cache.get(KEY, validator)
+        if entry is not None:
+            if entry.data is None: return None
             return {
-                'statusCode': 403,
-                'data': 'Forbidden access.'
+                'data': entry.data,
+                'statusCode': 200,
+                'headers': self.__entryHeaders(entry, filename, version, 'gzip')
             }
-            
-        filename = self.defaultDirectory + '/' + filename
 
-        # Locking the file to perform the write operation
-        with FileLock(filename):
-            try:
-                f = open(filename, "w")
-                f.write(filecontent)
-                f.close()
+        HEADERS = self.__fileHeaders(filename, version, 'gzip')
+
+        try:
+            f = open(file_path + '.gz', 'rb')
+        except OSError:
+            f = None
+
+        if f is not None:
+            gz_stat = os.fstat(f.fileno())
+            if stat.S_ISREG(gz_stat.st_mode) and gz_stat.st_mtime_ns >= file_stat.st_mtime_ns:
                 return {
-                    'data': 'Successfully wrote file content.',
-                    'statusCode': 200
+                    'file': f,
+                    'size': gz_stat.st_size,
+                    'statusCode': 200,
+                    'headers': HEADERS
                 }
-            except Exception as e:
+            f.close()
+
+        if not self.cache.cacheable(file_stat.st_size):
+            return None
+
+        # Compressed straight from the shared map of the file, without reading it into the heap
+        with open(file_path, 'rb') as f, FileLock(file_path, shared = True, fd = f.fileno()), MAPPED_FILES.open(f) as mapped:
+            # The file changed since it was stat'ed: let the plain path deal with the new version
+            if mapped.size != file_stat.st_size:
+                return None
+
+            with mapped.view() as file_data:
+                compressed = gzip.compress(file_data, compresslevel = 6, mtime = 0)
+
+        if len(compressed) >= file_stat.st_size:
+            # Remember that this version doesn't compress
+            self.cache.put(KEY, validator, None, None)
+            return None
+
+        self.cache.put(KEY, validator, compressed, HEADERS)
+        return {
+            'data': compressed,
+            'statusCode': 200,
+            'headers': HEADERS
+        }
+
+    '''
+        If-None-Match takes precedence over If-Modified-Since (RFC 7232 section 6).
+    '''
+    def __notModified(self, file_stat, REQUEST_HEADERS, ENCODING = None):
+        IF_NONE_MATCH = REQUEST_HEADERS.get('if-none-match')
+        if IF_NONE_MATCH is not None:
+            if IF_NONE_MATCH.strip() == '*': return True
+            # Weak comparison: W/"x" matches "x"
+            tags = [tag.strip().replace('W/', '', 1) for tag in IF_NONE_MATCH.split(',')]
+            return self.__etag(file_stat, ENCODING) in tags
+
+        IF_MODIFIED_SINCE = REQUEST_HEADERS.get('if-modified-since')
+        if IF_MODIFIED_SINCE is not None:
+            try:
+                since = parsedate_to_datetime(IF_MODIFIED_SINCE).timestamp()
+            except (TypeError, ValueError):
+                return False
+            # HTTP dates have a one second resolution
+            return int(file_stat.st_mtime) <= since
+
+        return False
+
+    '''
+        Turns a full 200 file response into a 206 when the request has a satisfiable Range header.
+        - One range: the same body narrowed to the range (an offset into the file for sendfile, or a
+          zero-copy slice of the cached bytes)
+        - Several ranges: a multipart/byteranges stream of only the requested bytes, sliced from the file's shared map
+        - No satisfiable range: 416 with the file size in Content-Range
+    '''
+    def __applyRanges(self, RESPONSE, file_stat, REQUEST_HEADERS):
+        ranges = self.__requestedRanges(file_stat, REQUEST_HEADERS)
+        if ranges is None:
+            return RESPONSE
+
+        size = file_stat.st_size
+
+        if not ranges:
+            if 'file' in RESPONSE: RESPONSE['file'].close()
+            return {
+                'statusCode': 416,
+                'headers': ['Content-Range: bytes */%d' % size],
+                'data': 'Requested range not satisfiable.'
+            }
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            HEADERS = RESPONSE['headers'] + ['Content-Range: bytes %d-%d/%d' % (start, end, size)]
+
+            if 'file' in RESPONSE:
                 return {
-                    'statusCode': 500,
-                    'data': f'Error getting file content: {e}'
-                }
\ No newline at end of file
+                    'file': RESPONSE['file'],
+                    'offset': start,
+                    'size': end - start + 1,
+                    'statusCode': 206,
+                    'headers': HEADERS
+                }
+
+            return {
+                'data': memoryview(RESPONSE['data'])[start:end + 1],
+                'statusCode': 206,
+                'headers': HEADERS
+            }
+
+        BOUNDARY = uuid.uuid4().hex
+        CONTENT_TYPE = 'application/octet-stream'
+        HEADERS = []
+        for HEADER in RESPONSE['headers']:
+            if HEADER.lower().startswith('content-type:'):
+                CONTENT_TYPE = HEADER.split(':', 1)[1].strip()
+            else:
+                HEADERS.append(HEADER)
+
+        # Part headers are built up front so the exact Content-Length is known
+        parts = []
+        for start, end in ranges:
+            PART_HEADER = '--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (BOUNDARY, CONTENT_TYPE, start, end, size)
+            parts.append((PART_HEADER.encode(), start, end))
+        CLOSING = ('--%s--\r\n' % BOUNDARY).encode()
+
+        length = sum(len(PART_HEADER) + (end - start + 1) + 2 for PART_HEADER, start, end in parts) + len(CLOSING)
+
+        return {
+            'stream': self.__streamRanges(RESPONSE, parts, CLOSING),
+            'size': length,
+            'statusCode': 206,
+            'headers': HEADERS + ['Content-Type: multipart/byteranges; boundary=' + BOUNDARY]
+        }
+
+    def __streamRanges(self, RESPONSE, parts, CLOSING):
+        f = RESPONSE.get('file')
+        mapped = MAPPED_FILES.open(f) if f is not None else None
+        try:
+            for PART_HEADER, start, end in parts:
+                yield PART_HEADER
+
+                if mapped is None:
+                    yield memoryview(RESPONSE['data'])[start:end + 1]
+                else:
+                    yield from self.__mappedSlices(mapped, start, end + 1)
+
+                yield b'\r\n'
+
+            yield CLOSING
+        finally:
+            if mapped is not None: mapped.release()
+            if f is not None: f.close()
+
+    '''
+        Bytes [start, end) of a mapped file (see Modules/MappedFile.py) as memoryview slices of at most
+        MAP_SLICE bytes: the content is sent straight from the page cache without being read into the
+        Python heap, and every reader of the same version of the file shares the one map.
+    '''
+    def __mappedSlices(self, mapped, start, end):
+        if end > mapped.size:
+            raise IOError('File shrank while being sent.')
+
+        for position in range(start, end, MAP_SLICE):
+            yield mapped.view(position, min(position + MAP_SLICE, end))
+
+    '''
+        Returns None when the whole file should be sent (no Range header, a range unit other than
+        bytes, a malformed or overly long range set, or an If-Range that no longer matches),
+        otherwise the list of satisfiable (start, end) byte ranges, end inclusive. An empty list
+        means nothing could be satisfied.
+    '''
+    def __requestedRanges(self, file_stat, REQUEST_HEADERS):
+        MAX_RANGES = 32
+
+        RANGE = REQUEST_HEADERS.get('range')
+        if RANGE is None:
+            return None
+
+        IF_RANGE = REQUEST_HEADERS.get('if-range')
+        if IF_RANGE is not None:
+            IF_RANGE = IF_RANGE.strip()
+            if IF_RANGE.startswith('"') or IF_RANGE.startswith('W/'):
+                if IF_RANGE != self.__etag(file_stat): return None
+            elif IF_RANGE != formatdate(file_stat.st_mtime, usegmt = True):
+                return None
+
+        unit, _, specs = RANGE.partition('=')
+        specs = specs.split(',')
+        if unit.strip().lower() != 'bytes' or len(specs) > MAX_RANGES:
+            return None
+
+        size = file_stat.st_size
+        ranges = []
+
+        for spec in specs:
+            first, dash, last = spec.strip().partition('-')
+            if not dash: return None
+
+            try:
+                if first == '':
+                    # Suffix range: the last N bytes
+                    length = int(last)
+                    start, end = max(0, size - length), size - 1
+                    if length <= 0: continue
+                else:
+                    start = int(first)
+                    end = int(last) if last else start
+                    if start < 0 or end < start: return None
+                    end = min(end if last else size - 1, size - 1)
+            except ValueError:
+                return None
+
+            if start < size:
+                ranges.append((start, end))
+
+        return ranges
+
+    def __fileBusy(self):
+        return {
+            'statusCode': 503,
+            'headers': ['Retry-After: 1'],
+            'data': 'File is busy, try again later.'
+        }
+
+    def __fileNotFound(self):
+        return {
+            'statusCode': 404,
+            'data': 'File does not exist.'
+        }
+
+    '''
+        Starts writing a file whose content arrives in pieces (see Modules/Upload.py): the returned
+        Upload takes the body through write() and is finished with finishUpload(). Raises
+        UploadError when the file can't be written.
+    '''
+    def beginUpload(self, filename):
+        # If user tries to access outside of default directory
+        if '..' in filename:
+            raise UploadError(403, 'Forbidden access.')
+
+        try:
+            if self.store is not None:
+                if filename.endswith('/'): raise UploadError(400, 'FileName is a directory.')
+                return BlobUpload(self.store, filename, self.maxUploadSize, self.fsync)
+
+            return Upload(self.defaultDirectory + '/' + filename, self.maxUploadSize, self.fsync)
+        except OSError as e:
+            raise UploadError(500, f'Error writing file content: {e}')
+
+    '''
+        Starts a write of part of a file, finished with finishUpload() like any upload (see
+        PartialUpload in Modules/Upload.py). Without CONTENT_RANGE the body is appended to the file,
+        which is created if missing. With it ("bytes START-END/TOTAL", TOTAL may be *) the body must
+        be that range, written over the existing file from START on. Raises UploadError when the
+        range is malformed or the file can't be written.
+    '''
+    def beginPartialUpload(self, filename, CONTENT_RANGE = None):
+        # If user tries to access outside of default directory
+        if '..' in filename:
+            raise UploadError(403, 'Forbidden access.')
+
+        # Blobs never change: appending or patching would have to copy the whole file into a new one
+        if self.store is not None:
+            raise UploadError(501, 'Partial writes are not supported by the content-addressed storage.')
+
+        OFFSET = LENGTH = None
+        if CONTENT_RANGE is not None:
+            OFFSET, LENGTH = self.__contentRange(CONTENT_RANGE)
+
+        try:
+            return PartialUpload(self.defaultDirectory + '/' + filename, OFFSET, LENGTH, self.maxUploadSize, self.fsync)
+        except OSError as e:
+            raise UploadError(500, f'Error writing file content: {e}')
+
+    '''
+        (offset, length) of the range a Content-Range header gives. Raises UploadError(400) unless
+        it is a single byte range.
+    '''
+    def __contentRange(self, CONTENT_RANGE):
+        unit, _, spec = CONTENT_RANGE.strip().partition(' ')
+        span, slash, total = spec.strip().partition('/')
+        first, dash, last = span.partition('-')
+
+        try:
+            if unit.lower() != 'bytes' or not slash or not dash: raise ValueError
+            start, end = int(first), int(last)
+            if start < 0 or end < start or (total != '*' and int(total) <= end): raise ValueError
+        except ValueError:
+            raise UploadError(400, 'Content-Range must be "bytes START-END/TOTAL" (TOTAL may be *).')
+
+        return start, end - start + 1
+
+    '''
+        Moves a complete upload into place. Readers keep whichever version they opened, so they
+        never see a half-written file. A partial upload is copied into the file instead.
+    '''
+    def finishUpload(self, filename, upload):
+        name = filename
+        filename = self.defaultDirectory + '/' + filename
+
+        try:
+            upload.commit()
+
+            self.cache.invalidate(filename)
+            self.cache.invalidate((filename, 'gzip'))
+            if self.index is not None and '/' not in name: self.index.add(name)
+            return {
+                'data': 'Successfully wrote file content.',
+                'statusCode': 200
+            }
+        except FileLockException:
+            return self.__fileBusy()
+        except UploadError as e:
+            return {
+                'statusCode': e.status_code,
+                'headers': e.headers,
+                'data': str(e)
+            }
+        except Exception as e:
+            return {
+                'statusCode': 500,
+                'data': f'Error getting file content: {e}'
+            }
+
+    def writeToFile(self, filename, filecontent):
+        try:
+            upload = self.beginUpload(filename)
+            upload.write(filecontent)
+        except UploadError as e:
+            return {
+                'statusCode': e.status_code,
+                'data': str(e)
+            }
+
+        return self.finishUpload(filename, upload)
+
+    '''
+        Starts a batch upload: a multipart body (multipart/form-data as sent by curl -F, or
+        multipart/mixed with a Content-Location per part) whose parts are written to the files they
+        name. Raises UploadError when the body is not multipart.
+    '''
+    def beginBatchUpload(self, CONTENT_TYPE):
+        if not CONTENT_TYPE.lower().startswith('multipart/'):
+            raise UploadError(415, 'A batch upload must be a multipart body.')
+
+        return BatchUpload(header_param(CONTENT_TYPE, 'boundary'), self.beginUpload, self.maxUploadSize)
+
+    '''
+        Moves the files of a complete batch upload into place, up to BATCH_THREADS at a time (each
+        may have to be synced to disk first). Answers 200 if every file was written and 207 if
+        some were not, with the status of each file as JSON.
+    '''
+    def finishBatchUpload(self, batch):
+        try:
+            batch.close()
+        except UploadError as e:
+            return {
+                'statusCode': e.status_code,
+                'data': str(e)
+            }
+
+        def finish(part):
+            name, upload, error = part
+            if error is not None:
+                return {'name': name, 'status': error.status_code, 'message': str(error)}
+
+            RESPONSE = self.finishUpload(name, upload)
+            return {'name': name, 'status': RESPONSE['statusCode'], 'message': RESPONSE['data']}
+
+        results = list(self.batchExecutor.map(finish, batch.parts))
+        return {
+            'statusCode': 200 if all(result['status'] == 200 for result in results) else 207,
+            'headers': ['Content-Type: application/json'],
+            'data': json.dumps({'files': results})
+        }
@@ -1,110 +1,1010 @@
+import os
 import socket
-from http.client import responses
-from FileHandler import FileHandler
-from threading import Thread
+import signal
+import asyncio
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs, parse_qsl
+from FileHandler import FileHandler, STORAGE_BACKENDS
+from Modules.WorkerPool import WorkerPool
+from Modules.HTTPParser import HTTPParser, HTTPParseError
+from Modules.Upload import UploadError, DiscardedBody, FSYNC_POLICIES
+from Modules.Metrics import Metrics
+from Modules.AccessLog import AccessLog, FORMATS
+from Modules.FileLock import LOCKS
+from Modules.MappedFile import MAPPED_FILES
+from Modules.ResponseBuilder import ResponseBuilder, send_buffers, buffers_length
+from Modules.ConnectionGuard import RequestTimeout, TransferRate, ConnectionLimiter
 import time
 
 '''
     PORT:       Integer     > Port to connect to
     DIRECTORY:  String      > Directory to use
-    VERBOSE:    Boolean     > Print debugging information 
+    VERBOSE:    Boolean     > Print debugging information and log every request to stdout
+    THREADS:    Integer     > Number of worker threads serving connections (file I/O executor size for the async engine)
+    QUEUE_SIZE: Integer     > Accepted connections allowed to wait for a worker
+    BACKLOG:    Integer     > Listen backlog of the server socket
+    ENGINE:     String      > 'thread' for the worker pool, 'async' for the event loop
+    KEEP_ALIVE_TIMEOUT: Number  > Seconds an idle persistent connection is kept open (0 disables keep-alive)
+    MAX_REQUESTS:       Integer > Requests served on one connection before it is closed
+    CACHE_SIZE:         Integer > Bytes of hot file content cached in memory (0 disables the cache)
+    INDEX_SNAPSHOT:     String  > File the directory index is saved to and reloaded from on restart
+    MAX_BODY_SIZE:      Integer > Largest request body accepted, in bytes (0 for no limit)
+    FSYNC:              String  > When uploads are synced to disk: 'never', 'file' or 'always'
+    WORKERS:            Integer > Server processes sharing the port (1 serves from this process)
+    ACCESS_LOG:         String  > File the access log is appended to ('-' for stdout, None for no log)
+    LOG_FORMAT:         String  > 'json' or 'clf' (combined log format) access log lines
+    LOG_SAMPLE:         Number  > Fraction of requests logged (server errors are always logged)
+    PIPELINE_DEPTH:     Integer > Pipelined GET/HEAD requests of one connection handled at the same time
+    HEADER_TIMEOUT:     Number  > Seconds a request's headers may take to arrive (0 for no limit)
+    BODY_TIMEOUT:       Number  > Seconds a request body may go without data (0 for no limit)
+    WRITE_TIMEOUT:      Number  > Seconds a response write may make no progress (0 for no limit)
+    MIN_RATE:           Integer > Bytes per second request and response bodies must average (0 for no minimum)
+    MAX_CONNECTIONS_PER_IP: Integer > Connections one client address may have open (0 for no limit, needs WORKERS 1)
+    STORAGE:            String  > 'files' (as named in DIRECTORY) or 'cas' (deduplicated by content, one process only)
 '''
 
+ENGINES = ['thread', 'async']
+
+# Internal endpoint answering with the server's metrics (see __stats)
+STATS_PATH = '/__stats'
+
+# Batch endpoint: GET with path=... parameters for several files, POST with a multipart body to write several
+BATCH_PATH = '/__batch'
+
+# Requests that don't change any file, so pipelined ones may be handled at the same time
+SAFE_METHODS = ('GET', 'HEAD')
+
+# Sent as-is when every worker is busy and the queue is full
+SERVICE_UNAVAILABLE = b'HTTP/1.0 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+# Sent as-is when the client's address already has as many connections open as allowed
+TOO_MANY_CONNECTIONS = b'HTTP/1.0 429 Too Many Requests\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+# Seconds a transfer runs before its average rate is held to MIN_RATE, and the largest piece of a file
+# sent at once so the rate is checked while a large file goes out
+RATE_GRACE_SECONDS = 5
+SENDFILE_SLICE = 256 * 1024
+
 class HTTPServerLibrary:
 
     def __init__(self): 
         self.fileHandler = FileHandler()
+        self.keepAliveTimeout = 5
+        self.maxRequests = 100
+        self.maxBodySize = 1024 ** 3
+        self.metrics = Metrics()
+        self.accessLog = None
+        self.responseBuilder = ResponseBuilder(keep_alive_timeout = self.keepAliveTimeout)
+        self.pipelineDepth = 1
+        self.pipelineExecutor = None
+        self.headerTimeout = 10
+        self.bodyTimeout = 30
+        self.writeTimeout = 30
+        self.minRate = 1024
+        self.connectionLimiter = ConnectionLimiter()
+
+    def startServer(self, PORT, DIRECTORY = "Data", VERBOSE = False, THREADS = 32, QUEUE_SIZE = 128, BACKLOG = 128, ENGINE = 'thread',
+                    KEEP_ALIVE_TIMEOUT = 5, MAX_REQUESTS = 100, CACHE_SIZE = 64 * 1024 * 1024, INDEX_SNAPSHOT = None,
+                    MAX_BODY_SIZE = 1024 ** 3, FSYNC = 'never', WORKERS = 1, ACCESS_LOG = None, LOG_FORMAT = 'json', LOG_SAMPLE = 1.0,
+                    PIPELINE_DEPTH = 1, HEADER_TIMEOUT = 10, BODY_TIMEOUT = 30, WRITE_TIMEOUT = 30, MIN_RATE = 1024,
+                    MAX_CONNECTIONS_PER_IP = 0, STORAGE = 'files'):
 
-    def startServer(self, PORT, DIRECTORY = "Data", VERBOSE = False):
+        # The content-addressed store's index is kept in memory, which worker processes can't share
+        if STORAGE == 'cas' and WORKERS > 1:
+            raise ValueError('The cas storage can only be served by a single worker.')
+
+        # So are the connection counts: the kernel spreads a client's connections over the workers
+        if MAX_CONNECTIONS_PER_IP and WORKERS > 1:
+            raise ValueError('A per-address connection limit can only be enforced by a single worker.')
 
         if not DIRECTORY: DIRECTORY = "Data"
         self.fileHandler.setDefaultDirectory(DIRECTORY)
+        self.fileHandler.setCacheSize(CACHE_SIZE)
+        self.fileHandler.setUploadPolicy(MAX_BODY_SIZE, FSYNC)
+        self.fileHandler.setStorage(STORAGE)
+        self.fileHandler.buildIndex(INDEX_SNAPSHOT)
+        self.keepAliveTimeout = KEEP_ALIVE_TIMEOUT
+        self.maxRequests = MAX_REQUESTS
+        self.responseBuilder = ResponseBuilder(keep_alive_timeout = KEEP_ALIVE_TIMEOUT)
+        self.pipelineDepth = PIPELINE_DEPTH
+        self.maxBodySize = MAX_BODY_SIZE
+        self.headerTimeout = HEADER_TIMEOUT
+        self.bodyTimeout = BODY_TIMEOUT
+        self.writeTimeout = WRITE_TIMEOUT
+        self.minRate = MIN_RATE
+        self.connectionLimiter = ConnectionLimiter(MAX_CONNECTIONS_PER_IP)
+
+        if ENGINE not in ENGINES:
+            raise ValueError('Unknown engine: ' + str(ENGINE))
+
+        if FSYNC not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy: ' + str(FSYNC))
+
+        if LOG_FORMAT not in FORMATS:
+            raise ValueError('Unknown access log format: ' + str(LOG_FORMAT))
+
+        # -v logs requests to the terminal unless they already go to a file
+        if ACCESS_LOG is None and VERBOSE: ACCESS_LOG = '-'
+
+        def serve(server_socket):
+            # Opened here so each worker process has its own writer thread
+            if ACCESS_LOG is not None:
+                self.accessLog = AccessLog(ACCESS_LOG, LOG_FORMAT, LOG_SAMPLE)
+
+            if ENGINE == 'async':
+                asyncio.run(self.__serveAsync(server_socket, VERBOSE, THREADS, BACKLOG))
+            else:
+                self.__serveThreaded(server_socket, VERBOSE, THREADS, QUEUE_SIZE)
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+        if WORKERS <= 1:
+            with self.__listen(PORT, BACKLOG) as server_socket:
+                serve(server_socket)
+            return
 
+        if not hasattr(os, 'fork'):
+            raise ValueError('Several workers need os.fork, which this platform does not have.')
+
+        if hasattr(socket, 'SO_REUSEPORT'):
+            # Every worker listens on its own socket and the kernel spreads new connections between them.
+            # Binding once here without SO_REUSEPORT reports a port already in use (even by another server
+            # using SO_REUSEPORT, which would otherwise silently share it) before any worker is started.
+            self.__bind(PORT).close()
+
+            def runWorker():
+                with self.__listen(PORT, BACKLOG, True) as server_socket:
+                    serve(server_socket)
+
+            self.__supervise(WORKERS, runWorker, VERBOSE)
+        else:
+            # Workers inherit one listening socket and take turns accepting from it
+            with self.__listen(PORT, BACKLOG) as server_socket:
+                self.__supervise(WORKERS, lambda: serve(server_socket), VERBOSE)
+
+
+    def __bind(self, PORT, REUSE_PORT = False):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if REUSE_PORT: server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             server_socket.bind(('localhost', PORT))
-            server_socket.listen(5)
+        except BaseException:
+            server_socket.close()
+            raise
+
+        return server_socket
+
+
+    def __listen(self, PORT, BACKLOG, REUSE_PORT = False):
+        server_socket = self.__bind(PORT, REUSE_PORT)
+        server_socket.listen(BACKLOG)
+        return server_socket
+
+
+    '''
+        Multi-process mode. Each worker is a forked copy of this process (sharing the directory index
+        built at startup) running its own engine, so request parsing and response building use every
+        core instead of being serialised by the GIL. Worker state stays coherent through the file
+        system: the cache checks each file's stat, the index rescans when the directory changes and
+        file locks also take flock.
+        This process only supervises: a worker that dies is replaced (after a pause if it died right
+        after starting, so a worker that can't start does not spin). SIGINT/SIGTERM stop every worker.
+    '''
+    def __supervise(self, WORKERS, RUN_WORKER, VERBOSE):
+        RESTART_DELAY = 1
+        workers = {}
+
+        def stop(signum, frame):
+            raise SystemExit(0)
+
+        signal.signal(signal.SIGTERM, stop)
+
+        try:
+            for _ in range(WORKERS):
+                pid = self.__spawnWorker(RUN_WORKER)
+                workers[pid] = time.monotonic()
+                if VERBOSE: print('Worker started: ', pid)
+
+            while True:
+                pid, status = os.wait()
+                if pid not in workers: continue
+
+                started = workers.pop(pid)
+                print('Worker %d exited with status %d, restarting' % (pid, os.waitstatus_to_exitcode(status)))
+                if time.monotonic() - started < RESTART_DELAY: time.sleep(RESTART_DELAY)
+
+                pid = self.__spawnWorker(RUN_WORKER)
+                workers[pid] = time.monotonic()
+                if VERBOSE: print('Worker started: ', pid)
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            for pid in workers:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+
+
+    def __spawnWorker(self, RUN_WORKER):
+        pid = os.fork()
+        if pid: return pid
+
+        # Worker: Ctrl-C reaches the whole process group, but only the supervisor decides when workers stop
+        exitCode = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            RUN_WORKER()
+        except BaseException:
+            traceback.print_exc()
+            exitCode = 1
+        finally:
+            os._exit(exitCode)
+
+
+    def __serveThreaded(self, server_socket, VERBOSE, THREADS, QUEUE_SIZE):
+        pool = WorkerPool(THREADS, QUEUE_SIZE)
+
+        # Pipelined requests are handed to separate threads: a worker waiting on tasks queued
+        # behind other connections in its own pool could deadlock it
+        if self.pipelineDepth > 1:
+            self.pipelineExecutor = ThreadPoolExecutor(max_workers = THREADS, thread_name_prefix = 'httpfs-pipeline')
+
+        while True:    
+            client_connection, client_address = server_socket.accept()
+            accepted = time.monotonic()
+
+            # One client can't hold more than its share of the workers
+            if not self.connectionLimiter.acquire(client_address[0]):
+                self.__rejectClient(client_connection, TOO_MANY_CONNECTIONS, 429)
+                self.__logRejection(client_address, None, 429, len(TOO_MANY_CONNECTIONS))
+                continue
+
+            # Hand the connection to a worker, or turn it away if the pool is saturated
+            if not pool.submit(self.__handleClient, client_connection, client_address, VERBOSE, accepted):
+                self.connectionLimiter.release(client_address[0])
+                self.__rejectClient(client_connection)
+                self.__logRejection(client_address, None, 503, len(SERVICE_UNAVAILABLE))
+
+
+    '''
+        Answers 503 (or RESPONSE with STATUS) without reading the request so the accept loop is never
+        held up. The unread request is drained afterwards so closing does not reset the connection
+        before the client sees the response.
+    '''
+    def __rejectClient(self, client_connection, RESPONSE = SERVICE_UNAVAILABLE, STATUS = 503):
+        self.metrics.count_request('-', STATUS)
+        try:
+            client_connection.setblocking(False)
+            client_connection.send(RESPONSE)
+            client_connection.shutdown(socket.SHUT_WR)
+            client_connection.recv(4096)
+        except OSError:
+            pass
+        finally:
+            client_connection.close()
+
+
+    def __handleClient(self, client_connection, client_address, VERBOSE, ACCEPTED):
+        self.metrics.connection_opened()
+        try:
+            # A response is written in several sends (head, then file or chunks): without this, Nagle's
+            # algorithm holds the next one back until the client's delayed ACK, about 40ms later
+            client_connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.__serveClient(client_connection, client_address, VERBOSE, ACCEPTED)
+        except (RequestTimeout, socket.timeout) as e:
+            if VERBOSE: print('Slow client disconnected: ', client_address, e)
+        except ConnectionError as e:
+            if VERBOSE: print('Connection error: ', client_address, e)
+        finally:
+            client_connection.close()
+            self.connectionLimiter.release(client_address[0])
+            self.metrics.connection_closed()
+
+
+    '''
+        Serves requests on one connection until the client asks to close, the idle
+        timeout expires or MAX_REQUESTS have been answered.
+        A client too slow to send its request gets 408 and is disconnected (see __readTimeout). The
+        first request's header timeout counts from ACCEPTED (time.monotonic() at the accept), so the
+        time the connection waited in the pool's queue is included.
+    '''
+    def __serveClient(self, client_connection, client_address, VERBOSE, ACCEPTED):
+        BUFFER_SIZE = 65536
+        parser = HTTPParser(onHeaders = self.__onHeaders)
+        requests = deque()
+        requestCount = 0
+        parseStarted = None
+        headerDeadline = self.__headerDeadline(ACCEPTED)
+        bodyRate = None
+
+        try:
+            while True:
+                if not requests:
+                    timeout, idle = self.__readTimeout(parser, requestCount, headerDeadline)
+                    client_connection.settimeout(timeout)
+
+                    try:
+                        try:
+                            packet = client_connection.recv(BUFFER_SIZE)
+                        except socket.timeout:
+                            if idle:
+                                if VERBOSE: print('Idle connection closed: ', client_address)
+                                return
+                            raise RequestTimeout('Request not received in time.')
+
+                        if not packet: return
+
+                        self.metrics.received(len(packet))
+                        if not parser.hasPartialMessage():
+                            parseStarted = time.perf_counter()
+                            # The first request's headers are timed from the accept
+                            if requestCount > 0: headerDeadline = self.__headerDeadline()
+                        if bodyRate is not None: bodyRate.add(len(packet))
+
+                        messages = parser.feed(packet)
+                    except (HTTPParseError, UploadError, RequestTimeout) as e:
+                        response = self.__rejectRequest(e, parser.message, client_address)
+                        client_connection.settimeout(self.writeTimeout or None)
+                        send_buffers(client_connection, response)
+                        self.__lingeringClose(client_connection)
+                        return
+
+                    requests.extend(self.__timeParse(messages, parseStarted))
+                    if messages:
+                        parseStarted = time.perf_counter()
+                        headerDeadline = self.__headerDeadline()
+                    bodyRate = self.__bodyRate(parser, bodyRate)
+                    continue
+
+                batch = self.__nextBatch(requests, requestCount)
+                requestCount += len(batch)
+
+                records = [self.__newRecord(request, client_address, parseSeconds) for request, parseSeconds, _, _ in batch]
+                results = self.__respondBatch(batch, records)
+
+                try:
+                    keepAlive = self.__sendResponses(client_connection, batch, records, results)
+                finally:
+                    for _, body, _ in results:
+                        self.__closeBody(body)
+
+                if not keepAlive: return
+        finally:
+            self.__abortUploads(parser, requests)
+
+
+    '''
+        Time by which the head of the next request must have been received (None without a header timeout),
+        counting from STARTED (time.monotonic()) or from now.
+    '''
+    def __headerDeadline(self, STARTED = None):
+        if not self.headerTimeout: return None
+        return (time.monotonic() if STARTED is None else STARTED) + self.headerTimeout
+
+
+    '''
+        How long the next read may wait, depending on where the connection is:
+        - between requests of a persistent connection: the keep-alive timeout
+        - in the head of a request (or before the first one): what is left of the header timeout
+        - in a request body: the body timeout, for every read
+        Returns (timeout, idle). Running out of time while idle closes the connection quietly;
+        otherwise the client gets 408.
+    '''
+    def __readTimeout(self, parser, requestCount, headerDeadline):
+        if parser.readingBody():
+            return self.bodyTimeout or None, False
+
+        if requestCount > 0 and not parser.hasPartialMessage():
+            return self.keepAliveTimeout, True
+
+        if headerDeadline is None: return None, False
+
+        # A zero timeout would make the socket non-blocking instead of timing out
+        return max(0.001, headerDeadline - time.monotonic()), not parser.hasPartialMessage()
+
+
+    '''
+        The TransferRate of the request body being received, started when its head has been parsed.
+        None between bodies.
+    '''
+    def __bodyRate(self, parser, bodyRate):
+        if not parser.readingBody(): return None
+        return bodyRate or TransferRate(self.minRate, RATE_GRACE_SECONDS)
+
+
+    '''
+        Takes the requests to answer next off the connection's queue, as (request, parseSeconds,
+        keepAlive, remainingRequests) tuples. Pipelined GET/HEAD requests are taken together, up to
+        the pipeline depth, and handled at the same time: none of them changes what another reads.
+        Any other request is answered alone, after the ones before it and before the ones after it.
+        The batch also ends at a request after which the connection closes.
+    '''
+    def __nextBatch(self, requests, requestCount):
+        batch = []
+
+        while requests and len(batch) < self.pipelineDepth:
+            request, parseSeconds = requests[0]
+            if batch and request.method not in SAFE_METHODS: break
+
+            requests.popleft()
+            requestCount += 1
+            keepAlive = self.__wantsKeepAlive(request) and requestCount < self.maxRequests
+            batch.append((request, parseSeconds, keepAlive, self.maxRequests - requestCount))
+
+            if not keepAlive or request.method not in SAFE_METHODS: break
+
+        return batch
+
+
+    '''
+        __respond for every request of a batch: on this thread for a single request, otherwise
+        concurrently on the pipeline executor. Returns the (response, body, keepAlive) results in
+        request order.
+    '''
+    def __respondBatch(self, batch, records):
+        if len(batch) == 1:
+            request, _, keepAlive, remaining = batch[0]
+            return [self.__respond(request, records[0], keepAlive, remaining)]
+
+        futures = [self.pipelineExecutor.submit(self.__respond, request, record, keepAlive, remaining)
+                   for (request, _, keepAlive, remaining), record in zip(batch, records)]
+
+        return self.__gathered([future.exception() or future.result() for future in futures])
+
+
+    '''
+        Results of __respond for a batch, where a failed one is the exception it raised. If any failed,
+        the bodies the others opened are closed and the first exception is raised.
+    '''
+    def __gathered(self, outcomes):
+        errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+        if not errors: return outcomes
+
+        for outcome in outcomes:
+            if not isinstance(outcome, BaseException): self.__closeBody(outcome[1])
+        raise errors[0]
+
+
+    '''
+        Writes the responses of a batch in request order. Consecutive responses held in memory are
+        written together with one sendmsg; a file or stream body is sent after the responses before
+        it. Returns whether the connection stays open.
+    '''
+    def __sendResponses(self, client_connection, batch, records, results):
+        client_connection.settimeout(self.writeTimeout or None)
+        buffers = []
+        waiting = []
+        sendStarted = time.perf_counter()
+
+        for index, ((request, _, _, _), record, (response, body, keepAlive)) in enumerate(zip(batch, records, results)):
+            buffers.extend(response)
+            waiting.append((request, record, buffers_length(response)))
+            if body is None and keepAlive and index < len(batch) - 1: continue
+
+            try:
+                self.metrics.sent(send_buffers(client_connection, buffers))
+                complete = body is None or self.__sendBody(client_connection, body, record)
+            finally:
+                for waitingRequest, waitingRecord, size in waiting:
+                    self.__finishRequest(waitingRequest, waitingRecord, size, sendStarted)
+
+            # A file that shrank while being sent leaves the response short: the connection can't be reused
+            if not complete or not keepAlive: return False
+
+            buffers, waiting = [], []
+            sendStarted = time.perf_counter()
+
+        return True
+
+
+    '''
+        Runs as soon as a request's headers are parsed, before its body is read.
+        - A body announced larger than the limit is refused with 413 without reading it
+        - The body of a file upload is streamed into the file (see FileHandler.beginUpload)
+          instead of being buffered in memory, and the parts of a batch upload into theirs
+          (see FileHandler.beginBatchUpload). Appends and PATCH writes are spooled the same
+          way (see FileHandler.beginPartialUpload)
+        - Any other body is counted against the limit and dropped, never buffered: it may be
+          chunked, so the announced length alone can't bound it
+        Raising UploadError stops the connection with that status.
+    '''
+    def __onHeaders(self, request):
+        CONTENT_LENGTH = request.header('content-length', '').strip()
+        if self.maxBodySize and CONTENT_LENGTH.isdigit() and int(CONTENT_LENGTH) > self.maxBodySize:
+            raise UploadError(413, 'Request body is larger than %d bytes.' % self.maxBodySize)
+
+        if request.method == 'POST' and urlsplit(request.path).path == BATCH_PATH:
+            request.bodySink = self.fileHandler.beginBatchUpload(request.header('content-type', ''))
+        elif request.method in ('POST', 'PATCH') and request.path != '/':
+            FILENAME, PARTIAL = self.__uploadTarget(request)
+            if request.method == 'PATCH':
+                request.bodySink = self.fileHandler.beginPartialUpload(FILENAME, request.header('content-range', ''))
+            elif PARTIAL:
+                request.bodySink = self.fileHandler.beginPartialUpload(FILENAME)
+            else:
+                request.bodySink = self.fileHandler.beginUpload(FILENAME)
+        else:
+            request.bodySink = DiscardedBody(self.maxBodySize)
+
+
+    '''
+        The file a POST or PATCH writes, and whether only part of it is written: a PATCH writes the
+        range of its Content-Range and a POST with ?append=1 appends to the file. Any other POST
+        replaces the file named by the whole path.
+    '''
+    def __uploadTarget(self, request):
+        URL = urlsplit(request.path)
+        if request.method == 'PATCH' or parse_qs(URL.query).get('append') == ['1']:
+            return URL.path[1:], True
+
+        return request.path[1:], False
+
+
+    '''
+        Records the parse phase of the requests completed by one read: from the first byte of a
+        request to its last, so it includes waiting for the rest of the request to arrive.
+        Returns (request, parse seconds) pairs.
+    '''
+    def __timeParse(self, messages, parseStarted):
+        timed = []
+        now = time.perf_counter()
+
+        for message in messages:
+            self.metrics.observe('parse', self.__route(message), now - parseStarted)
+            timed.append((message, now - parseStarted))
+            parseStarted = now
+
+        return timed
 
-            while True:    
-                client_connection, client_address = server_socket.accept()
-                
-                # Spin up a new thread on client request
-                thread = Thread(target = self.__handleClient, args = (client_connection, client_address, VERBOSE ))
-                thread.start()
+
+    '''
+        Access log record of one request (None when there is no access log), completed by
+        __respond, __sendBody and __finishRequest.
+    '''
+    def __newRecord(self, request, client_address, parseSeconds):
+        if self.accessLog is None: return None
+
+        return {
+            'time': time.time(),
+            'remote': client_address[0] if client_address else '-',
+            'method': request.method,
+            'path': request.path,
+            'version': request.version,
+            'status': 0,
+            'bytes': 0,
+            'request_bytes': request.bodyLength,
+            'parse_ms': parseSeconds * 1000,
+            'handler_ms': 0.0,
+            'send_ms': 0.0,
+            'referer': request.header('referer'),
+            'user_agent': request.header('user-agent')
+        }
+
+
+    def __finishRequest(self, request, record, headerBytes, sendStarted):
+        sendSeconds = time.perf_counter() - sendStarted
+        self.metrics.observe('send', self.__route(request), sendSeconds)
+
+        if record is not None:
+            record['bytes'] += headerBytes
+            record['send_ms'] = sendSeconds * 1000
+            self.accessLog.log(record)
+
+
+    '''
+        Logs a response sent without going through __respond (a rejected connection or request).
+    '''
+    def __logRejection(self, client_address, request, status, size):
+        if self.accessLog is None: return
+
+        self.accessLog.log({
+            'time': time.time(),
+            'remote': client_address[0] if client_address else '-',
+            'method': request.method if request is not None and request.method else '-',
+            'path': request.path if request is not None and request.path else '-',
+            'version': request.version if request is not None and request.version else '-',
+            'status': status,
+            'bytes': size,
+            'request_bytes': request.bodyLength if request is not None else 0,
+            'parse_ms': 0.0,
+            'handler_ms': 0.0,
+            'send_ms': 0.0,
+            'referer': None,
+            'user_agent': None
+        })
+
+
+    '''
+        Removes the temporary files of uploads the connection ended in the middle of.
+    '''
+    def __abortUploads(self, parser, requests):
+        for request in [request for request, _ in requests] + [parser.message]:
+            if request.bodySink is not None:
+                request.bodySink.abort()
+
+
+    '''
+        After an error response, the client may still be sending the request body. Closing right
+        away would reset the connection and could destroy the response before the client reads
+        it, so the rest of the request is read (for a bounded time) and discarded first.
+    '''
+    def __lingeringClose(self, client_connection):
+        LINGER_SECONDS = 2
+        try:
+            client_connection.shutdown(socket.SHUT_WR)
+            deadline = time.monotonic() + LINGER_SECONDS
+            while time.monotonic() < deadline:
+                client_connection.settimeout(max(0.01, deadline - time.monotonic()))
+                if not client_connection.recv(65536): break
+        except OSError:
+            pass
+
+
+    '''
+        Sends a body the FileHandler did not materialise: an open file through sendfile, or a
+        stream of chunks as they are produced. A client reading slower than MIN_RATE raises RequestTimeout;
+        only the time spent in the sends counts, not the time the stream takes to produce its chunks.
+        Returns False if the body came out shorter than announced and the connection can't be reused.
+    '''
+    def __sendBody(self, client_connection, body, record = None):
+        rate = TransferRate(self.minRate, RATE_GRACE_SECONDS)
+
+        if 'file' in body:
+            offset = body.get('offset', 0)
+            sent = 0
+            while sent < body['size']:
+                sendStarted = time.monotonic()
+                count = client_connection.sendfile(body['file'], offset + sent, min(SENDFILE_SLICE, body['size'] - sent))
+                if not count: break
+
+                sent += count
+                self.metrics.sent(count)
+                if record is not None: record['bytes'] += count
+                rate.add(count, time.monotonic() - sendStarted)
+
+            return sent == body['size']
+
+        for buffers in encodeChunks(body['stream'], body['chunked']):
+            sendStarted = time.monotonic()
+            sent = send_buffers(client_connection, buffers)
+            self.metrics.sent(sent)
+            if record is not None: record['bytes'] += sent
+            rate.add(sent, time.monotonic() - sendStarted)
+
+        return True
+
+
+    def __closeBody(self, body):
+        if body is None: return
+
+        if 'file' in body:
+            body['file'].close()
+        elif hasattr(body['stream'], 'close'):
+            body['stream'].close()
 
 
+    '''
+        Event loop engine.
+        Every client socket is multiplexed on the loop thread; only the FileHandler work
+        (disk reads/writes, directory listing) is handed to a small thread pool executor,
+        so idle or slow connections cost a socket and a coroutine instead of a thread.
+    '''
+    async def __serveAsync(self, server_socket, VERBOSE, THREADS, BACKLOG):
+        executor = ThreadPoolExecutor(max_workers = THREADS, thread_name_prefix = 'httpfs-io')
+
+        async def handleClient(reader, writer):
+            address = writer.get_extra_info('peername')[0]
+            if not self.connectionLimiter.acquire(address):
+                self.metrics.count_request('-', 429)
+                self.__logRejection(writer.get_extra_info('peername'), None, 429, len(TOO_MANY_CONNECTIONS))
+                writer.write(TOO_MANY_CONNECTIONS)
+                writer.close()
+                return
+
+            try:
+                await self.__handleAsyncClient(reader, writer, executor, VERBOSE)
+            finally:
+                self.connectionLimiter.release(address)
+
+        server = await asyncio.start_server(handleClient, sock = server_socket, backlog = BACKLOG)
+        async with server:
+            await server.serve_forever()
+
+
+    async def __handleAsyncClient(self, reader, writer, executor, VERBOSE):
+        BUFFER_SIZE = 65536
+        client_address = writer.get_extra_info('peername')
+        loop = asyncio.get_running_loop()
+
+        parser = HTTPParser(onHeaders = self.__onHeaders)
+        requests = deque()
+        requestCount = 0
+        parseStarted = None
+        headerDeadline = self.__headerDeadline()
+        bodyRate = None
+        self.metrics.connection_opened()
+
+        # As in __handleClient. asyncio only sets it itself on sockets created with proto IPPROTO_TCP
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        try:
+            while True:
+                if not requests:
+                    timeout, idle = self.__readTimeout(parser, requestCount, headerDeadline)
+
+                    try:
+                        try:
+                            packet = await asyncio.wait_for(reader.read(BUFFER_SIZE), timeout)
+                        except asyncio.TimeoutError:
+                            if idle:
+                                if VERBOSE: print('Idle connection closed: ', client_address)
+                                return
+                            raise RequestTimeout('Request not received in time.')
+
+                        if not packet: return
+
+                        self.metrics.received(len(packet))
+                        if not parser.hasPartialMessage():
+                            parseStarted = time.perf_counter()
+                            if requestCount > 0: headerDeadline = self.__headerDeadline()
+                        if bodyRate is not None: bodyRate.add(len(packet))
+
+                        # Upload bodies are written to disk as they are parsed: keep that off the loop thread
+                        if parser.message.bodySink is not None and not isinstance(parser.message.bodySink, DiscardedBody):
+                            messages = await loop.run_in_executor(executor, parser.feed, packet)
+                        else:
+                            messages = parser.feed(packet)
+                    except (HTTPParseError, UploadError, RequestTimeout) as e:
+                        writer.writelines(self.__rejectRequest(e, parser.message, client_address))
+                        await self.__drain(writer)
+                        await self.__lingeringAsyncClose(reader, writer)
+                        return
+
+                    requests.extend(self.__timeParse(messages, parseStarted))
+                    if messages:
+                        parseStarted = time.perf_counter()
+                        headerDeadline = self.__headerDeadline()
+                    bodyRate = self.__bodyRate(parser, bodyRate)
+                    continue
+
+                batch = self.__nextBatch(requests, requestCount)
+                requestCount += len(batch)
 
-    def __handleClient(self, client_connection, client_address, VERBOSE):
+                records = [self.__newRecord(request, client_address, parseSeconds) for request, parseSeconds, _, _ in batch]
+                results = self.__gathered(await asyncio.gather(*[
+                    loop.run_in_executor(executor, self.__respond, request, record, keepAlive, remaining)
+                    for (request, _, keepAlive, remaining), record in zip(batch, records)
+                ], return_exceptions = True))
 
-        requestHeader, requestBody = self.__receiveResponse(client_connection)
+                try:
+                    keepAlive = await self.__sendAsyncResponses(writer, batch, records, results, executor)
+                finally:
+                    for _, body, _ in results:
+                        self.__closeBody(body)
 
-        if VERBOSE:
-            print('Request from: ', client_connection, client_address)
-            print('Request Data: ', requestHeader.strip(), requestBody.strip())
-            print('\n')
+                if not keepAlive: return
 
+        except (RequestTimeout, asyncio.TimeoutError) as e:
+            if VERBOSE: print('Slow client disconnected: ', client_address, e)
+
+        except ConnectionError as e:
+            if VERBOSE: print('Connection error: ', client_address, e)
+
+        finally:
+            self.__abortUploads(parser, requests)
+            writer.close()
+            self.metrics.connection_closed()
+
+
+    async def __lingeringAsyncClose(self, reader, writer):
+        LINGER_SECONDS = 2
+        try:
+            writer.write_eof()
+            async def drain():
+                while await reader.read(65536): pass
+            await asyncio.wait_for(drain(), LINGER_SECONDS)
+        except (asyncio.TimeoutError, OSError):
+            pass
+
+
+    '''
+        Event loop version of __sendResponses.
+    '''
+    async def __sendAsyncResponses(self, writer, batch, records, results, executor):
+        waiting = []
+        sendStarted = time.perf_counter()
+
+        for index, ((request, _, _, _), record, (response, body, keepAlive)) in enumerate(zip(batch, records, results)):
+            writer.writelines(response)
+            waiting.append((request, record, buffers_length(response)))
+            if body is None and keepAlive and index < len(batch) - 1: continue
+
+            try:
+                await self.__drain(writer)
+                self.metrics.sent(sum(size for _, _, size in waiting))
+                complete = body is None or await self.__sendAsyncBody(writer, body, executor, record)
+            finally:
+                for waitingRequest, waitingRecord, size in waiting:
+                    self.__finishRequest(waitingRequest, waitingRecord, size, sendStarted)
+
+            if not complete or not keepAlive: return False
+
+            waiting = []
+            sendStarted = time.perf_counter()
+
+        return True
+
+
+    '''
+        Event loop version of __sendBody. The loop can't tell when a write stops making progress,
+        so the write timeout bounds every drain and every sendfile slice instead.
+    '''
+    async def __sendAsyncBody(self, writer, body, executor, record = None):
+        loop = asyncio.get_running_loop()
+        rate = TransferRate(self.minRate, RATE_GRACE_SECONDS)
+
+        if 'file' in body:
+            offset = body.get('offset', 0)
+            sent = 0
+            while sent < body['size']:
+                sendStarted = time.monotonic()
+                count = await asyncio.wait_for(loop.sendfile(writer.transport, body['file'], offset + sent,
+                                                             min(SENDFILE_SLICE, body['size'] - sent)), self.writeTimeout or None)
+                if not count: break
+
+                sent += count
+                self.metrics.sent(count)
+                if record is not None: record['bytes'] += count
+                rate.add(count, time.monotonic() - sendStarted)
+
+            return sent == body['size']
+
+        # Producing a chunk may touch the disk, so the stream is advanced on the executor
+        chunks = encodeChunks(body['stream'], body['chunked'])
+        while True:
+            buffers = await loop.run_in_executor(executor, next, chunks, None)
+            if buffers is None: return True
+
+            sendStarted = time.monotonic()
+            writer.writelines(buffers)
+            await self.__drain(writer)
+            sent = buffers_length(buffers)
+            self.metrics.sent(sent)
+            if record is not None: record['bytes'] += sent
+            rate.add(sent, time.monotonic() - sendStarted)
+
+
+    async def __drain(self, writer):
+        await asyncio.wait_for(writer.drain(), self.writeTimeout or None)
+
+
+    '''
+        Turns one request into the encoded response. Shared by both engines.
+        Returns (response, body, keepAlive), and fills in the status and handler time of the
+        access log record when there is one.
+        When the FileHandler answered with an open file or a stream of chunks, the response holds
+        only the headers and the caller sends body (see __sendBody), so the content is never fully
+        materialised in memory. The caller must close the body with __closeBody.
+    '''
+    def __respond(self, request, RECORD = None, KEEP_ALIVE = False, REMAINING_REQUESTS = 0):
 
         # Mimicking slow response
         # time.sleep(10)
 
-        filehandlerResponse = self.__processRequest(requestHeader, requestBody)
-        response = self.__prepareResponse(filehandlerResponse)
+        handlerStarted = time.perf_counter()
+        filehandlerResponse = self.__processRequest(request)
+        handlerSeconds = time.perf_counter() - handlerStarted
 
-        if VERBOSE:
-            print('Response Data: ', response)
-            print('\n')
-        
-        client_connection.sendall(response)
-        client_connection.close()
+        self.metrics.observe('handler', self.__route(request), handlerSeconds)
+        self.metrics.count_request(request.method, filehandlerResponse['statusCode'])
+        if RECORD is not None:
+            RECORD['status'] = filehandlerResponse['statusCode']
+            RECORD['handler_ms'] = handlerSeconds * 1000
 
+        body = None
 
+        if 'file' in filehandlerResponse:
+            body = filehandlerResponse
 
-    def __receiveResponse(self, socket):
-        BUFFER_SIZE = 1024
-        response = b''
+        elif 'stream' in filehandlerResponse:
+            body = filehandlerResponse
+            # A stream of known size is sent with a Content-Length. Otherwise it is chunked, except for
+            # HTTP/1.0 clients that don't understand chunked encoding: the connection close ends the body
+            body['chunked'] = 'size' not in body and request.version.upper() != 'HTTP/1.0'
+            KEEP_ALIVE = KEEP_ALIVE and ('size' in body or body['chunked'])
 
-        '''Reads data in packets of length BUFFER_SIZE from the kernel buffer'''
-        while True:
-            packet = socket.recv(BUFFER_SIZE)
-            response += packet
-            if len(packet) < BUFFER_SIZE: break   # Last packet
-        
-        response = response.decode('utf-8')
+        # HEAD gets the headers a GET would get, without the body
+        INCLUDE_BODY = request.method != 'HEAD'
+        response = self.__prepareResponse(filehandlerResponse, KEEP_ALIVE, REMAINING_REQUESTS, INCLUDE_BODY)
 
-        '''If responseBody does not exists'''
-        if response.count('\r\n\r\n') < 1:
-            return response, ""
-        
+        if not INCLUDE_BODY:
+            self.__closeBody(body)
+            body = None
+
+        return response, body, KEEP_ALIVE
+
+
+    '''
+        Response for a request that is refused before it is complete: 400 when it can't be parsed,
+        or the status of the UploadError or RequestTimeout raised while it was being received.
+    '''
+    def __rejectRequest(self, error, request, client_address):
+        if isinstance(error, (UploadError, RequestTimeout)):
+            RESPONSEDATA = {
+                'statusCode': error.status_code,
+                'data': str(error)
+            }
         else:
-            responseHeader, responseBody = response.split('\r\n\r\n', 1)
-            return responseHeader, responseBody
+            RESPONSEDATA = {
+                'statusCode': 400,
+                'data': 'Bad request: ' + str(error)
+            }
+
+        self.metrics.count_request(request.method or '-', RESPONSEDATA['statusCode'])
+        response = self.__prepareResponse(RESPONSEDATA)
+        self.__logRejection(client_address, request, RESPONSEDATA['statusCode'], buffers_length(response))
+        return response
+
+
+    '''
+        HTTP/1.1 connections are persistent unless the client sends "Connection: close";
+        HTTP/1.0 connections are persistent only with "Connection: keep-alive".
+    '''
+    def __wantsKeepAlive(self, request):
+        if self.keepAliveTimeout <= 0: return False
+
+        connection = [token.strip() for token in request.header('connection', '').lower().split(',')]
+
+        if request.version.upper() == 'HTTP/1.1':
+            return 'close' not in connection
+
+        return 'keep-alive' in connection
 
 
     '''
         Processes a incoming request.
-        1) Parses the HTTPHeader and extracts the METHOD and PATH
+        1) Reads the METHOD and PATH from the parsed request
         2) Call the respective fileHandler method depending on the METHOD and PATH
     '''
-    def __processRequest(self, requestHeader, requestBody):
+    def __processRequest(self, request):
 
-        HEADERS = requestHeader.split('\r\n')
-        HTTP_META_INFORMATION = HEADERS[0].split(' ')
+        METHOD = request.method
+        PATH = request.path
 
-        METHOD = HTTP_META_INFORMATION[0].strip()
-        PATH = HTTP_META_INFORMATION[1].strip()
+        if METHOD in ('GET', 'HEAD') and urlsplit(PATH).path == STATS_PATH:
+            return self.__stats(request)
 
-        if METHOD != 'GET' and METHOD != 'POST':
+        if METHOD in ('GET', 'HEAD') and urlsplit(PATH).path == BATCH_PATH:
+            return self.fileHandler.getFiles(parse_qs(urlsplit(PATH).query).get('path', []))
+
+        if METHOD == 'POST' and urlsplit(PATH).path == BATCH_PATH:
+            return self.fileHandler.finishBatchUpload(request.bodySink)
+
+        if METHOD not in ('GET', 'HEAD', 'POST', 'PATCH'):
             return {
                 'statusCode': 405,
+                'headers': ['Allow: GET, HEAD, POST, PATCH'],
                 'data': 'HTTP Method not supported: ' + METHOD
             }
         
-        if METHOD == 'GET':
-            if PATH == '/':
-                return self.fileHandler.getNamesOfAllFiles()
+        if METHOD == 'GET' or METHOD == 'HEAD':
+            # A path ending with '/' lists a directory, narrowed down by the query (see FileHandler.getNamesOfAllFiles)
+            URL = urlsplit(PATH)
+            if URL.path.endswith('/'):
+                return self.fileHandler.getNamesOfAllFiles(URL.path[1:], dict(parse_qsl(URL.query)))
             
             else:
-                return self.fileHandler.getFileContent(PATH[1:])
+                return self.fileHandler.getFileContent(PATH[1:], request.headers)
         
         else:
             if PATH == '/':
@@ -113,27 +1013,115 @@ class HTTPServerLibrary:
                     'data': 'FileName is null'
                 }
             
+            # The body was streamed to disk while it was received (see __onHeaders)
+            elif request.bodySink is not None:
+                return self.fileHandler.finishUpload(self.__uploadTarget(request)[0], request.bodySink)
+
             else:
-                return self.fileHandler.writeToFile(PATH[1:], requestBody)
+                return self.fileHandler.writeToFile(PATH[1:], bytes(request.body))
+
+
+    '''
+        Metrics of this process in the Prometheus text format, or as JSON with ?format=json or
+        "Accept: application/json". Includes the file locks' wait times, the cache's hit ratio, the
+        connections refused for their client address, the memory-mapped files and the content-addressed
+        store's names, blobs and deduplicated uploads.
+    '''
+    def __stats(self, request):
+        sections = {'locks': LOCKS.stats(), 'cache': self.fileHandler.cache.stats(), 'clients': self.connectionLimiter.stats(),
+                    'mapped': MAPPED_FILES.stats()}
+        if self.accessLog is not None: sections['access_log'] = self.accessLog.stats()
+        if self.fileHandler.store is not None: sections['store'] = self.fileHandler.store.stats()
 
+        snapshot = self.metrics.snapshot(**sections)
+
+        FORMAT = parse_qs(urlsplit(request.path).query).get('format', [''])[0]
+        if FORMAT == 'json' or (not FORMAT and 'application/json' in request.header('accept', '')):
+            return {
+                'statusCode': 200,
+                'headers': ['Content-Type: application/json', 'Cache-Control: no-store'],
+                'data': self.metrics.to_json(snapshot)
+            }
+
+        return {
+            'statusCode': 200,
+            'headers': ['Content-Type: text/plain; version=0.0.4; charset=utf-8', 'Cache-Control: no-store'],
+            'data': self.metrics.to_prometheus(snapshot)
+        }
+
+
+    '''
+        Route label of a request in the latency metrics.
+    '''
+    def __route(self, request):
+        if request.method in ('GET', 'HEAD'):
+            if urlsplit(request.path).path.endswith('/'): return 'list'
+            if urlsplit(request.path).path == STATS_PATH: return 'stats'
+            if urlsplit(request.path).path == BATCH_PATH: return 'batch'
+            return 'file'
 
-    def __prepareResponse(self, RESPONSEDATA):
+        if request.method == 'POST':
+            if urlsplit(request.path).path == BATCH_PATH: return 'batch_upload'
+            return 'append' if self.__uploadTarget(request)[1] else 'upload'
+
+        if request.method == 'PATCH':
+            return 'patch'
+
+        return 'other'
+
+
+    '''
+        Encodes the head of the response, and the body when the FileHandler returned it in memory,
+        as a list of buffers to send with send_buffers (see Modules/ResponseBuilder.py).
+    '''
+    def __prepareResponse(self, RESPONSEDATA, KEEP_ALIVE = False, REMAINING_REQUESTS = 0, INCLUDE_BODY = True):
 
         STATUS_CODE = RESPONSEDATA.get('statusCode')
         HEADERS = RESPONSEDATA.get('headers', [])
-        BODY = RESPONSEDATA.get('data', "")
 
-        request = ''
+        # Content-Length (or chunked encoding) delimits the body so the connection can carry the next response
+        # (a 304 has no body and describes the representation through its validators instead)
+        if STATUS_CODE == 304:
+            return [self.responseBuilder.head(STATUS_CODE, HEADERS, None, False, KEEP_ALIVE, REMAINING_REQUESTS)]
 
-        request += 'HTTP/1.0 '
-        request += str(STATUS_CODE) + ' ' + responses[STATUS_CODE]
-        
-        for HEADER in HEADERS:
-            request += '\r\n' + HEADER
+        # File and stream bodies are sent separately by the caller
+        if 'file' in RESPONSEDATA or 'stream' in RESPONSEDATA:
+            return [self.responseBuilder.head(STATUS_CODE, HEADERS, RESPONSEDATA.get('size'), RESPONSEDATA.get('chunked', False),
+                                              KEEP_ALIVE, REMAINING_REQUESTS)]
+
+        return self.responseBuilder.response(STATUS_CODE, HEADERS, RESPONSEDATA.get('data', b''), KEEP_ALIVE,
+                                             REMAINING_REQUESTS, INCLUDE_BODY)
+
+
+'''
+    Frames a stream of str/bytes pieces for the wire, as lists of buffers to write with one send_buffers call.
+    Small pieces (e.g. one file name each) are batched up to BATCH_SIZE so every chunk is worth a send call;
+    larger ones (e.g. slices of a mapped file) are passed on as they are, without being copied.
+    With CHUNKED each batch becomes one chunk of the chunked transfer-encoding and the stream ends with the
+    zero-length chunk; otherwise the batches are sent raw and the connection close ends the body.
+'''
+def encodeChunks(STREAM, CHUNKED, BATCH_SIZE = 16384):
+    def frame(buffer):
+        return [b'%x\r\n' % len(buffer), buffer, b'\r\n'] if CHUNKED else [buffer]
+
+    batch = bytearray()
+
+    for piece in STREAM:
+        if isinstance(piece, str): piece = piece.encode()
+        if not len(piece): continue
+
+        if len(piece) >= BATCH_SIZE:
+            yield (frame(batch) if batch else []) + frame(piece)
+            batch = bytearray()
+            continue
 
-        request += '\r\n\r\n'
-        request += BODY
+        batch += piece
+        if len(batch) >= BATCH_SIZE:
+            yield frame(batch)
+            batch = bytearray()
 
-        request += '\r\n'
+    if batch:
+        yield frame(batch)
 
-        return request.encode()
+    if CHUNKED:
+        yield [b'0\r\n\r\n']
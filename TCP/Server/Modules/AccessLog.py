@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import threading
+
+FORMATS = ['json', 'clf']
+
+class AccessLog(object):
+    """ One line per request, written by a background thread.
+
+        log() only puts the record on a bounded queue, so a request never
+        waits for the terminal or the disk. The writer thread wakes up every
+        `flush_interval` seconds (rather than once per request, which would
+        compete with the request threads for the GIL), formats what queued
+        up and writes each batch with a single os.write on an O_APPEND
+        descriptor: lines from several worker processes sharing the file do
+        not tear. When the queue is full the record is dropped and counted
+        instead of slowing the server down.
+
+        Records are dicts with: time (epoch seconds), remote, method, path,
+        version, status, bytes (sent), request_bytes, parse_ms, handler_ms,
+        send_ms, referer, user_agent.
+    """
+
+    def __init__(self, path='-', log_format='json', sample_rate=1.0, queue_size=65536, batch_size=1024, flush_interval=0.2):
+        """ `path` '-' writes to stdout. With `sample_rate` below 1 only that
+            fraction of requests is logged, except server errors (5xx) which
+            are always kept.
+        """
+        if log_format not in FORMATS:
+            raise ValueError('Unknown access log format: ' + str(log_format))
+
+        self.log_format = log_format
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        if path == '-':
+            sys.stdout.flush()
+            self.fd = sys.stdout.fileno()
+            self.owns_fd = False
+        else:
+            self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self.owns_fd = True
+
+        self.queue = queue.Queue(queue_size)
+        self.closing = threading.Event()
+        self.written = 0
+        self.dropped = 0
+
+        self.thread = threading.Thread(target=self.__run, name='httpfs-access-log', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+
+    def log(self, record):
+        if self.sample_rate < 1 and record['status'] < 500 and random.random() >= self.sample_rate:
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+    def close(self):
+        """ Write what is queued and stop the writer thread. """
+        if not self.thread.is_alive(): return
+
+        self.closing.set()
+        self.thread.join()
+        if self.owns_fd: os.close(self.fd)
+
+
+    def stats(self):
+        return {
+            'written': self.written,
+            'dropped': self.dropped,
+            'queued': self.queue.qsize()
+        }
+
+
+    def __run(self):
+        while True:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            if batch: self.__write(batch)
+
+            # A partial batch means the queue is empty: let the next one build up
+            if len(batch) < self.batch_size:
+                if self.closing.is_set(): return
+                self.closing.wait(self.flush_interval)
+
+
+    def __write(self, batch):
+        format = self.__json if self.log_format == 'json' else self.__clf
+        data = ''.join(format(record) for record in batch).encode('utf-8', errors='replace')
+
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self.fd, view):]
+            self.written += len(batch)
+        except OSError:
+            self.dropped += len(batch)
+
+
+    def __json(self, record):
+        record = dict(record)
+        seconds = record['time']
+        record['time'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)) + '.%03dZ' % (seconds % 1 * 1000)
+        for key in ('parse_ms', 'handler_ms', 'send_ms'):
+            record[key] = round(record[key], 3)
+        return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+    def __clf(self, record):
+        """ Combined Log Format, followed by the total time in milliseconds. """
+        total_ms = record['parse_ms'] + record['handler_ms'] + record['send_ms']
+        return '%s - - [%s] "%s %s %s" %d %d "%s" "%s" %.3f\n' % (
+            record['remote'], time.strftime('%d/%b/%Y:%H:%M:%S +0000', time.gmtime(record['time'])),
+            record['method'], record['path'], record['version'], record['status'], record['bytes'],
+            record['referer'] or '-', record['user_agent'] or '-', total_ms)
@@ -0,0 +1,92 @@
+import time
+import threading
+
+class RequestTimeout(Exception):
+    """ A client too slow to send its request or to read the response.
+        `status_code` is the HTTP status it gets if it is still listening.
+    """
+
+    status_code = 408
+
+
+class TransferRate(object):
+    """ Average rate of one transfer (a request body or a response body),
+        for turning away clients that trickle data just fast enough to
+        never hit a timeout.
+
+        A request body is timed from its start. A response body is timed
+        only while sending it waits on the client (the caller passes that
+        time to add), so a server slow to produce it (a long listing, a
+        batch read) is not blamed on the client.
+    """
+
+    def __init__(self, min_rate, grace=5):
+        """ Once `grace` seconds have passed, falling below `min_rate` bytes
+            per second on average raises RequestTimeout. A `min_rate` of 0
+            disables the check.
+        """
+        self.min_rate = min_rate
+        self.grace = grace
+        self.started = time.monotonic()
+        self.waited = 0.0
+        self.bytes = 0
+
+
+    def add(self, count, seconds=None):
+        """ Count `count` more bytes. `seconds` is how long moving them
+            took; without it, the whole time since the start counts.
+        """
+        self.bytes += count
+        if seconds is None:
+            elapsed = time.monotonic() - self.started
+        else:
+            self.waited += seconds
+            elapsed = self.waited
+        if not self.min_rate: return
+
+        if elapsed > self.grace and self.bytes < self.min_rate * elapsed:
+            raise RequestTimeout('Transfer slower than %d bytes per second.' % self.min_rate)
+
+
+class ConnectionLimiter(object):
+    """ Counts the open connections of every client address, so a single
+        client can't take all the workers. Thread safe.
+    """
+
+    def __init__(self, max_per_address=0):
+        """ `max_per_address` of 0 means no limit. """
+        self.max_per_address = max_per_address
+        self.counts = {}
+        self.refused = 0
+        self.lock = threading.Lock()
+
+
+    def acquire(self, address):
+        """ Count a new connection from `address`. Returns False, without
+            counting it, when that address already has as many as allowed.
+        """
+        with self.lock:
+            count = self.counts.get(address, 0)
+            if self.max_per_address and count >= self.max_per_address:
+                self.refused += 1
+                return False
+
+            self.counts[address] = count + 1
+            return True
+
+
+    def release(self, address):
+        with self.lock:
+            count = self.counts.get(address, 0) - 1
+            if count > 0:
+                self.counts[address] = count
+            else:
+                self.counts.pop(address, None)
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'addresses': len(self.counts),
+                'refused': self.refused
+            }
@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from Modules.Upload import Upload
+
+class ContentStore(object):
+    """ Files stored by content. Every distinct content is kept once, as a
+        blob named by its SHA-256 under `root`/objects, and a file name is an
+        entry of an index pointing at a blob, with the time the name was last
+        written (a blob may be much older than a name pointing at it, so its
+        own modification time says nothing about the name). Storing content
+        the store already has costs its hash and an index update; a blob is
+        deleted once no name points at it any more.
+
+        The index lives in memory and is persisted to an append-only journal
+        (one JSON line per change), rewritten from the index on start and
+        whenever it grows well past it. Blobs never change once stored, so
+        names sharing one also share its cache entry and memory map.
+
+        Thread safe, but a store must not be used by several processes.
+    """
+
+    JOURNAL = 'index.journal'
+
+    def __init__(self, root, fsync='never'):
+        """ Open (or create) the store in directory `root`. With the 'always'
+            fsync policy every index change is synced before it is answered.
+        """
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        self.journal_path = os.path.join(root, self.JOURNAL)
+        self.fsync = fsync
+        self.lock = threading.Lock()
+
+        self.names = {}
+        # Modification time of every name, in nanoseconds
+        self.modified = {}
+        # References and size of every blob
+        self.refs = {}
+        self.sizes = {}
+        # Names in listing order, rebuilt after a name is added
+        self.sorted = None
+
+        self.stored = 0
+        self.deduplicated = 0
+
+        os.makedirs(self.objects, exist_ok=True)
+        self.__load()
+
+
+    def blob_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+
+    def lookup(self, name):
+        """ (path of the blob holding the content of `name`, time `name` was
+            last written in nanoseconds), or None if the store has no such
+            name.
+        """
+        with self.lock:
+            digest = self.names.get(name)
+            if digest is None: return None
+            return self.blob_path(digest), self.modified[name]
+
+
+    def list(self):
+        """ Every name, ordered by path components (like a depth first walk
+            of directories sorted by name). The list is never modified, so
+            it can be read while names are added.
+        """
+        with self.lock:
+            if self.sorted is None:
+                self.sorted = sorted(self.names, key=lambda name: name.split('/'))
+            return self.sorted
+
+
+    def put(self, name, temporary_path, digest):
+        """ Point `name` at the content of the file `temporary_path`, whose
+            SHA-256 is `digest`. The file becomes the blob, or is removed if
+            the store has that content already. The blob `name` pointed at
+            before is deleted if no other name points at it.
+        """
+        path = self.blob_path(digest)
+
+        with self.lock:
+            if digest in self.refs:
+                os.unlink(temporary_path)
+                self.deduplicated += 1
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temporary_path, path)
+                if self.fsync == 'always': self.__syncDirectory(os.path.dirname(path))
+                self.sizes[digest] = os.stat(path).st_size
+                self.refs[digest] = 0
+                self.stored += 1
+
+            previous = self.names.get(name)
+            if previous == digest: return
+
+            # Never before the previous version, even if the clock went back
+            modified = max(time.time_ns(), self.modified.get(name, 0) + 1)
+
+            # Journaled before the index changes: a crash in between only leaves a blob to clean up
+            self.__append({'name': name, 'hash': digest, 'mtime': modified})
+
+            if previous is None: self.sorted = None
+            self.names[name] = digest
+            self.modified[name] = modified
+            self.refs[digest] += 1
+            if previous is not None: self.__release(previous)
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'names': len(self.names),
+                'blobs': len(self.refs),
+                'bytes': sum(self.sizes.values()),
+                'stored': self.stored,
+                'deduplicated': self.deduplicated
+            }
+
+
+    def __release(self, digest):
+        self.refs[digest] -= 1
+        if self.refs[digest] > 0: return
+
+        del self.refs[digest]
+        del self.sizes[digest]
+        try:
+            # Readers that have it open keep reading it
+            os.unlink(self.blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+
+    def __append(self, entry):
+        self.journal.write(json.dumps(entry) + '\n')
+        self.journal.flush()
+        if self.fsync == 'always':
+            os.fsync(self.journal.fileno())
+
+        self.journal_lines += 1
+        if self.journal_lines > 2 * len(self.names) + 1024:
+            self.__compact()
+
+
+    def __syncDirectory(self, directory):
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+    def __load(self):
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line of a journal cut short by a crash
+                        continue
+                    self.names[entry['name']] = entry['hash']
+                    self.modified[entry['name']] = entry['mtime']
+        except FileNotFoundError:
+            pass
+
+        for digest in self.names.values():
+            self.refs[digest] = self.refs.get(digest, 0) + 1
+
+        # Blobs no name points at (stored just before a crash) and uploads that never finished
+        for entry in os.scandir(self.objects):
+            if entry.is_dir(follow_symlinks=False):
+                for blob in os.scandir(entry.path):
+                    if blob.name in self.refs:
+                        self.sizes[blob.name] = blob.stat().st_size
+                    else:
+                        os.unlink(blob.path)
+            elif Upload.is_temporary(entry.name):
+                os.unlink(entry.path)
+
+        # Names whose blob is gone can't be read
+        for name, digest in list(self.names.items()):
+            if digest not in self.sizes:
+                del self.names[name]
+                del self.modified[name]
+                self.refs.pop(digest, None)
+
+        self.journal = None
+        self.__compact()
+
+
+    def __compact(self):
+        """ Rewrite the journal with one line per name. """
+        temporary_path = self.journal_path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as journal:
+            for name, digest in self.names.items():
+                journal.write(json.dumps({'name': name, 'hash': digest, 'mtime': self.modified[name]}) + '\n')
+            journal.flush()
+            if self.fsync != 'never':
+                os.fsync(journal.fileno())
+
+        if self.journal is not None: self.journal.close()
+        os.replace(temporary_path, self.journal_path)
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        self.journal_lines = len(self.names)
+
+
+class BlobUpload(Upload):
+    """ An Upload into a ContentStore: the body is hashed while it is
+        spooled, and on commit the temporary file becomes the blob of that
+        hash (or is dropped if the store has it) and `name` points at it.
+    """
+
+    def __init__(self, store, name, max_bytes=None, fsync='never'):
+        super().__init__(os.path.join(store.objects, 'blob'), max_bytes, fsync)
+        self.store = store
+        self.name = name
+        self.digest = hashlib.sha256()
+
+
+    def write(self, data):
+        super().write(data)
+        self.digest.update(data)
+
+
+    def commit(self):
+        try:
+            self.file.flush()
+            if self.fsync != 'never':
+                os.fsync(self.file.fileno())
+            self.file.close()
+
+            self.store.put(self.name, self.temporary_path, self.digest.hexdigest())
+        except BaseException:
+            self.abort()
+            raise
+
+        self.temporary_path = None
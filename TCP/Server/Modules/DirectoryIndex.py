@@ -0,0 +1,150 @@
+import os
+import json
+import atexit
+import bisect
+import threading
+
+class DirectoryIndex(object):
+    """ Sorted list of the regular files directly inside a directory, so
+        listing it does not cost a syscall per entry.
+
+        The index is built once with os.scandir (or loaded from a snapshot
+        file when the directory has not changed since it was written), kept
+        up to date by the server's own writes through add()/remove(), and
+        rebuilt when the directory's mtime shows someone else changed it.
+    """
+
+    def __init__(self, directory, snapshot_path=None, hidden_filter=None):
+        """ `hidden_filter(name)` returning True keeps a file out of the
+            index (e.g. uploads still being written).
+        """
+        self.directory = directory
+        self.hidden_filter = hidden_filter
+        self.snapshot_path = snapshot_path
+        self.lock = threading.Lock()
+        # Replaced, never mutated in place, so a listing being streamed keeps a consistent view
+        self.names = []
+        self.mtime = None
+        self.dirty = False
+
+        # A snapshot kept inside the indexed directory is not one of its files
+        self.hidden = set()
+        self.snapshot_inside = snapshot_path is not None and \
+            os.path.dirname(os.path.abspath(snapshot_path)) == os.path.abspath(directory)
+        if self.snapshot_inside:
+            name = os.path.basename(snapshot_path)
+            self.hidden = {name, name + '.tmp'}
+
+        if not self.__loadSnapshot():
+            self.rebuild()
+
+        if snapshot_path is not None:
+            atexit.register(self.save)
+
+
+    def list(self):
+        """ Current file names, sorted. Rebuilds first if the directory
+            changed since the index was last brought up to date.
+        """
+        self.refresh()
+        return self.names
+
+
+    def refresh(self):
+        if os.stat(self.directory).st_mtime_ns != self.mtime:
+            self.rebuild()
+
+
+    def rebuild(self):
+        with self.lock:
+            # The mtime is read before scanning: a change made during the scan triggers another rebuild
+            mtime = os.stat(self.directory).st_mtime_ns
+            with os.scandir(self.directory) as entries:
+                names = sorted(entry.name for entry in entries if self.__visible(entry.name) and entry.is_file())
+
+            self.names = names
+            self.mtime = mtime
+            self.dirty = True
+
+        self.save()
+
+
+    def add(self, name):
+        """ Record a file the server just created. The directory mtime is
+            re-read so the server's own change does not force a rebuild.
+        """
+        if not self.__visible(name): return
+
+        with self.lock:
+            index = bisect.bisect_left(self.names, name)
+            if index == len(self.names) or self.names[index] != name:
+                self.names = self.names[:index] + [name] + self.names[index:]
+
+            self.mtime = os.stat(self.directory).st_mtime_ns
+            self.dirty = True
+
+
+    def remove(self, name):
+        with self.lock:
+            index = bisect.bisect_left(self.names, name)
+            if index < len(self.names) and self.names[index] == name:
+                self.names = self.names[:index] + self.names[index + 1:]
+
+            self.mtime = os.stat(self.directory).st_mtime_ns
+            self.dirty = True
+
+
+    def save(self):
+        """ Write the snapshot (if one is configured) so a restart on a huge
+            directory can skip the scan. Written to a temporary file and
+            renamed so a crash never leaves a truncated snapshot.
+            Best kept outside the indexed directory: writing it inside changes
+            the directory mtime, so such a snapshot is only reused if nothing
+            else is written before the restart.
+        """
+        if self.snapshot_path is None or not self.dirty: return
+
+        with self.lock:
+            snapshot = {
+                'directory': os.path.abspath(self.directory),
+                'mtime': self.mtime,
+                'names': self.names
+            }
+            self.dirty = False
+
+        temporary_path = self.snapshot_path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(temporary_path, self.snapshot_path)
+
+        # Writing the snapshot must not look like an outside change
+        if self.snapshot_inside:
+            with self.lock:
+                self.mtime = os.stat(self.directory).st_mtime_ns
+
+
+    def __loadSnapshot(self):
+        if self.snapshot_path is None: return False
+
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if snapshot.get('directory') != os.path.abspath(self.directory):
+            return False
+
+        # Only trusted if nothing was added, removed or renamed since it was written
+        if snapshot.get('mtime') != os.stat(self.directory).st_mtime_ns:
+            return False
+
+        self.names = snapshot['names']
+        self.mtime = snapshot['mtime']
+        return True
+
+
+    def __visible(self, name):
+        if self.hidden_filter is not None and self.hidden_filter(name):
+            return False
+        return name not in self.hidden
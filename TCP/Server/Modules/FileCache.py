@@ -0,0 +1,113 @@
+import threading
+from collections import OrderedDict
+
+class CacheEntry(object):
+    """ Cached body and response headers of one file, valid while the file's
+        (mtime, size) still matches `validator`. `data` is None for files too
+        large to keep in memory: only their headers are cached.
+    """
+    __slots__ = ('validator', 'data', 'headers', 'cost')
+
+    # Rough memory cost of an entry besides its body
+    OVERHEAD = 256
+
+    def __init__(self, validator, data, headers):
+        self.validator = validator
+        self.data = data
+        self.headers = headers
+        self.cost = self.OVERHEAD + (len(data) if data is not None else 0)
+
+
+class FileCache(object):
+    """ A byte-budgeted LRU cache of file contents keyed by path.
+        Entries are validated against the caller's os.stat result, so a file
+        changed behind the server's back is never served stale; the server's
+        own writes invalidate their entry directly.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entry_bytes=None):
+        """ Keep at most `max_bytes` of bodies. Files larger than
+            `max_entry_bytes` (default: an eighth of the budget) are not
+            cached so one big file can't flush every hot one.
+        """
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 8 if max_entry_bytes is None else max_entry_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, key, validator):
+        """ Return the entry for `key` if it is still valid for `validator`,
+            else None. A stale entry is dropped.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and entry.validator == validator:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+            if entry is not None:
+                self.__remove(key)
+
+            self.misses += 1
+            return None
+
+
+    def put(self, key, validator, data, headers):
+        """ Cache `data` (or only `headers` if data is None or too large). """
+        if self.max_bytes <= 0: return None
+
+        if data is not None and len(data) > self.max_entry_bytes:
+            data = None
+
+        entry = CacheEntry(validator, data, headers)
+
+        with self.lock:
+            if key in self.entries:
+                self.__remove(key)
+
+            self.entries[key] = entry
+            self.size += entry.cost
+
+            while self.size > self.max_bytes and self.entries:
+                oldest = next(iter(self.entries))
+                self.__remove(oldest)
+                self.evictions += 1
+
+        return entry
+
+
+    def cacheable(self, size):
+        return self.max_bytes > 0 and size <= self.max_entry_bytes
+
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.__remove(key)
+
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+
+    def __remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry.cost
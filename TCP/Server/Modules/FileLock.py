@@ -1,84 +1,182 @@
-# Package retrieved from: https://github.com/dmfrey/FileLock
-
-import os
 import time
-import errno
+import threading
+
+# Advisory locks between processes are used where the platform has them
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 class FileLockException(Exception):
     pass
- 
+
+
+class ReadWriteLock(object):
+    """ Any number of readers or a single writer. Waiting writers are served
+        before new readers so a steady stream of reads can't starve a write.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+        # Threads holding or waiting for this lock, so the table can drop it when unused
+        self.users = 0
+
+
+    def acquire(self, shared, timeout=None):
+        """ Block until the lock is held (shared for readers, exclusive for
+            writers). Returns False if `timeout` seconds passed first.
+        """
+        with self.condition:
+            if shared:
+                if not self.condition.wait_for(lambda: not self.writer and not self.waiting_writers, timeout):
+                    return False
+                self.readers += 1
+                return True
+
+            self.waiting_writers += 1
+            try:
+                if not self.condition.wait_for(lambda: not self.writer and not self.readers, timeout):
+                    return False
+                self.writer = True
+                return True
+            finally:
+                self.waiting_writers -= 1
+                # Readers held back by this writer may go if it gave up
+                if not self.writer: self.condition.notify_all()
+
+
+    def release(self, shared):
+        with self.condition:
+            if shared:
+                self.readers -= 1
+            else:
+                self.writer = False
+            self.condition.notify_all()
+
+
+class LockTable(object):
+    """ One ReadWriteLock per path, created on first use and dropped once no
+        thread holds or waits for it. Also counts how often and how long
+        threads waited, for the server's metrics.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+
+
+    def acquire(self, path, shared, timeout=None):
+        with self.lock:
+            entry = self.locks.get(path)
+            if entry is None:
+                entry = self.locks[path] = ReadWriteLock()
+            entry.users += 1
+
+        start_time = time.perf_counter()
+        acquired = entry.acquire(shared, timeout)
+        waited = time.perf_counter() - start_time
+
+        with self.lock:
+            self.acquisitions += acquired
+            self.timeouts += not acquired
+            # Anything over a millisecond had to wait for another thread
+            if waited > 0.001:
+                self.contended += 1
+                self.wait_seconds += waited
+
+            if not acquired: self.__drop(path, entry)
+
+        return acquired
+
+
+    def release(self, path, shared):
+        with self.lock:
+            entry = self.locks[path]
+            entry.release(shared)
+            self.__drop(path, entry)
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'paths': len(self.locks),
+                'acquisitions': self.acquisitions,
+                'contended': self.contended,
+                'wait_seconds': self.wait_seconds,
+                'timeouts': self.timeouts
+            }
+
+
+    def __drop(self, path, entry):
+        entry.users -= 1
+        if entry.users == 0:
+            del self.locks[path]
+
+
+# Shared by every FileLock in the process
+LOCKS = LockTable()
+
+
 class FileLock(object):
-    """ A file locking mechanism that has context-manager support so 
-        you can use it in a with statement. This should be relatively cross
-        compatible as it doesn't rely on msvcrt or fcntl for the locking.
+    """ A reader/writer lock on a path with context-manager support:
+
+            with FileLock(path):               # exclusive, for writers
+            with FileLock(path, shared=True):  # shared, for readers
+
+        Threads wait on a condition and wake as soon as the lock is released;
+        nothing is written to disk, so a crashed holder can't leave a stale
+        lock behind. If `fd` (an open descriptor of the file) is given and
+        fcntl is available, an advisory flock is also taken on it to keep
+        other processes serving the same directory out. It is released when
+        the lock is, or by the kernel if the process dies.
     """
- 
-    def __init__(self, file_name, timeout=10, delay=.05):
-        """ Prepare the file locker. Specify the file to lock and optionally
-            the maximum timeout and the delay between each attempt to lock.
+
+    def __init__(self, file_name, timeout=10, shared=False, fd=None):
+        """ Prepare the lock. Acquiring raises FileLockException after
+            `timeout` seconds (None waits forever).
         """
-        if timeout is not None and delay is None:
-            raise ValueError("If timeout is not None, then delay must not be None.")
         self.is_locked = False
-        self.lockfile = os.path.join(os.getcwd(), "%s.lock" % file_name)
         self.file_name = file_name
         self.timeout = timeout
-        self.delay = delay
- 
- 
+        self.shared = shared
+        self.fd = fd
+
+
     def acquire(self):
-        """ Acquire the lock, if possible. If the lock is in use, it check again
-            every `wait` seconds. It does this until it either gets the lock or
-            exceeds `timeout` number of seconds, in which case it throws 
-            an exception.
-        """
-        start_time = time.time()
-        while True:
+        if not LOCKS.acquire(self.file_name, self.shared, self.timeout):
+            raise FileLockException("Timeout occured.")
+
+        if self.fd is not None and fcntl is not None:
             try:
-                self.fd = os.open(self.lockfile, os.O_CREAT|os.O_EXCL|os.O_RDWR)
-                self.is_locked = True #moved to ensure tag only when locked
-                break;
-            except OSError as e:
-                if e.errno != errno.EEXIST:
-                    raise
-                if self.timeout is None:
-                    raise FileLockException("Could not acquire lock on {}".format(self.file_name))
-                if (time.time() - start_time) >= self.timeout:
-                    raise FileLockException("Timeout occured.")
-                time.sleep(self.delay)
-#        self.is_locked = True
- 
- 
+                fcntl.flock(self.fd, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+            except BaseException:
+                LOCKS.release(self.file_name, self.shared)
+                raise
+
+        self.is_locked = True
+
+
     def release(self):
-        """ Get rid of the lock by deleting the lockfile. 
-            When working in a `with` statement, this gets automatically 
-            called at the end.
-        """
         if self.is_locked:
-            os.close(self.fd)
-            os.unlink(self.lockfile)
+            if self.fd is not None and fcntl is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            LOCKS.release(self.file_name, self.shared)
             self.is_locked = False
- 
- 
+
+
     def __enter__(self):
-        """ Activated when used in the with statement. 
-            Should automatically acquire a lock to be used in the with block.
-        """
         if not self.is_locked:
             self.acquire()
         return self
- 
- 
+
+
     def __exit__(self, type, value, traceback):
-        """ Activated at the end of the with statement.
-            It automatically releases the lock if it isn't locked.
-        """
-        if self.is_locked:
-            self.release()
- 
- 
-    def __del__(self):
-        """ Make sure that the FileLock instance doesn't leave a lockfile
-            lying around.
-        """
-        self.release()
\ No newline at end of file
+        self.release()
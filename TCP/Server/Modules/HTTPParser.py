@@ -0,0 +1,304 @@
+'''
+Incremental HTTP/1.x message parser.
+
+The same module is used by the TCP and UDP clients and servers. Bytes are fed in as they
+arrive from the socket (or from reassembled UDP packets) and complete messages come out:
+
+    parser = HTTPParser()
+    for message in parser.feed(socket.recv(65536)):
+        print(message.method, message.path, message.headers, bytes(message.body))
+
+- Works on bytes/memoryview; the header block is decoded once per message
+- Bodies are framed by Content-Length or chunked transfer-encoding. A response with neither
+  is read until the connection closes (call feedEOF())
+- Bytes past the end of a message are kept for the next one, so several requests on one
+  connection are returned in order
+- onHeaders(message) is called as soon as a header block is parsed. It may set
+  message.bodySink to any object with a write(bytes) method to receive the body instead of
+  buffering it in message.body
+'''
+
+# States
+HEAD = 0
+BODY = 1
+CHUNK_SIZE = 2
+CHUNK_DATA = 3
+CHUNK_END = 4
+TRAILER = 5
+BODY_UNTIL_EOF = 6
+
+CRLF = b'\r\n'
+HEADER_END = b'\r\n\r\n'
+
+
+class HTTPParseError(Exception):
+    pass
+
+
+class HTTPMessage(object):
+    """ A parsed request or response. Header names are stored lower-cased. """
+
+    def __init__(self):
+        self.rawHeader = ''
+        self.method = None
+        self.path = None
+        self.version = None
+        self.statusCode = None
+        self.reason = None
+        self.headers = {}
+        self.trailers = {}
+        self.body = bytearray()
+        self.bodySink = None
+        self.bodyLength = 0
+        self.chunked = False
+        self.complete = False
+
+    def header(self, name, default = None):
+        return self.headers.get(name.lower(), default)
+
+    def text(self, encoding = 'utf-8'):
+        return self.body.decode(encoding, errors = 'replace')
+
+    def __repr__(self):
+        return '<HTTPMessage %s>' % (self.rawHeader.split('\r\n', 1)[0])
+
+
+class HTTPParser(object):
+    """ Turns a stream of bytes into HTTPMessage objects. """
+
+    def __init__(self, isResponse = False, maxHeaderSize = 65536, onHeaders = None):
+        self.isResponse = isResponse
+        self.maxHeaderSize = maxHeaderSize
+        self.onHeaders = onHeaders
+        # Responses to HEAD carry headers describing a body that is never sent
+        self.requestMethod = None
+
+        self.buffer = bytearray()
+        self.state = HEAD
+        self.remaining = 0
+        # Bytes of an unfinished header block already searched for the blank line
+        self.scanned = 0
+        self.message = HTTPMessage()
+
+
+    def feed(self, data):
+        """ Parse `data` and return the list of messages it completed. """
+        messages = []
+
+        if self.buffer:
+            self.buffer += data
+            source = self.buffer
+        else:
+            source = data if isinstance(data, (bytes, bytearray)) else bytes(data)
+
+        view = memoryview(source)
+        position = 0
+
+        try:
+            while position < len(view):
+                newPosition = self.__step(source, view, position, messages)
+                if newPosition == position: break
+                position = newPosition
+        finally:
+            view.release()
+
+        # Keep whatever has not been consumed for the next call
+        if source is self.buffer:
+            del self.buffer[:position]
+        else:
+            self.buffer = bytearray(source[position:])
+
+        return messages
+
+
+    def feedEOF(self):
+        """ The peer closed the connection. Completes a body that is delimited by the close
+            and returns it; raises HTTPParseError if a message was cut short.
+        """
+        if self.state == BODY_UNTIL_EOF:
+            messages = []
+            self.__finish(messages)
+            return messages
+
+        if self.state != HEAD or self.buffer.strip(CRLF):
+            raise HTTPParseError('Connection closed in the middle of a message.')
+
+        return []
+
+
+    def hasPartialMessage(self):
+        return self.state != HEAD or bool(self.buffer.strip(CRLF))
+
+
+    def readingBody(self):
+        """ True once the head of the current message is parsed and until its body is complete. """
+        return self.state != HEAD
+
+
+    def __step(self, source, view, position, messages):
+        if self.state == HEAD:
+            return self.__parseHead(source, position, messages)
+
+        if self.state in (BODY, CHUNK_DATA):
+            size = min(self.remaining, len(view) - position)
+            self.__writeBody(view[position:position + size])
+            self.remaining -= size
+
+            if self.remaining == 0:
+                if self.state == BODY:
+                    self.__finish(messages)
+                else:
+                    self.state = CHUNK_END
+
+            return position + size
+
+        if self.state == BODY_UNTIL_EOF:
+            self.__writeBody(view[position:])
+            return len(view)
+
+        if self.state == CHUNK_END:
+            if len(view) - position < 2: return position
+            if source[position:position + 2] != CRLF:
+                raise HTTPParseError('Chunk is not terminated by CRLF.')
+            self.state = CHUNK_SIZE
+            return position + 2
+
+        # CHUNK_SIZE and TRAILER are line based
+        end = source.find(CRLF, position)
+        if end < 0:
+            if len(view) - position > self.maxHeaderSize:
+                raise HTTPParseError('Chunk header too long.')
+            return position
+
+        line = bytes(source[position:end])
+
+        if self.state == CHUNK_SIZE:
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise HTTPParseError('Invalid chunk size: %r' % line)
+
+            if size == 0:
+                self.state = TRAILER
+            else:
+                self.state = CHUNK_DATA
+                self.remaining = size
+
+        elif line:
+            key, _, value = line.decode('latin-1').partition(':')
+            self.message.trailers[key.strip().lower()] = value.strip()
+
+        else:
+            self.__finish(messages)
+
+        return end + 2
+
+
+    def __parseHead(self, source, position, messages):
+        # Stray CRLFs between messages are skipped
+        while source[position:position + 2] == CRLF:
+            position += 2
+            self.scanned = max(0, self.scanned - 2)
+
+        end = source.find(HEADER_END, position + max(0, self.scanned - 3))
+        if end < 0:
+            self.scanned = len(source) - position
+            if self.scanned > self.maxHeaderSize:
+                raise HTTPParseError('Header block too large.')
+            return position
+
+        message = self.message
+        message.rawHeader = bytes(source[position:end]).decode('utf-8', errors = 'replace')
+        self.__parseHeaderBlock(message)
+
+        self.scanned = 0
+        self.__frameBody(message)
+
+        if self.onHeaders is not None:
+            self.onHeaders(message)
+
+        if self.state == HEAD:
+            self.__finish(messages)
+
+        return end + 4
+
+
+    def __parseHeaderBlock(self, message):
+        LINES = message.rawHeader.split('\r\n')
+        START_LINE = LINES[0].split(' ', 2)
+
+        if len(START_LINE) < 2:
+            raise HTTPParseError('Malformed start line: ' + LINES[0])
+
+        if self.isResponse:
+            message.version = START_LINE[0]
+            try:
+                message.statusCode = int(START_LINE[1])
+            except ValueError:
+                raise HTTPParseError('Malformed status line: ' + LINES[0])
+            message.reason = START_LINE[2] if len(START_LINE) > 2 else ''
+        else:
+            message.method = START_LINE[0].strip()
+            message.path = START_LINE[1].strip()
+            message.version = START_LINE[2].strip() if len(START_LINE) > 2 else 'HTTP/1.0'
+
+        for LINE in LINES[1:]:
+            key, separator, value = LINE.partition(':')
+            if not separator: continue
+
+            key = key.strip().lower()
+            value = value.strip()
+
+            if key in message.headers:
+                message.headers[key] += ', ' + value
+            else:
+                message.headers[key] = value
+
+
+    def __frameBody(self, message):
+        transferEncoding = message.headers.get('transfer-encoding', '').lower()
+        contentLength = message.headers.get('content-length')
+
+        if self.isResponse and (self.requestMethod == 'HEAD' or message.statusCode in (204, 304) or message.statusCode < 200):
+            self.state = HEAD
+            return
+
+        if 'chunked' in transferEncoding:
+            message.chunked = True
+            self.state = CHUNK_SIZE
+            return
+
+        if contentLength is not None:
+            try:
+                self.remaining = int(contentLength)
+            except ValueError:
+                raise HTTPParseError('Invalid Content-Length: ' + contentLength)
+            if self.remaining < 0:
+                raise HTTPParseError('Invalid Content-Length: ' + contentLength)
+
+            self.state = BODY if self.remaining > 0 else HEAD
+            return
+
+        # Only a response may be delimited by closing the connection
+        self.state = BODY_UNTIL_EOF if self.isResponse else HEAD
+
+
+    def __writeBody(self, data):
+        if not data: return
+
+        self.message.bodyLength += len(data)
+
+        if self.message.bodySink is not None:
+            self.message.bodySink.write(data)
+        else:
+            self.message.body += data
+
+
+    def __finish(self, messages):
+        self.message.complete = True
+        messages.append(self.message)
+
+        self.message = HTTPMessage()
+        self.state = HEAD
+        self.remaining = 0
+        self.requestMethod = None
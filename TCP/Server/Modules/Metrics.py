@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import bisect
+import threading
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Methods counted under their own name. Any other method is client-controlled text and is counted
+# as 'other', so a client can neither break the labels nor grow the table; '-' is a connection
+# turned away before its request was read
+COUNTED_METHODS = {'GET', 'HEAD', 'POST', 'PATCH', '-'}
+
+# Keys of the extra sections (see snapshot) that only ever grow
+COUNTER_KEYS = {'hits', 'misses', 'evictions', 'acquisitions', 'contended', 'timeouts', 'wait_seconds', 'written', 'dropped', 'refused', 'opened', 'shared', 'stored', 'deduplicated'}
+
+
+def label(value):
+    """ `value` escaped for a Prometheus label value. """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram(object):
+    """ Cumulative-bucket histogram, as Prometheus expects. Not locked:
+        Metrics updates it under its own lock.
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def cumulative(self):
+        """ [(upper bound, observations <= bound)], ending with +Inf. """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics(object):
+    """ Counters and latency histograms of one server process.
+
+        Every update takes a single lock for a few additions, so recording
+        costs far less than the request it describes. With several worker
+        processes each one keeps (and reports) its own numbers.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+        self.requests = {}
+        self.phases = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.connections_total = 0
+        self.connections_active = 0
+
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections_total += 1
+            self.connections_active += 1
+
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections_active -= 1
+
+
+    def count_request(self, method, status):
+        key = (method if method in COUNTED_METHODS else 'other', status)
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+
+    def observe(self, phase, route, seconds):
+        """ Record how long `phase` (parse, handler or send) took for a
+            request to `route`.
+        """
+        key = (phase, route)
+        with self.lock:
+            histogram = self.phases.get(key)
+            if histogram is None:
+                histogram = self.phases[key] = Histogram()
+            histogram.observe(seconds)
+
+
+    def received(self, size):
+        with self.lock:
+            self.bytes_received += size
+
+
+    def sent(self, size):
+        with self.lock:
+            self.bytes_sent += size
+
+
+    def snapshot(self, **sections):
+        """ Everything as plain data. `sections` adds named dicts of numbers
+            from other components (e.g. cache=..., locks=...).
+        """
+        with self.lock:
+            snapshot = {
+                'pid': os.getpid(),
+                'uptime_seconds': time.time() - self.started,
+                'connections_total': self.connections_total,
+                'connections_active': self.connections_active,
+                'bytes_received': self.bytes_received,
+                'bytes_sent': self.bytes_sent,
+                'requests': [
+                    {'method': method, 'status': status, 'count': count}
+                    for (method, status), count in sorted(self.requests.items())
+                ],
+                'latency': [
+                    {
+                        'phase': phase,
+                        'route': route,
+                        'count': histogram.count,
+                        'sum': histogram.sum,
+                        'buckets': [[bound if bound != float('inf') else '+Inf', count] for bound, count in histogram.cumulative()]
+                    }
+                    for (phase, route), histogram in sorted(self.phases.items())
+                ]
+            }
+
+        snapshot.update(sections)
+        return snapshot
+
+
+    def to_json(self, snapshot):
+        return json.dumps(snapshot, indent=2)
+
+
+    def to_prometheus(self, snapshot):
+        """ Prometheus text exposition format (version 0.0.4). """
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, labels, repr(float(value)) if isinstance(value, float) else value))
+
+        metric('httpfs_uptime_seconds', 'gauge', 'Seconds since the process started.', [('', snapshot['uptime_seconds'])])
+        metric('httpfs_connections_total', 'counter', 'Connections accepted.', [('', snapshot['connections_total'])])
+        metric('httpfs_connections_active', 'gauge', 'Connections currently open.', [('', snapshot['connections_active'])])
+        metric('httpfs_received_bytes_total', 'counter', 'Bytes read from clients.', [('', snapshot['bytes_received'])])
+        metric('httpfs_sent_bytes_total', 'counter', 'Bytes written to clients.', [('', snapshot['bytes_sent'])])
+
+        metric('httpfs_requests_total', 'counter', 'Requests answered, by method and status.', [
+            ('{method="%s",status="%s"}' % (label(entry['method']), label(entry['status'])), entry['count'])
+            for entry in snapshot['requests']
+        ])
+
+        lines.append('# HELP httpfs_phase_seconds Time spent reading and parsing the request, in the FileHandler and sending the response.')
+        lines.append('# TYPE httpfs_phase_seconds histogram')
+        for entry in snapshot['latency']:
+            labels = 'phase="%s",route="%s"' % (label(entry['phase']), label(entry['route']))
+            for bound, count in entry['buckets']:
+                lines.append('httpfs_phase_seconds_bucket{%s,le="%s"} %d' % (labels, bound, count))
+            lines.append('httpfs_phase_seconds_sum{%s} %r' % (labels, entry['sum']))
+            lines.append('httpfs_phase_seconds_count{%s} %d' % (labels, entry['count']))
+
+        # Sections contributed by other components
+        for section, values in snapshot.items():
+            if not isinstance(values, dict): continue
+            for key, value in sorted(values.items()):
+                if key in COUNTER_KEYS:
+                    metric('httpfs_%s_%s_total' % (section, key), 'counter', '%s %s.' % (section, key), [('', value)])
+                else:
+                    metric('httpfs_%s_%s' % (section, key), 'gauge', '%s %s.' % (section, key), [('', value)])
+
+        return '\n'.join(lines) + '\n'
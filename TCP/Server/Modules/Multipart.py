@@ -0,0 +1,132 @@
+from email.message import Message
+from email.utils import collapse_rfc2231_value
+
+CRLF = b'\r\n'
+
+class MultipartError(Exception):
+    pass
+
+
+class MultipartParser(object):
+    """ Incremental parser of a multipart body (RFC 2046), fed the body in
+        pieces as they come off the socket.
+
+        Every part's content is handed on as it arrives and never collected:
+        `on_part(headers)` is called when a part's headers are complete, with
+        a dict of lower-cased header names, and returns the callable that
+        takes the part's content (or None to skip the part).
+    """
+
+    def __init__(self, boundary, on_part, max_header_size=16384):
+        if not boundary:
+            raise MultipartError('Missing multipart boundary.')
+
+        # The CRLF before a delimiter belongs to the delimiter. One is put in front of the body so the
+        # first delimiter, which usually opens the body, is found the same way as the others
+        self.delimiter = b'\r\n--' + boundary.encode('latin-1')
+        self.on_part = on_part
+        self.max_header_size = max_header_size
+        self.buffer = bytearray(CRLF)
+        self.state = 'preamble'
+        self.write = None
+
+
+    def feed(self, data):
+        self.buffer += data
+
+        while self.buffer:
+            if self.state == 'preamble' or self.state == 'body':
+                if not self.__content(): return
+
+            elif self.state == 'delimiter':
+                if not self.__afterDelimiter(): return
+
+            elif self.state == 'headers':
+                if not self.__headers(): return
+
+            else:
+                # Epilogue, ignored
+                self.buffer.clear()
+
+
+    def close(self):
+        """ Raises MultipartError unless the closing delimiter was seen. """
+        if self.state != 'epilogue':
+            raise MultipartError('Multipart body ended before its closing boundary.')
+
+
+    def __content(self):
+        position = self.buffer.find(self.delimiter)
+
+        if position < 0:
+            # Everything but what could be the start of a delimiter split across two reads
+            keep = len(self.delimiter) - 1
+            if len(self.buffer) > keep:
+                self.__emit(len(self.buffer) - keep)
+            return False
+
+        self.__emit(position)
+        del self.buffer[:len(self.delimiter)]
+        self.write = None
+        self.state = 'delimiter'
+        return True
+
+
+    def __emit(self, length):
+        if self.state == 'body' and self.write is not None and length:
+            # The view is released before the buffer is trimmed: the sink must not keep it
+            with memoryview(self.buffer) as view, view[:length] as content:
+                self.write(content)
+        del self.buffer[:length]
+
+
+    def __afterDelimiter(self):
+        # Either "--" (the closing delimiter) or the end of the line, possibly after some whitespace
+        if self.buffer[:2] == b'--':
+            self.state = 'epilogue'
+            return True
+
+        line_end = self.buffer.find(CRLF)
+        if line_end < 0:
+            if len(self.buffer) > 1024: raise MultipartError('Malformed multipart boundary line.')
+            return False
+
+        if self.buffer[:line_end].strip(b' \t'):
+            raise MultipartError('Malformed multipart boundary line.')
+
+        del self.buffer[:line_end + 2]
+        self.state = 'headers'
+        return True
+
+
+    def __headers(self):
+        if self.buffer.startswith(CRLF):
+            end, block = 2, b''
+        else:
+            end = self.buffer.find(CRLF + CRLF)
+            if end < 0:
+                if len(self.buffer) > self.max_header_size: raise MultipartError('Multipart part headers too large.')
+                return False
+            block = bytes(self.buffer[:end])
+            end += 4
+
+        headers = {}
+        for line in block.decode('utf-8', errors='replace').split('\r\n') if block else []:
+            name, colon, value = line.partition(':')
+            if not colon: raise MultipartError('Malformed multipart part header.')
+            headers[name.strip().lower()] = value.strip()
+
+        del self.buffer[:end]
+        self.write = self.on_part(headers)
+        self.state = 'body'
+        return True
+
+
+def header_param(value, name):
+    """ A parameter of a header value such as Content-Type or
+        Content-Disposition (e.g. the boundary or the filename), unquoted.
+    """
+    message = Message()
+    message['content-type'] = value
+    param = message.get_param(name)
+    return collapse_rfc2231_value(param) if param is not None else None
@@ -0,0 +1,308 @@
+import os
+import stat
+import shutil
+import tempfile
+from Modules.FileLock import FileLock
+from Modules.Multipart import MultipartParser, MultipartError, header_param
+
+# When uploaded data is forced to disk before it is acknowledged:
+#   never:  left to the OS (fastest, a crash may lose recent uploads)
+#   file:   the file's data is fsynced before it is renamed into place
+#   always: the file and then its directory entry are fsynced
+FSYNC_POLICIES = ['never', 'file', 'always']
+
+class UploadError(Exception):
+    """ An upload that can't be accepted. `status_code` is the HTTP status
+        the client should get.
+    """
+
+    def __init__(self, status_code, message, headers=()):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = list(headers)
+
+
+class Upload(object):
+    """ Spools a request body into a temporary file next to its destination
+        and renames it into place once the body is complete, so readers see
+        either the old file or the new one and never a partial write.
+
+        The temporary files are kept in a hidden SPOOL directory inside the
+        destination's directory: on the same filesystem, so the rename is
+        atomic, but creating and removing them does not change the mtime of
+        the destination's directory (which would make its DirectoryIndex
+        rescan it).
+
+        It is meant as the HTTPParser body sink: write() is called with each
+        piece of the body as it comes off the socket and goes through a fixed
+        size buffer, so memory per upload does not depend on the file size.
+    """
+
+    SUFFIX = '.upload'
+    SPOOL = '.uploads'
+    BUFFER_SIZE = 65536
+
+    def __init__(self, path, max_bytes=None, fsync='never'):
+        """ Create the temporary file for `path`. Raises UploadError(404)
+            if the directory of `path` does not exist: it is not created.
+            Writing more than `max_bytes` (None or 0 for no limit) raises
+            UploadError(413).
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.size = 0
+
+        directory, name = os.path.split(path)
+        spool = os.path.join(directory or '.', self.SPOOL)
+        try:
+            os.mkdir(spool)
+        except FileExistsError:
+            pass
+        except (FileNotFoundError, NotADirectoryError):
+            raise UploadError(404, 'Directory does not exist.')
+        fd, self.temporary_path = tempfile.mkstemp(prefix='.' + name + '.', suffix=self.SUFFIX, dir=spool)
+        self.file = os.fdopen(fd, 'wb', buffering=self.BUFFER_SIZE)
+
+        # mkstemp creates the file private to its owner: keep the mode of the file being replaced
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except OSError:
+            mode = 0o644
+        os.chmod(self.temporary_path, mode)
+
+
+    @staticmethod
+    def is_temporary(name):
+        """ True for the name of an upload still in progress, or of the
+            directory they are spooled in.
+        """
+        return name == Upload.SPOOL or (name.startswith('.') and name.endswith(Upload.SUFFIX))
+
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_bytes and self.size > self.max_bytes:
+            self.abort()
+            raise UploadError(413, 'Request body is larger than %d bytes.' % self.max_bytes)
+
+        self.file.write(data)
+
+
+    def commit(self):
+        """ Flush and sync the data as the fsync policy says, then replace
+            the destination with it. The temporary file is removed on failure.
+        """
+        try:
+            self.file.flush()
+            if self.fsync != 'never':
+                os.fsync(self.file.fileno())
+            self.file.close()
+
+            with FileLock(self.path):
+                os.replace(self.temporary_path, self.path)
+        except BaseException:
+            self.abort()
+            raise
+
+        self.temporary_path = None
+
+        if self.fsync == 'always':
+            fd = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+    def abort(self):
+        """ Drop the upload. Safe to call more than once, or after commit(). """
+        if self.temporary_path is None: return
+
+        self.file.close()
+        try:
+            os.unlink(self.temporary_path)
+        except FileNotFoundError:
+            pass
+        self.temporary_path = None
+
+
+class DiscardedBody(object):
+    """ Body sink of a request that has no use for its body (a GET, a
+        request refused with 405, ...): the body is counted and dropped
+        instead of being kept in memory. Going over `max_bytes` (None or 0
+        for no limit) raises UploadError(413).
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.size = 0
+
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_bytes and self.size > self.max_bytes:
+            raise UploadError(413, 'Request body is larger than %d bytes.' % self.max_bytes)
+
+
+    def abort(self):
+        pass
+
+
+class PartialUpload(Upload):
+    """ An Upload that changes part of its destination instead of replacing
+        it: the body is appended to the file, or written over it from a given
+        offset. It is spooled like any upload and only copied into the file,
+        under its lock, once complete, so a slow client never holds the lock
+        and a broken request leaves the file as it was. Only the bytes of the
+        body are written, whatever the size of the file.
+
+        The file never shrinks, so readers that have it memory mapped are
+        safe. Readers already sending the bytes being overwritten may send
+        some of the new ones; appended bytes are never seen by them.
+    """
+
+    def __init__(self, path, offset=None, length=None, max_bytes=None, fsync='never'):
+        """ Append to `path` (created if missing) when `offset` is None,
+            otherwise write the body over the existing file from `offset` on.
+            `length` is the body size announced for the write, if any.
+        """
+        super().__init__(path, max_bytes, fsync)
+        self.offset = offset
+        self.length = length
+
+
+    def commit(self):
+        """ Copy the body into the destination, sync it as the fsync policy
+            says and remove the temporary file. Raises UploadError when the
+            body does not match the announced length (400), the file is
+            missing (404) or the offset is past its end (416).
+        """
+        try:
+            if self.length is not None and self.size != self.length:
+                raise UploadError(400, 'Request body is %d bytes, the range to write is %d.' % (self.size, self.length))
+
+            self.file.flush()
+            fd, created = self.__open()
+            try:
+                with FileLock(self.path, fd=fd):
+                    size = os.fstat(fd).st_size
+                    offset = size if self.offset is None else self.offset
+                    if offset > size:
+                        raise UploadError(416, 'Write starts past the end of the file (%d bytes).' % size, ['Content-Range: bytes */%d' % size])
+
+                    self.__copy(fd, offset)
+                    if self.fsync != 'never':
+                        os.fsync(fd)
+            finally:
+                os.close(fd)
+        finally:
+            self.abort()
+
+        if created and self.fsync == 'always':
+            fd = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+    def __open(self):
+        """ Descriptor of the destination for writing, and whether it was
+            just created (only appends create the file).
+        """
+        flags = os.O_WRONLY | getattr(os, 'O_BINARY', 0)
+        if self.offset is not None:
+            try:
+                return os.open(self.path, flags), False
+            except FileNotFoundError:
+                raise UploadError(404, 'File does not exist.')
+
+        try:
+            return os.open(self.path, flags | os.O_CREAT | os.O_EXCL, 0o644), True
+        except FileExistsError:
+            return os.open(self.path, flags), False
+
+
+    def __copy(self, fd, offset):
+        # The descriptor was opened without O_TRUNC, so the file object writes over it in place
+        with open(self.temporary_path, 'rb') as source, open(fd, 'wb', closefd=False) as target:
+            target.seek(offset)
+            shutil.copyfileobj(source, target, self.BUFFER_SIZE)
+
+
+class BatchUpload(object):
+    """ Body sink for a multipart body carrying several files (see
+        Modules/Multipart.py). Each part is spooled into its own Upload as it
+        arrives, so the whole batch never sits in memory. A part that can't
+        be written (no file name, forbidden path, too large) is dropped and
+        reported on its own instead of failing the other files.
+
+        `begin_upload(name)` returns the Upload for one file and raises
+        UploadError when it can't be written. A body larger than `max_bytes`
+        (None or 0 for no limit) as a whole raises UploadError(413).
+    """
+
+    def __init__(self, boundary, begin_upload, max_bytes=None):
+        self.begin_upload = begin_upload
+        self.max_bytes = max_bytes
+        self.size = 0
+        # [name, Upload or None, UploadError or None], in the order of the body
+        self.parts = []
+
+        try:
+            self.parser = MultipartParser(boundary, self.__begin_part)
+        except MultipartError as e:
+            raise UploadError(400, str(e))
+
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_bytes and self.size > self.max_bytes:
+            self.abort()
+            raise UploadError(413, 'Request body is larger than %d bytes.' % self.max_bytes)
+
+        try:
+            self.parser.feed(data)
+        except MultipartError as e:
+            self.abort()
+            raise UploadError(400, str(e))
+
+
+    def close(self):
+        """ Check the body ended where it should. Raises UploadError(400)
+            after aborting every part if it did not.
+        """
+        try:
+            self.parser.close()
+        except MultipartError as e:
+            self.abort()
+            raise UploadError(400, str(e))
+
+
+    def abort(self):
+        for _, upload, _ in self.parts:
+            if upload is not None: upload.abort()
+
+
+    def __begin_part(self, headers):
+        # The file name of a form upload (curl -F), or the location a multipart/mixed part is meant for
+        name = header_param(headers.get('content-disposition', ''), 'filename') or headers.get('content-location', '')
+        part = [name.lstrip('/'), None, None]
+        self.parts.append(part)
+
+        try:
+            if not part[0]: raise UploadError(400, 'Part has no file name.')
+            part[1] = self.begin_upload(part[0])
+        except UploadError as e:
+            part[2] = e
+            return None
+
+        def write(data):
+            if part[2] is not None: return
+            try:
+                part[1].write(data)
+            except UploadError as e:
+                part[2] = e
+
+        return write
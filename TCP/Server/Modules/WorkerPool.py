@@ -0,0 +1,50 @@
+import threading
+from queue import Queue, Full
+
+class WorkerPool(object):
+    """ A fixed number of worker threads fed from a bounded queue.
+        Tasks that do not fit in the queue are refused instead of
+        spawning more threads, so the caller can shed load cheaply.
+    """
+
+    def __init__(self, size=32, queue_size=128):
+        """ Start `size` worker threads that take tasks from a queue that
+            holds at most `queue_size` pending tasks.
+        """
+        if size < 1 or queue_size < 1:
+            raise ValueError("Pool size and queue size must be at least 1.")
+        self.size = size
+        self.queue = Queue(maxsize=queue_size)
+        self.workers = []
+
+        for index in range(size):
+            worker = threading.Thread(target=self.__work, name="httpfs-worker-%d" % index, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+
+    def submit(self, task, *args):
+        """ Queue `task(*args)` for a worker. Returns False without blocking
+            when the queue is full.
+        """
+        try:
+            self.queue.put_nowait((task, args))
+            return True
+        except Full:
+            return False
+
+
+    def pending(self):
+        """ Number of tasks waiting for a free worker. """
+        return self.queue.qsize()
+
+
+    def __work(self):
+        while True:
+            task, args = self.queue.get()
+            try:
+                task(*args)
+            except Exception as e:
+                print('Worker error: ', e)
+            finally:
+                self.queue.task_done()
@@ -1,14 +1,67 @@
 '''
 httpfs is a simple file server.
-usage: httpfs [-v] [-p PORT] [-d PATH-TO-DIR]
--v Prints debugging messages.
+usage: httpfs [-v] [-p PORT] [-d PATH-TO-DIR] [--threads N] [--queue N] [--backlog N] [--engine thread|async]
+              [--keep-alive SECONDS] [--max-requests N] [--cache-size BYTES]
+              [--index-snapshot PATH] [--max-body-size BYTES] [--fsync never|file|always]
+              [--workers N] [--access-log PATH] [--log-format json|clf] [--log-sample FRACTION]
+              [--pipeline-depth N] [--header-timeout SECONDS] [--body-timeout SECONDS]
+              [--write-timeout SECONDS] [--min-rate BYTES] [--max-connections-per-ip N]
+              [--storage files|cas]
+-v Prints debugging messages, and logs every request to stdout unless
+--access-log is given.
 -p Specifies the port number that the server will listen and serve at.
 Default is 8080.
 -d Specifies the directory that the server will use to read/write requested
 files. Default is the current directory when launching the application.
+--threads Number of worker threads serving connections. Default is 32.
+--queue Number of accepted connections that may wait for a free worker before
+new ones are answered with 503. Default is 128.
+--backlog Listen backlog of the server socket. Default is 128.
+--engine Serving model: 'thread' (worker pool) or 'async' (single event loop
+thread, file I/O offloaded to --threads executor threads). Default is thread.
+--keep-alive Seconds an idle persistent connection is kept open. 0 disables
+keep-alive. Default is 5.
+--max-requests Requests served on one persistent connection before it is
+closed. Default is 100.
+--cache-size Bytes of hot file content kept in memory, with an optional K/M/G
+suffix. 0 disables the cache. Default is 64M.
+--index-snapshot File the directory index is saved to, and reloaded from on the
+next start if the directory has not changed, to skip rescanning it.
+--max-body-size Largest request body accepted, with an optional K/M/G suffix.
+Larger uploads are refused with 413. 0 disables the limit. Default is 1G.
+--fsync When uploaded files are forced to disk: 'never' (left to the OS), 'file'
+(the file's data before it replaces the old one) or 'always' (the file and its
+directory entry). Default is never.
+--workers Number of server processes sharing the port, so all cores are used.
+A supervisor restarts workers that die. Default is 1.
+--access-log File every request is logged to, one line each ('-' for stdout).
+Lines are written by a background thread in batches. Default is no log.
+--log-format Access log lines as 'json' or 'clf' (combined log format followed
+by the time taken in milliseconds). Default is json.
+--log-sample Fraction of requests logged, between 0 and 1. Server errors are
+always logged. Default is 1.
+--pipeline-depth Pipelined GET/HEAD requests of one connection handled at the
+same time. Responses are always sent in request order. Default is 1.
+--header-timeout Seconds a request's headers may take to arrive, counted from
+the connection's accept for the first request. Slower clients get 408. 0
+disables it. Default is 10.
+--body-timeout Seconds a request body may go without receiving data before the
+client gets 408. 0 disables it. Default is 30.
+--write-timeout Seconds a response write may go without progress before the
+connection is dropped. 0 disables it. Default is 30.
+--min-rate Bytes per second request and response bodies must average after
+their first 5 seconds, with an optional K/M/G suffix. A response only counts the
+time spent waiting on the client, not the time taken to produce it. 0 disables
+it. Default is 1K.
+--max-connections-per-ip Connections one client address may have open at once.
+More are answered with 429. 0 disables the limit. The connections are counted
+by each process, so it needs --workers 1. Default is 0.
+--storage How files are stored: 'files' (as named in the directory) or 'cas' (by
+SHA-256 in a content-addressed store inside the directory, so identical content
+is stored once whatever its names). 'cas' needs --workers 1. Default is files.
 '''
 import argparse
-from HTTPServerLibrary import HTTPServerLibrary
+from HTTPServerLibrary import HTTPServerLibrary, ENGINES, FSYNC_POLICIES, FORMATS, STORAGE_BACKENDS
 
 def validate_port(port, parser):
     if not port.isnumeric() or len(port) > 5:
@@ -19,6 +72,50 @@ def validate_port(port, parser):
 def validate_directory(directory, parser):
     return directory
 
+def validate_timeout(value, parser, name):
+    try:
+        timeout = float(value)
+    except ValueError:
+        timeout = -1
+
+    if timeout < 0:
+        parser.error("Please input a non-negative number of seconds for " + name + ".")
+
+    return timeout
+
+def validate_size(value, parser, name):
+    UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    multiplier = UNITS.get(value[-1:].upper(), 1)
+    number = value[:-1] if multiplier > 1 else value
+
+    if not number.isnumeric():
+        parser.error("Please input a size in bytes (optionally with a K/M/G suffix) for " + name + ".")
+
+    return int(number) * multiplier
+
+def validate_fraction(value, parser, name):
+    try:
+        fraction = float(value)
+    except ValueError:
+        fraction = -1
+
+    if not 0 <= fraction <= 1:
+        parser.error("Please input a number between 0 and 1 for " + name + ".")
+
+    return fraction
+
+def validate_positive_int(value, parser, name):
+    if not value.isnumeric() or int(value) < 1:
+        parser.error("Please input a positive integer for " + name + ".")
+
+    return int(value)
+
+def validate_count(value, parser, name):
+    if not value.isnumeric():
+        parser.error("Please input a non-negative integer for " + name + ".")
+
+    return int(value)
+
 def main():
     print("\n=====[Pan & Smit's Server]=====\n")
 
@@ -26,17 +123,87 @@ def main():
 
     # When storing arguments, can use parameters to perform extra parsing
     parser.add_argument('-help', action='help', help='Show this help message and exit')
-    parser.add_argument('-v', dest='verbose', help='Verbose mode. Display more information for a given request.',
+    parser.add_argument('-v', dest='verbose', help='Verbose mode. Display more information and log every request.',
                         default=False, action='store_true')
     parser.add_argument('-p', dest='port', help='Specifies the port number that the server will listen and serve at. Default is 8080.',
                         type=lambda port: validate_port(port,parser), default='8080')
     parser.add_argument('-d', dest='directory', help='Specifies the directory that the server will use to read/write requested\
                         files. Default is the current directory when launching the application.', type=lambda dir: validate_directory(dir, parser))
+    parser.add_argument('--threads', dest='threads', help='Number of worker threads serving connections. Default is 32.',
+                        type=lambda value: validate_positive_int(value, parser, '--threads'), default='32')
+    parser.add_argument('--queue', dest='queue', help='Number of accepted connections that may wait for a free worker\
+                        before new ones are answered with 503. Default is 128.',
+                        type=lambda value: validate_positive_int(value, parser, '--queue'), default='128')
+    parser.add_argument('--backlog', dest='backlog', help='Listen backlog of the server socket. Default is 128.',
+                        type=lambda value: validate_positive_int(value, parser, '--backlog'), default='128')
+    parser.add_argument('--engine', dest='engine', help='Serving model: "thread" uses the worker pool, "async" multiplexes\
+                        all connections on one event loop thread. Default is thread.', choices=ENGINES, default='thread')
+    parser.add_argument('--keep-alive', dest='keep_alive', help='Seconds an idle persistent connection is kept open.\
+                        0 disables keep-alive. Default is 5.',
+                        type=lambda value: validate_timeout(value, parser, '--keep-alive'), default='5')
+    parser.add_argument('--max-requests', dest='max_requests', help='Requests served on one persistent connection before\
+                        it is closed. Default is 100.',
+                        type=lambda value: validate_positive_int(value, parser, '--max-requests'), default='100')
+    parser.add_argument('--cache-size', dest='cache_size', help='Bytes of hot file content kept in memory, with an optional\
+                        K/M/G suffix. 0 disables the cache. Default is 64M.',
+                        type=lambda value: validate_size(value, parser, '--cache-size'), default='64M')
+    parser.add_argument('--index-snapshot', dest='index_snapshot', help='File the directory index is saved to, and reloaded\
+                        from on the next start if the directory has not changed, to skip rescanning it.')
+    parser.add_argument('--max-body-size', dest='max_body_size', help='Largest request body accepted, with an optional\
+                        K/M/G suffix. 0 disables the limit. Default is 1G.',
+                        type=lambda value: validate_size(value, parser, '--max-body-size'), default='1G')
+    parser.add_argument('--fsync', dest='fsync', help='When uploaded files are forced to disk: "never", "file" (before\
+                        replacing the old file) or "always" (file and directory entry). Default is never.',
+                        choices=FSYNC_POLICIES, default='never')
+    parser.add_argument('--workers', dest='workers', help='Number of server processes sharing the port, so all cores\
+                        are used. A supervisor restarts workers that die. Default is 1.',
+                        type=lambda value: validate_positive_int(value, parser, '--workers'), default='1')
+    parser.add_argument('--access-log', dest='access_log', help='File every request is logged to, one line each ("-" for\
+                        stdout). Default is no log (stdout with -v).')
+    parser.add_argument('--log-format', dest='log_format', help='Access log lines as "json" or "clf" (combined log\
+                        format plus milliseconds taken). Default is json.', choices=FORMATS, default='json')
+    parser.add_argument('--log-sample', dest='log_sample', help='Fraction of requests logged, between 0 and 1. Server\
+                        errors are always logged. Default is 1.',
+                        type=lambda value: validate_fraction(value, parser, '--log-sample'), default='1')
+    parser.add_argument('--pipeline-depth', dest='pipeline_depth', help='Pipelined GET/HEAD requests of one connection\
+                        handled at the same time. Responses are always sent in request order. Default is 1.',
+                        type=lambda value: validate_positive_int(value, parser, '--pipeline-depth'), default='1')
+    parser.add_argument('--header-timeout', dest='header_timeout', help='Seconds a request\'s headers may take to arrive.\
+                        Slower clients get 408. 0 disables it. Default is 10.',
+                        type=lambda value: validate_timeout(value, parser, '--header-timeout'), default='10')
+    parser.add_argument('--body-timeout', dest='body_timeout', help='Seconds a request body may go without receiving\
+                        data. 0 disables it. Default is 30.',
+                        type=lambda value: validate_timeout(value, parser, '--body-timeout'), default='30')
+    parser.add_argument('--write-timeout', dest='write_timeout', help='Seconds a response write may go without\
+                        progress. 0 disables it. Default is 30.',
+                        type=lambda value: validate_timeout(value, parser, '--write-timeout'), default='30')
+    parser.add_argument('--min-rate', dest='min_rate', help='Bytes per second request and response bodies must average,\
+                        with an optional K/M/G suffix. 0 disables it. Default is 1K.',
+                        type=lambda value: validate_size(value, parser, '--min-rate'), default='1K')
+    parser.add_argument('--max-connections-per-ip', dest='max_connections_per_ip', help='Connections one client\
+                        address may have open at once. 0 disables the limit. Needs --workers 1. Default is 0.',
+                        type=lambda value: validate_count(value, parser, '--max-connections-per-ip'), default='0')
+    parser.add_argument('--storage', dest='storage', help='How files are stored: "files" as named in the directory, or\
+                        "cas" deduplicated by content (needs --workers 1). Default is files.',
+                        choices=STORAGE_BACKENDS, default='files')
     # All arguments will be stored here
     parsed_args = parser.parse_args()
 
+    if parsed_args.storage == 'cas' and parsed_args.workers > 1:
+        parser.error("--storage cas can't be used with more than one worker.")
+
+    if parsed_args.max_connections_per_ip and parsed_args.workers > 1:
+        parser.error("--max-connections-per-ip can't be used with more than one worker.")
+
     http = HTTPServerLibrary()
-    http.startServer(parsed_args.port, parsed_args.directory, parsed_args.verbose)
+    http.startServer(parsed_args.port, parsed_args.directory, parsed_args.verbose,
+                     parsed_args.threads, parsed_args.queue, parsed_args.backlog, parsed_args.engine,
+                     parsed_args.keep_alive, parsed_args.max_requests, parsed_args.cache_size,
+                     parsed_args.index_snapshot, parsed_args.max_body_size, parsed_args.fsync,
+                     parsed_args.workers, parsed_args.access_log, parsed_args.log_format, parsed_args.log_sample,
+                     parsed_args.pipeline_depth, parsed_args.header_timeout, parsed_args.body_timeout,
+                     parsed_args.write_timeout, parsed_args.min_rate, parsed_args.max_connections_per_ip,
+                     parsed_args.storage)
 
     print('\n===========[END]==========\n')
 
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The server's modules import each other from the server directory (FileHandler, Modules.*)
+SERVER_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SERVER_DIRECTORY not in sys.path:
+    sys.path.insert(0, SERVER_DIRECTORY)
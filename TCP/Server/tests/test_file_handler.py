@@ -0,0 +1,355 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from urllib.parse import unquote
+import tests
+from FileHandler import FileHandler
+from Modules.Multipart import MultipartParser, header_param
+from Modules.Upload import UploadError
+
+CONTENT = bytes(range(256)) * 4
+
+
+def body(RESPONSE):
+    if 'stream' in RESPONSE:
+        return b''.join(piece.encode() if isinstance(piece, str) else bytes(piece) for piece in RESPONSE['stream'])
+
+    if 'file' in RESPONSE:
+        with RESPONSE['file'] as f:
+            f.seek(RESPONSE.get('offset', 0))
+            return f.read(RESPONSE['size'])
+
+    data = RESPONSE.get('data', b'')
+    return data.encode() if isinstance(data, str) else bytes(data)
+
+
+def header(RESPONSE, name):
+    for HEADER in RESPONSE.get('headers', []):
+        key, _, value = HEADER.partition(':')
+        if key.strip().lower() == name.lower():
+            return value.strip()
+    return None
+
+
+class HandlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.handler = FileHandler()
+        self.handler.setDefaultDirectory(self.directory)
+
+    def create(self, name, content = b''):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+
+class RangeTest(HandlerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.create('data.bin', CONTENT)
+
+    def get(self, RANGE, **HEADERS):
+        HEADERS['range'] = RANGE
+        return self.handler.getFileContent('data.bin', HEADERS)
+
+    def assertRange(self, RANGE, start, end):
+        for CACHE_SIZE in (1024 ** 2, 0):
+            self.handler.setCacheSize(CACHE_SIZE)
+            RESPONSE = self.get(RANGE)
+            self.assertEqual(RESPONSE['statusCode'], 206, RANGE)
+            self.assertEqual(header(RESPONSE, 'Content-Range'), 'bytes %d-%d/%d' % (start, end, len(CONTENT)))
+            self.assertEqual(body(RESPONSE), CONTENT[start:end + 1], RANGE)
+
+    def assertWholeFile(self, RANGE, **HEADERS):
+        RESPONSE = self.get(RANGE, **HEADERS)
+        self.assertEqual(RESPONSE['statusCode'], 200, RANGE)
+        self.assertIsNone(header(RESPONSE, 'Content-Range'))
+        self.assertEqual(body(RESPONSE), CONTENT)
+
+    def parts(self, RESPONSE):
+        parts = []
+        parser = MultipartParser(header_param(header(RESPONSE, 'Content-Type'), 'boundary'), lambda headers: parts.append([headers, b'']) or (lambda data: parts[-1].__setitem__(1, parts[-1][1] + bytes(data))))
+        data = body(RESPONSE)
+        self.assertEqual(len(data), RESPONSE['size'])
+        parser.feed(data)
+        parser.close()
+        return [(headers['content-range'], content) for headers, content in parts]
+
+    def test_single_range(self):
+        self.assertRange('bytes=0-9', 0, 9)
+        self.assertRange('bytes=1000-1023', 1000, 1023)
+
+    def test_open_ended_range(self):
+        self.assertRange('bytes=1000-', 1000, 1023)
+
+    def test_range_past_the_end_is_clamped(self):
+        self.assertRange('bytes=1020-5000', 1020, 1023)
+
+    def test_suffix_range(self):
+        self.assertRange('bytes=-10', 1014, 1023)
+        self.assertRange('bytes=-5000', 0, 1023)
+
+    def test_overlapping_ranges_are_separate_parts(self):
+        for CACHE_SIZE in (1024 ** 2, 0):
+            self.handler.setCacheSize(CACHE_SIZE)
+            RESPONSE = self.get('bytes=0-5, 3-8,-2')
+            self.assertEqual(RESPONSE['statusCode'], 206)
+            self.assertTrue(header(RESPONSE, 'Content-Type').startswith('multipart/byteranges; boundary='))
+            self.assertEqual(self.parts(RESPONSE), [
+                ('bytes 0-5/1024', CONTENT[0:6]),
+                ('bytes 3-8/1024', CONTENT[3:9]),
+                ('bytes 1022-1023/1024', CONTENT[1022:])
+            ])
+
+    def test_unsatisfiable_ranges_are_left_out(self):
+        RESPONSE = self.get('bytes=2000-3000,10-11')
+        self.assertEqual(RESPONSE['statusCode'], 206)
+        self.assertEqual(body(RESPONSE), CONTENT[10:12])
+
+    def test_nothing_satisfiable(self):
+        for RANGE in ('bytes=1024-', 'bytes=2000-3000', 'bytes=-0', 'bytes=1024-2000,-0'):
+            RESPONSE = self.get(RANGE)
+            self.assertEqual(RESPONSE['statusCode'], 416, RANGE)
+            self.assertEqual(header(RESPONSE, 'Content-Range'), 'bytes */1024')
+
+    def test_ignored_ranges(self):
+        for RANGE in ('bytes=9-3', 'bytes=a-b', 'bytes=5', 'items=0-9', 'bytes=' + ','.join(['0-0'] * 33)):
+            self.assertWholeFile(RANGE)
+
+    def test_if_range(self):
+        ETAG = header(self.handler.getFileContent('data.bin'), 'ETag')
+        LAST_MODIFIED = header(self.handler.getFileContent('data.bin'), 'Last-Modified')
+
+        self.assertEqual(self.get('bytes=0-9', **{'if-range': ETAG})['statusCode'], 206)
+        self.assertEqual(self.get('bytes=0-9', **{'if-range': LAST_MODIFIED})['statusCode'], 206)
+        self.assertWholeFile('bytes=0-9', **{'if-range': '"another-version"'})
+        self.assertWholeFile('bytes=0-9', **{'if-range': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+
+
+class ConditionalTest(HandlerTestCase):
+
+    GZIP = {'accept-encoding': 'gzip'}
+
+    def setUp(self):
+        super().setUp()
+        self.handler.setCacheSize(1024 ** 2)
+
+    def assertRevalidates(self, name, ENCODING):
+        RESPONSE = self.handler.getFileContent(name, dict(self.GZIP))
+        self.assertEqual(RESPONSE['statusCode'], 200)
+        self.assertEqual(header(RESPONSE, 'Content-Encoding'), ENCODING)
+        body(RESPONSE)
+
+        for _ in range(2):
+            RESPONSE = self.handler.getFileContent(name, dict(self.GZIP, **{'if-none-match': header(RESPONSE, 'ETag')}))
+            self.assertEqual(RESPONSE['statusCode'], 304, name)
+        return header(RESPONSE, 'ETag')
+
+    def test_compressed_variant(self):
+        self.create('small.txt', b'hello ' * 1000)
+        ETAG = self.assertRevalidates('small.txt', 'gzip')
+        self.assertTrue(ETAG.endswith('-gzip"'))
+
+        # The plain variant's ETag does not match the variant this client gets
+        PLAIN_ETAG = header(self.handler.getFileContent('small.txt'), 'ETag')
+        RESPONSE = self.handler.getFileContent('small.txt', dict(self.GZIP, **{'if-none-match': PLAIN_ETAG}))
+        self.assertEqual(RESPONSE['statusCode'], 200)
+        self.assertEqual(header(RESPONSE, 'Content-Encoding'), 'gzip')
+
+    def test_too_large_to_compress(self):
+        # Larger than the cache's per-entry limit, so it is always sent plain
+        self.create('large.txt', b'hello ' * 40000)
+        ETAG = self.assertRevalidates('large.txt', None)
+        self.assertEqual(ETAG, header(self.handler.getFileContent('large.txt'), 'ETag'))
+
+    def test_does_not_compress(self):
+        self.create('random.txt', os.urandom(4096))
+        self.assertRevalidates('random.txt', None)
+
+
+class PartialUploadTest(HandlerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.create('data.txt', b'0123456789')
+
+    def patch(self, CONTENT_RANGE, data):
+        upload = self.handler.beginPartialUpload('data.txt', CONTENT_RANGE)
+        upload.write(data)
+        return self.handler.finishUpload('data.txt', upload)
+
+    def read(self):
+        with open(os.path.join(self.directory, 'data.txt'), 'rb') as f:
+            return f.read()
+
+    def test_write_over_and_past_the_end(self):
+        self.assertEqual(self.patch('bytes 2-4/*', b'abc')['statusCode'], 200)
+        self.assertEqual(self.patch('bytes 8-11/12', b'WXYZ')['statusCode'], 200)
+        self.assertEqual(self.read(), b'01abc567WXYZ')
+
+    def test_append(self):
+        self.assertEqual(self.patch(None, b'ab')['statusCode'], 200)
+        self.assertEqual(self.read(), b'0123456789ab')
+
+    def test_malformed_content_range(self):
+        for CONTENT_RANGE in ('bytes 4-2/*', 'bytes 0-9/9', 'bytes 0-9', 'items 0-9/*', 'bytes -1-2/*', 'bytes a-b/*', 'bytes 3/*'):
+            with self.assertRaises(UploadError) as raised:
+                self.handler.beginPartialUpload('data.txt', CONTENT_RANGE)
+            self.assertEqual(raised.exception.status_code, 400, CONTENT_RANGE)
+
+    def test_body_of_the_wrong_length(self):
+        self.assertEqual(self.patch('bytes 0-3/*', b'ab')['statusCode'], 400)
+        self.assertEqual(self.read(), b'0123456789')
+
+    def test_write_starting_past_the_end(self):
+        RESPONSE = self.patch('bytes 11-12/*', b'ab')
+        self.assertEqual(RESPONSE['statusCode'], 416)
+        self.assertEqual(header(RESPONSE, 'Content-Range'), 'bytes */10')
+        self.assertEqual(self.read(), b'0123456789')
+
+
+class ListingTest(HandlerTestCase):
+
+    FILES = ['a.txt', 'a-b/z.txt', 'b/c.txt', 'b/d/e.txt', 'b/d/f.json', 'b.txt', 'c.json']
+
+    def setUp(self):
+        super().setUp()
+        for name in self.FILES:
+            self.create(name, name.encode())
+
+    def names(self, DIRECTORY = '', **QUERY):
+        RESPONSE = self.handler.getNamesOfAllFiles(DIRECTORY, QUERY)
+        self.assertEqual(RESPONSE['statusCode'], 200, RESPONSE.get('data'))
+        data = body(RESPONSE).decode()
+        return data.split('\n') if data else []
+
+    def pages(self, DIRECTORY = '', **QUERY):
+        pages = []
+        while True:
+            RESPONSE = self.handler.getNamesOfAllFiles(DIRECTORY, QUERY)
+            self.assertEqual(RESPONSE['statusCode'], 200, RESPONSE.get('data'))
+            pages.append(body(RESPONSE).decode().split('\n'))
+
+            CURSOR = header(RESPONSE, 'X-Next-Cursor')
+            if CURSOR is None: return pages
+            QUERY['cursor'] = unquote(CURSOR)
+
+    def test_recursive_listing_is_ordered_by_components(self):
+        self.assertEqual(self.names(recursive = '1'), ['a-b/z.txt', 'a.txt', 'b/c.txt', 'b/d/e.txt', 'b/d/f.json', 'b.txt', 'c.json'])
+
+    def test_top_level(self):
+        self.assertEqual(self.names(), ['a.txt', 'b.txt', 'c.json'])
+        self.assertEqual(self.names('b/'), ['c.txt'])
+        self.assertEqual(self.names('b/', recursive = '1'), ['c.txt', 'd/e.txt', 'd/f.json'])
+
+    def test_cursor_pages(self):
+        everything = self.names(recursive = '1')
+        for LIMIT in range(1, len(everything) + 1):
+            pages = self.pages(recursive = '1', limit = str(LIMIT))
+            self.assertEqual(sum(pages, []), everything, LIMIT)
+            self.assertTrue(all(len(page) == LIMIT for page in pages[:-1]), LIMIT)
+
+    def test_cursor_inside_a_skipped_directory(self):
+        self.assertEqual(self.names(recursive = '1', cursor = 'b/d'), ['b/d/e.txt', 'b/d/f.json', 'b.txt', 'c.json'])
+        self.assertEqual(self.names(recursive = '1', cursor = 'b/d/e.txt'), ['b/d/f.json', 'b.txt', 'c.json'])
+
+    def test_indexed_cursor_pages(self):
+        self.handler.buildIndex()
+        self.assertEqual(self.pages(limit = '2'), [['a.txt', 'b.txt'], ['c.json']])
+        self.assertEqual(self.names(prefix = 'b', cursor = 'a.txt'), ['b.txt'])
+
+    def test_prefix_and_glob(self):
+        self.assertEqual(self.names(recursive = '1', prefix = 'b/d'), ['b/d/e.txt', 'b/d/f.json'])
+        self.assertEqual(self.names(recursive = '1', glob = '*.json'), ['b/d/f.json', 'c.json'])
+        self.assertEqual(self.names(glob = '*.json'), ['c.json'])
+
+    def test_json_pages(self):
+        RESPONSE = self.handler.getNamesOfAllFiles('', {'format': 'json', 'limit': '2'})
+        listing = json.loads(body(RESPONSE))
+        self.assertEqual([entry['name'] for entry in listing['files']], ['a.txt', 'b.txt'])
+        self.assertEqual([entry['size'] for entry in listing['files']], [5, 5])
+        self.assertEqual(listing['next_cursor'], 'b.txt')
+
+        listing = json.loads(body(self.handler.getNamesOfAllFiles('', {'format': 'json', 'cursor': 'b.txt'})))
+        self.assertEqual(listing, {'files': [{'name': 'c.json', 'size': 6, 'mtime': listing['files'][0]['mtime']}], 'next_cursor': None})
+
+    def test_bad_parameters(self):
+        for QUERY in ({'limit': '0'}, {'limit': 'x'}, {'format': 'xml'}):
+            self.assertEqual(self.handler.getNamesOfAllFiles('', QUERY)['statusCode'], 400, QUERY)
+
+    def test_write_to_a_missing_directory(self):
+        self.assertEqual(self.handler.writeToFile('no/such/x.txt', b'x')['statusCode'], 404)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'no')))
+
+    def test_upload_spool_is_not_listed(self):
+        upload = self.handler.beginUpload('new.txt')
+        upload.write(b'new')
+        self.assertEqual(self.names(recursive = '1'), self.names(recursive = '1', glob = '[!.]*'))
+        self.assertEqual(self.handler.finishUpload('new.txt', upload)['statusCode'], 200)
+        self.assertEqual(self.names(), ['a.txt', 'b.txt', 'c.json', 'new.txt'])
+
+    def test_listing_outside_the_directory(self):
+        os.symlink('/', os.path.join(self.directory, 'root'))
+        for DIRECTORY in ('/etc/', '//etc/', '../', 'b/../../', './', 'b//', 'root/', 'b\\..\\'):
+            self.assertEqual(self.handler.getNamesOfAllFiles(DIRECTORY, {})['statusCode'], 403, DIRECTORY)
+
+
+class ContentStoreTest(HandlerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.handler.setStorage('cas')
+
+    def write(self, name, content):
+        self.assertEqual(self.handler.writeToFile(name, content)['statusCode'], 200)
+
+    def test_name_version_does_not_follow_the_blob(self):
+        self.write('old.txt', b'second')
+        self.write('a.txt', b'first')
+        FIRST = self.handler.getFileContent('a.txt')
+
+        # a.txt now points at the older blob of old.txt
+        self.write('a.txt', b'second')
+        SECOND = self.handler.getFileContent('a.txt')
+        self.assertEqual(body(SECOND), b'second')
+        self.assertNotEqual(header(SECOND, 'ETag'), header(FIRST, 'ETag'))
+        self.assertNotEqual(header(SECOND, 'ETag'), header(self.handler.getFileContent('old.txt'), 'ETag'))
+
+        RESPONSE = self.handler.getFileContent('a.txt', {'if-none-match': header(FIRST, 'ETag')})
+        self.assertEqual(RESPONSE['statusCode'], 200)
+        RESPONSE = self.handler.getFileContent('a.txt', {'range': 'bytes=0-1', 'if-range': header(FIRST, 'ETag')})
+        self.assertEqual(RESPONSE['statusCode'], 200)
+
+    def test_modification_times_survive_a_restart(self):
+        self.write('a.txt', b'first')
+        self.write('a.txt', b'second')
+        _, MODIFIED_NS = self.handler.store.lookup('a.txt')
+
+        handler = FileHandler()
+        handler.setDefaultDirectory(self.directory)
+        handler.setStorage('cas')
+        self.assertEqual(handler.store.lookup('a.txt')[1], MODIFIED_NS)
+        self.assertEqual(header(handler.getFileContent('a.txt'), 'ETag'), header(self.handler.getFileContent('a.txt'), 'ETag'))
+
+    def test_modification_time_never_goes_back(self):
+        times = []
+        for i in range(5):
+            self.write('a.txt', b'%d' % (i % 2))
+            times.append(self.handler.store.lookup('a.txt')[1])
+        self.assertEqual(times, sorted(set(times)))
+
+    def test_listing(self):
+        for name in ('b/c.txt', 'a.txt', 'b/d/e.txt'):
+            self.write(name, name.encode())
+        self.assertEqual(body(self.handler.getNamesOfAllFiles('', {'recursive': '1', 'limit': '2'})), b'a.txt\nb/c.txt')
+        self.assertEqual(body(self.handler.getNamesOfAllFiles('b/', {'recursive': '1', 'cursor': 'c.txt'})), b'd/e.txt')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import os
+import unittest
+from tests import SERVER_DIRECTORY
+from Modules.HTTPParser import HTTPParser, HTTPParseError
+from HTTPServerLibrary import encodeChunks
+
+REPOSITORY = os.path.dirname(os.path.dirname(SERVER_DIRECTORY))
+
+REQUEST = b'POST /upload.txt HTTP/1.1\r\nHost: localhost\r\nContent-Length: 11\r\n\r\nhello world'
+
+CHUNKED_REQUEST = (b'POST /upload.txt HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n\r\n'
+                   b'5;name=value\r\nhello\r\n1\r\n \r\n5\r\nworld\r\n0\r\nChecksum: abc\r\nX-Trailer: 1\r\n\r\n')
+
+
+def feedAll(parser, pieces):
+    messages = []
+    for piece in pieces:
+        messages += parser.feed(piece)
+    return messages
+
+
+class Sink(object):
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+
+class HTTPParserTest(unittest.TestCase):
+
+    def test_request_in_one_piece(self):
+        [message] = HTTPParser().feed(REQUEST)
+        self.assertEqual(message.method, 'POST')
+        self.assertEqual(message.path, '/upload.txt')
+        self.assertEqual(message.version, 'HTTP/1.1')
+        self.assertEqual(message.header('Host'), 'localhost')
+        self.assertEqual(bytes(message.body), b'hello world')
+        self.assertTrue(message.complete)
+
+    def test_body_split_across_reads(self):
+        for split in range(1, len(REQUEST)):
+            parser = HTTPParser()
+            messages = feedAll(parser, [REQUEST[:split], REQUEST[split:]])
+            self.assertEqual(len(messages), 1, split)
+            self.assertEqual(bytes(messages[0].body), b'hello world', split)
+            self.assertFalse(parser.hasPartialMessage())
+
+    def test_byte_by_byte(self):
+        parser = HTTPParser()
+        messages = feedAll(parser, [REQUEST[i:i + 1] for i in range(len(REQUEST))])
+        self.assertEqual([bytes(message.body) for message in messages], [b'hello world'])
+
+    def test_memoryview_input(self):
+        [message] = HTTPParser().feed(memoryview(REQUEST))
+        self.assertEqual(bytes(message.body), b'hello world')
+
+    def test_chunked_body_and_trailers(self):
+        [message] = HTTPParser().feed(CHUNKED_REQUEST)
+        self.assertTrue(message.chunked)
+        self.assertEqual(bytes(message.body), b'hello world')
+        self.assertEqual(message.trailers, {'checksum': 'abc', 'x-trailer': '1'})
+
+    def test_chunked_split_at_every_position(self):
+        for split in range(1, len(CHUNKED_REQUEST)):
+            messages = feedAll(HTTPParser(), [CHUNKED_REQUEST[:split], CHUNKED_REQUEST[split:]])
+            self.assertEqual([bytes(message.body) for message in messages], [b'hello world'], split)
+            self.assertEqual(messages[0].trailers['checksum'], 'abc', split)
+
+    def test_invalid_chunk_size(self):
+        with self.assertRaises(HTTPParseError):
+            HTTPParser().feed(b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n')
+
+    def test_chunk_without_crlf(self):
+        with self.assertRaises(HTTPParseError):
+            HTTPParser().feed(b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabcXY')
+
+    def test_pipelined_requests_and_leftover(self):
+        first = b'GET /a HTTP/1.1\r\nHost: x\r\n\r\n'
+        second = b'GET /b HTTP/1.1\r\nHost: x\r\n\r\n'
+        third = b'POST /c HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc'
+
+        parser = HTTPParser()
+        messages = parser.feed(first + second + third[:20])
+        self.assertEqual([message.path for message in messages], ['/a', '/b'])
+        self.assertTrue(parser.hasPartialMessage())
+        self.assertFalse(parser.readingBody())
+
+        messages = parser.feed(third[20:-1])
+        self.assertEqual(messages, [])
+        self.assertTrue(parser.readingBody())
+
+        [message] = parser.feed(third[-1:])
+        self.assertEqual((message.path, bytes(message.body)), ('/c', b'abc'))
+        self.assertFalse(parser.hasPartialMessage())
+
+    def test_stray_crlf_between_requests(self):
+        messages = HTTPParser().feed(b'GET /a HTTP/1.1\r\n\r\n\r\n\r\nGET /b HTTP/1.1\r\n\r\n')
+        self.assertEqual([message.path for message in messages], ['/a', '/b'])
+
+    def test_body_sink(self):
+        sinks = []
+
+        def onHeaders(message):
+            message.bodySink = Sink()
+            sinks.append(message.bodySink)
+
+        parser = HTTPParser(onHeaders = onHeaders)
+        messages = feedAll(parser, [REQUEST[:50], REQUEST[50:], CHUNKED_REQUEST])
+        self.assertEqual([bytes(sink.data) for sink in sinks], [b'hello world', b'hello world'])
+        self.assertEqual([bytes(message.body) for message in messages], [b'', b''])
+        self.assertEqual([message.bodyLength for message in messages], [11, 11])
+
+    def test_header_block_too_large(self):
+        parser = HTTPParser(maxHeaderSize = 64)
+        with self.assertRaises(HTTPParseError):
+            parser.feed(b'GET / HTTP/1.1\r\nX-Long: ' + b'a' * 100)
+
+    def test_invalid_content_length(self):
+        for value in (b'abc', b'-1'):
+            with self.assertRaises(HTTPParseError):
+                HTTPParser().feed(b'POST / HTTP/1.1\r\nContent-Length: ' + value + b'\r\n\r\n')
+
+    def test_repeated_headers_are_joined(self):
+        [message] = HTTPParser().feed(b'GET / HTTP/1.1\r\nAccept: a\r\naccept: b\r\n\r\n')
+        self.assertEqual(message.header('accept'), 'a, b')
+
+    def test_response_to_head_has_no_body(self):
+        parser = HTTPParser(isResponse = True)
+        parser.requestMethod = 'HEAD'
+        messages = parser.feed(b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nHTTP/1.1 204 No Content\r\n\r\n')
+        self.assertEqual([message.statusCode for message in messages], [200, 204])
+        self.assertEqual([bytes(message.body) for message in messages], [b'', b''])
+
+    def test_response_until_eof(self):
+        parser = HTTPParser(isResponse = True)
+        self.assertEqual(parser.feed(b'HTTP/1.0 200 OK\r\n\r\nsome '), [])
+        self.assertEqual(parser.feed(b'body'), [])
+        [message] = parser.feedEOF()
+        self.assertEqual(bytes(message.body), b'some body')
+
+    def test_eof_in_the_middle_of_a_message(self):
+        parser = HTTPParser()
+        parser.feed(REQUEST[:-3])
+        with self.assertRaises(HTTPParseError):
+            parser.feedEOF()
+
+    def test_server_chunked_encoding_round_trip(self):
+        pieces = ['text ', b'', b'x' * 20000, memoryview(b'tail'), b'y' * 5]
+        for CHUNKED in (True, False):
+            encoded = b''.join(bytes(buffer) for buffers in encodeChunks(iter(pieces), CHUNKED, BATCH_SIZE = 1024) for buffer in buffers)
+            expected = b'text ' + b'x' * 20000 + b'tail' + b'y' * 5
+            if not CHUNKED:
+                self.assertEqual(encoded, expected)
+                continue
+
+            parser = HTTPParser(isResponse = True)
+            [message] = parser.feed(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n' + encoded)
+            self.assertEqual(bytes(message.body), expected)
+
+
+class DuplicatedModulesTest(unittest.TestCase):
+    """ The clients and servers each ship their own copy of these modules; they must not drift. """
+
+    def assertIdentical(self, paths):
+        contents = []
+        for path in paths:
+            with open(os.path.join(REPOSITORY, path), 'rb') as f:
+                contents.append(f.read())
+        for path, content in zip(paths[1:], contents[1:]):
+            self.assertEqual(content, contents[0], path + ' differs from ' + paths[0])
+
+    def test_http_parser_copies(self):
+        self.assertIdentical(['TCP/Server/Modules/HTTPParser.py', 'TCP/Client/HTTPParser.py',
+                              'UDP/Server/Modules/HTTPParser.py', 'UDP/Client/HTTPParser.py'])
+
+    def test_server_module_copies(self):
+        for name in ('FileLock.py', 'ResponseBuilder.py', 'MappedFile.py'):
+            self.assertIdentical(['TCP/Server/Modules/' + name, 'UDP/Server/Modules/' + name])
+
+
+if __name__ == '__main__':
+    unittest.main()
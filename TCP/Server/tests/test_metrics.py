@@ -0,0 +1,32 @@
+import unittest
+import tests
+from Modules.Metrics import Metrics, label
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_unknown_methods_are_counted_together(self):
+        metrics = Metrics()
+        for method in ('GET', 'GET', 'PATCH', 'BREW', 'X"} HTTP/1.1', 'METHOD%d' % 1, '-'):
+            metrics.count_request(method, 405 if method not in ('GET', 'PATCH') else 200)
+
+        requests = {(entry['method'], entry['status']): entry['count'] for entry in metrics.snapshot()['requests']}
+        self.assertEqual(requests, {('GET', 200): 2, ('PATCH', 200): 1, ('other', 405): 3, ('-', 405): 1})
+
+    def test_prometheus_labels(self):
+        metrics = Metrics()
+        metrics.count_request('X"} HTTP/1.1', 405)
+        metrics.observe('handler', 'a"b\\c\nd', 0.001)
+        text = metrics.to_prometheus(metrics.snapshot())
+
+        self.assertIn('httpfs_requests_total{method="other",status="405"} 1', text.splitlines())
+        self.assertIn('httpfs_phase_seconds_count{phase="handler",route="a\\"b\\\\c\\nd"} 1', text.splitlines())
+
+    def test_label(self):
+        self.assertEqual(label('plain'), 'plain')
+        self.assertEqual(label(404), '404')
+        self.assertEqual(label('a\\"\n'), 'a\\\\\\"\\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
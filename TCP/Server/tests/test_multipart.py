@@ -0,0 +1,108 @@
+import unittest
+import tests
+from Modules.Multipart import MultipartParser, MultipartError, header_param
+
+BODY = (b'preamble to ignore\r\n'
+        b'--XyZ\r\n'
+        b'Content-Disposition: form-data; name="file"; filename="a.txt"\r\n'
+        b'Content-Type: text/plain\r\n'
+        b'\r\n'
+        b'first line\r\n--not the boundary\r\n-\r\n--'
+        b'\r\n--XyZ  \r\n'
+        b'\r\n'
+        b'part without headers'
+        b'\r\n--XyZ\r\n'
+        b'Content-Location: /b.bin\r\n'
+        b'\r\n'
+        b'\r\n--XyZ--\r\n'
+        b'epilogue to ignore')
+
+EXPECTED = [
+    ({'content-disposition': 'form-data; name="file"; filename="a.txt"', 'content-type': 'text/plain'},
+     b'first line\r\n--not the boundary\r\n-\r\n--'),
+    ({}, b'part without headers'),
+    ({'content-location': '/b.bin'}, b''),
+]
+
+
+class Collector(object):
+    def __init__(self):
+        self.parts = []
+
+    def onPart(self, headers):
+        part = [headers, bytearray()]
+        self.parts.append(part)
+        # The parser hands out views of its buffer: they must be copied
+        return lambda data: part[1].extend(bytes(data))
+
+    def result(self):
+        return [(headers, bytes(content)) for headers, content in self.parts]
+
+
+def parse(pieces, boundary = 'XyZ', **options):
+    collector = Collector()
+    parser = MultipartParser(boundary, collector.onPart, **options)
+    for piece in pieces:
+        parser.feed(piece)
+    parser.close()
+    return collector.result()
+
+
+class MultipartParserTest(unittest.TestCase):
+
+    def test_whole_body(self):
+        self.assertEqual(parse([BODY]), EXPECTED)
+
+    def test_split_at_every_position(self):
+        for split in range(1, len(BODY)):
+            self.assertEqual(parse([BODY[:split], BODY[split:]]), EXPECTED, split)
+
+    def test_byte_by_byte(self):
+        self.assertEqual(parse([BODY[i:i + 1] for i in range(len(BODY))]), EXPECTED)
+
+    def test_body_starting_with_the_delimiter(self):
+        self.assertEqual(parse([b'--XyZ\r\n\r\ndata\r\n--XyZ--']), [({}, b'data')])
+
+    def test_skipped_part(self):
+        parser = MultipartParser('XyZ', lambda headers: None)
+        parser.feed(b'--XyZ\r\n\r\nignored\r\n--XyZ--\r\n')
+        parser.close()
+
+    def test_missing_closing_delimiter(self):
+        collector = Collector()
+        parser = MultipartParser('XyZ', collector.onPart)
+        parser.feed(b'--XyZ\r\n\r\ncut short')
+        with self.assertRaises(MultipartError):
+            parser.close()
+
+    def test_garbage_after_delimiter(self):
+        with self.assertRaises(MultipartError):
+            parse([b'--XyZoops\r\n\r\ndata\r\n--XyZ--'])
+
+    def test_malformed_part_header(self):
+        with self.assertRaises(MultipartError):
+            parse([b'--XyZ\r\nno colon here\r\n\r\ndata\r\n--XyZ--'])
+
+    def test_part_headers_too_large(self):
+        with self.assertRaises(MultipartError):
+            parse([b'--XyZ\r\nX-Long: ' + b'a' * 200], max_header_size = 100)
+
+    def test_missing_boundary(self):
+        with self.assertRaises(MultipartError):
+            MultipartParser('', lambda headers: None)
+
+
+class HeaderParamTest(unittest.TestCase):
+
+    def test_params(self):
+        self.assertEqual(header_param('multipart/form-data; boundary="a b"', 'boundary'), 'a b')
+        self.assertEqual(header_param('multipart/mixed; boundary=simple', 'boundary'), 'simple')
+        self.assertEqual(header_param('form-data; name="f"; filename="x.txt"', 'filename'), 'x.txt')
+        self.assertIsNone(header_param('form-data; name="f"', 'filename'))
+
+    def test_rfc2231_filename(self):
+        self.assertEqual(header_param("form-data; filename*=UTF-8''na%C3%AFve.txt", 'filename'), 'naïve.txt')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import time
+import socket
+import asyncio
+import threading
+import unittest
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+import tests
+from HTTPServerLibrary import HTTPServerLibrary
+from Modules.ConnectionGuard import TransferRate, RequestTimeout
+from Modules.HTTPParser import HTTPParser
+
+PIECES = [b'first', b'second', b'third']
+
+
+def slowStream():
+    # Each piece takes longer to produce than the grace period, as a listing of a large tree can
+    for piece in PIECES:
+        time.sleep(0.1)
+        yield piece
+
+
+def readAll(connection, result):
+    data = bytearray()
+    while True:
+        packet = connection.recv(65536)
+        if not packet: break
+        data += packet
+    result.append(bytes(data))
+
+
+def decodeChunked(data):
+    parser = HTTPParser(isResponse = True)
+    [message] = parser.feed(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n' + data)
+    return bytes(message.body)
+
+
+@mock.patch('HTTPServerLibrary.RATE_GRACE_SECONDS', 0.05)
+class SlowProducerTest(unittest.TestCase):
+    """ A stream slow to produce must not be mistaken for a client slow to read it. """
+
+    def setUp(self):
+        self.server = HTTPServerLibrary()
+        self.server.minRate = 1024 ** 2
+        self.server.writeTimeout = 5
+        self.serverSide, self.clientSide = socket.socketpair()
+        self.addCleanup(self.clientSide.close)
+
+        self.received = []
+        self.reader = threading.Thread(target = readAll, args = (self.clientSide, self.received))
+        self.reader.start()
+
+    def finish(self):
+        self.serverSide.close()
+        self.reader.join()
+        return decodeChunked(self.received[0])
+
+    def test_thread_engine(self):
+        body = {'stream': slowStream(), 'chunked': True}
+        self.assertTrue(self.server._HTTPServerLibrary__sendBody(self.serverSide, body))
+        self.assertEqual(self.finish(), b''.join(PIECES))
+
+    def test_event_loop_engine(self):
+        executor = ThreadPoolExecutor(max_workers = 1)
+        self.addCleanup(executor.shutdown)
+
+        async def send():
+            _, writer = await asyncio.open_connection(sock = self.serverSide)
+            body = {'stream': slowStream(), 'chunked': True}
+            complete = await self.server._HTTPServerLibrary__sendAsyncBody(writer, body, executor)
+            writer.close()
+            return complete
+
+        self.assertTrue(asyncio.run(send()))
+        self.assertEqual(self.finish(), b''.join(PIECES))
+
+
+class HeaderTimeoutTest(unittest.TestCase):
+
+    def test_counted_from_the_accept(self):
+        server = HTTPServerLibrary()
+        server.headerTimeout = 1
+
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        client = socket.create_connection(listener.getsockname(), timeout = 5)
+        self.addCleanup(client.close)
+        connection, address = listener.accept()
+        client.sendall(b'GET / HTTP/1.1\r\nHost: ')
+
+        # The connection waited in the pool's queue for longer than the header timeout
+        started = time.monotonic()
+        handler = threading.Thread(target = server._HTTPServerLibrary__handleClient, args = (connection, address, False, started - 2))
+        handler.start()
+
+        self.assertTrue(client.recv(65536).startswith(b'HTTP/1.1 408 '))
+        self.assertLess(time.monotonic() - started, 0.5)
+        client.close()
+        handler.join()
+
+
+class TransferRateTest(unittest.TestCase):
+
+    def test_slow_transfer(self):
+        rate = TransferRate(100, grace = 1)
+        rate.add(50, 0.5)
+        with self.assertRaises(RequestTimeout):
+            rate.add(50, 1.0)
+
+    def test_only_the_given_time_counts(self):
+        rate = TransferRate(100, grace = 0)
+        time.sleep(0.05)
+        rate.add(10, 0.01)
+
+    def test_disabled(self):
+        TransferRate(0, grace = 0).add(1, 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import unittest
+import tests
+from Modules.Upload import Upload, UploadError, DiscardedBody, BatchUpload
+
+
+class UploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'file.txt')
+
+    def test_commit(self):
+        upload = Upload(self.path)
+        upload.write(b'hello ')
+        upload.write(memoryview(b'world'))
+        self.assertFalse(os.path.exists(self.path))
+        upload.commit()
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'hello world')
+        self.assertEqual(os.listdir(os.path.join(self.directory, Upload.SPOOL)), [])
+
+    def test_spooled_outside_the_directory(self):
+        os.mkdir(os.path.join(self.directory, Upload.SPOOL))
+        os.utime(self.directory, ns = (0, 0))
+
+        upload = Upload(self.path)
+        upload.write(b'data')
+        self.assertEqual(os.stat(self.directory).st_mtime_ns, 0)
+        self.assertTrue(Upload.is_temporary(os.path.basename(upload.temporary_path)))
+        upload.abort()
+        self.assertEqual(os.stat(self.directory).st_mtime_ns, 0)
+
+    def test_missing_directory(self):
+        with open(self.path, 'wb'):
+            pass
+
+        # A directory that isn't there, and a path under a file
+        for path in (os.path.join(self.directory, 'no', 'such', 'file.txt'), os.path.join(self.path, 'file.txt')):
+            with self.assertRaises(UploadError) as raised:
+                Upload(path)
+            self.assertEqual(raised.exception.status_code, 404)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['file.txt'])
+
+    def test_too_large(self):
+        upload = Upload(self.path, max_bytes = 5)
+        upload.write(b'12345')
+        with self.assertRaises(UploadError) as raised:
+            upload.write(b'6')
+        self.assertEqual(raised.exception.status_code, 413)
+        self.assertEqual(os.listdir(os.path.join(self.directory, Upload.SPOOL)), [])
+
+    def test_discarded_body(self):
+        sink = DiscardedBody(max_bytes = 5)
+        sink.write(b'123')
+        with self.assertRaises(UploadError) as raised:
+            sink.write(b'456')
+        self.assertEqual(raised.exception.status_code, 413)
+
+        DiscardedBody().write(b'x' * 100000)
+
+
+class BatchUploadTest(unittest.TestCase):
+
+    BODY = (b'--XyZ\r\nContent-Disposition: form-data; name="a"; filename="a.txt"\r\n\r\nfirst'
+            b'\r\n--XyZ\r\nContent-Disposition: form-data; name="b"\r\n\r\nno file name'
+            b'\r\n--XyZ\r\nContent-Location: /b.txt\r\n\r\nsecond'
+            b'\r\n--XyZ--\r\n')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def beginUpload(self, name):
+        return Upload(os.path.join(self.directory, name))
+
+    def test_parts(self):
+        batch = BatchUpload('XyZ', self.beginUpload)
+        for i in range(0, len(self.BODY), 7):
+            batch.write(self.BODY[i:i + 7])
+        batch.close()
+
+        self.assertEqual([name for name, _, _ in batch.parts], ['a.txt', '', 'b.txt'])
+        self.assertEqual(batch.parts[1][2].status_code, 400)
+        for name, upload, error in batch.parts:
+            if error is None: upload.commit()
+
+        for name, content in (('a.txt', b'first'), ('b.txt', b'second')):
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+    def test_whole_body_limit(self):
+        batch = BatchUpload('XyZ', self.beginUpload, max_bytes = len(self.BODY) - 1)
+        batch.write(self.BODY[:100])
+        self.assertTrue(os.listdir(os.path.join(self.directory, Upload.SPOOL)))
+        with self.assertRaises(UploadError) as raised:
+            batch.write(self.BODY[100:])
+        self.assertEqual(raised.exception.status_code, 413)
+        self.assertEqual(os.listdir(os.path.join(self.directory, Upload.SPOOL)), [])
+
+    def test_truncated_body(self):
+        batch = BatchUpload('XyZ', self.beginUpload)
+        batch.write(self.BODY[:-10])
+        with self.assertRaises(UploadError) as raised:
+            batch.close()
+        self.assertEqual(raised.exception.status_code, 400)
+        self.assertEqual(os.listdir(os.path.join(self.directory, Upload.SPOOL)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,12 @@
 import socket
 import ipaddress
+import threading
 from urllib.parse import urlparse
 from packet import Packet
 from packetType import PacketType
 from selectiveRepeat import SRSender
 from selectiveRepeatClientServer import SRReceiver
+from HTTPParser import HTTPParser, HTTPParseError
 
 class HTTPClientLibrary:
 
@@ -15,7 +17,8 @@ class HTTPClientLibrary:
         self.sender = None
         self.sender_thread = None
         self.receiver = None
-        self.response = ''
+        self.parser = HTTPParser(isResponse = True)
+        self.responses = []
         self.socket = None
         
     '''
@@ -42,26 +45,13 @@ class HTTPClientLibrary:
                 PORT = 80
 
             with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
-                # 3-way handshake
-                self.__handshake(client_socket, HOST, PORT)
-                self.socket = client_socket
-
-                # Selective repeat sender and receiver
-                self.sender = SRSender(client_socket, (self.router_addr, self.router_port))
-                self.receiver = SRReceiver(client_socket, self.append_packet_payload, HOST, PORT, \
-                    (self.router_addr, self.router_port), 1, VERBOSE)
-
-                requestData = self.__prepareRequest(HOST, HTTP_METHOD, PATH, HEADERS, BODY_DATA)    
-                self.__convertToPacketsAndSend(client_socket, requestData, PacketType.DATA, HOST, PORT)
-   
-                # Receive response
-                responseHeader, responseBody = self.__receiveResponse(client_socket)
+                response = self.__exchange(client_socket, HOST, PORT, HTTP_METHOD, PATH, HEADERS, BODY_DATA, VERBOSE)
                 print("Response Received\n")
-                print(responseHeader, responseBody)
+                print(response.rawHeader, response.text())
 
                 '''Check if the response is 302: redirect'''
-                if (self.__responseHeaderContainsRedirection(responseHeader)):
-                    redirectURL = self.__findRedirectURL(responseHeader)
+                if (self.__responseContainsRedirection(response)):
+                    redirectURL = self.__findRedirectURL(response)
 
                     if redirectURL == "":
                         print("Received 302 response code but didn't find the redirection URL")
@@ -76,18 +66,69 @@ class HTTPClientLibrary:
 
                 else:
                     if VERBOSE:
-                        print(responseHeader)
+                        print(response.rawHeader)
 
                     if OUTPUT_FILE is not None:
-                        file = open(OUTPUT_FILE, "w")
-                        file.write(responseBody)
+                        file = open(OUTPUT_FILE, "wb")
+                        file.write(response.body)
                         file.close()
                     
                     else:
-                        print(responseBody)
+                        print(response.text())
                 
                 self.__keep_ACKing()
 
+    '''
+    Description: Send one request and return the response instead of printing it (used by the load generator)
+
+    Method Parameters
+        HOST, HTTP_METHOD, PATH, HEADERS, BODY_DATA, VERBOSE: As for sendHTTPRequest
+        LINGER: Seconds the connection keeps ACKing retransmitted packets once the response is in. This
+                happens on a background thread, so the call returns as soon as the response is complete
+
+    Returns: HTTPMessage. A new HTTPClientLibrary is needed for every call
+    '''
+    def fetch(self, HOST, HTTP_METHOD, PATH = "/", HEADERS = [], BODY_DATA = None, VERBOSE = False, LINGER = 1.0):
+        if HOST.count(":") == 1:
+            HOST, PORT = HOST.split(":")
+            PORT = int(PORT)
+        else:
+            PORT = 80
+
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            response = self.__exchange(client_socket, HOST, PORT, HTTP_METHOD, PATH or "/", HEADERS, BODY_DATA, VERBOSE)
+        except BaseException:
+            if self.sender is not None: self.sender.stop()
+            if self.receiver is not None: self.receiver.stop()
+            client_socket.close()
+            raise
+
+        threading.Thread(target=self.__keep_ACKing, args=(LINGER,), daemon=True).start()
+        return response
+
+    '''
+        Internal Method
+        Description: Handshake, send the request and receive the response on client_socket
+        Return: HTTPMessage
+    '''
+    def __exchange(self, client_socket, HOST, PORT, HTTP_METHOD, PATH, HEADERS, BODY_DATA, VERBOSE):
+        # 3-way handshake
+        self.__handshake(client_socket, HOST, PORT)
+        self.socket = client_socket
+
+        # Selective repeat sender and receiver
+        self.sender = SRSender(client_socket, (self.router_addr, self.router_port))
+        self.receiver = SRReceiver(client_socket, self.append_packet_payload, HOST, PORT, \
+            (self.router_addr, self.router_port), 1, VERBOSE)
+
+        requestData = self.__prepareRequest(HOST, HTTP_METHOD, PATH, HEADERS, BODY_DATA)
+        self.__convertToPacketsAndSend(client_socket, requestData, PacketType.DATA, HOST, PORT)
+
+        # Receive response
+        self.parser.requestMethod = HTTP_METHOD
+        return self.__receiveResponse(client_socket)
+
     '''
         Internal Method
         Description: Prepares the HTTP request data to sent from the socket
@@ -95,9 +136,8 @@ class HTTPClientLibrary:
 
         Note: 
                 - Each line must be seperated by the '\r\n' delimiter
-                - Body must be seperated by an extra '\r\n' delimiter
-                - Body requires the Content-length Header
-                - The request must end with an extra '\r\n' delimiter
+                - The header block ends with an extra '\r\n' delimiter
+                - Body requires the Content-length Header (length in bytes) and is sent as-is after the header block
     '''
     def __prepareRequest(self, HOST, HTTP_METHOD, PATH, HEADERS, BODY_DATA):
         request = ''
@@ -108,23 +148,41 @@ class HTTPClientLibrary:
         for HEADER in HEADERS:
             request += HEADER + "\r\n"
 
+        BODY = b''
         if BODY_DATA is not None:
-            request += "Content-Length: " + str(len(BODY_DATA)) + "\r\n"
-            request += "\r\n"
-            request += BODY_DATA + "\r\n"
+            BODY = BODY_DATA if isinstance(BODY_DATA, bytes) else BODY_DATA.encode()
+            request += "Content-Length: " + str(len(BODY)) + "\r\n"
 
         request += "\r\n"
-        return request.encode()
+        return request.encode() + BODY
 
     def append_packet_payload(self, packet):
-        self.response += packet.payload.decode("utf-8")
+        try:
+            self.responses.extend(self.parser.feed(packet.payload))
+        except HTTPParseError as e:
+            print('Invalid response: ', e)
     
-    def __keep_ACKing(self):
+    '''
+        Internal Method
+        Description: ACKs data packets the server retransmits (because one of our ACKs was lost).
+                     Forever by default; with LINGER, until nothing arrived for LINGER seconds, then the
+                     connection is closed
+    '''
+    def __keep_ACKing(self, LINGER = None):
         BUFFER_SIZE = 1024
 
+        if LINGER is not None:
+            self.socket.settimeout(LINGER)
+
         '''Reads data in packets of length BUFFER_SIZE from the kernel buffer'''
         while True:
-            byteData, sender = self.socket.recvfrom(BUFFER_SIZE)
+            try:
+                byteData, sender = self.socket.recvfrom(BUFFER_SIZE)
+            except socket.timeout:
+                self.receiver.stop()
+                self.socket.close()
+                return
+
             packet = Packet.from_bytes(byteData)
 
             # Selective repeat: if packet type is DATA, send ACK
@@ -134,9 +192,10 @@ class HTTPClientLibrary:
     '''
         Internal Method 
         Description: Receives the response from the socket
-        Return: responseHeader, responseBody
+        Return: HTTPMessage with statusCode, headers and body (bytes)
 
-        Note: Splits the Header and Body using the '\r\n\r\n' delimiter
+        Note: The payloads are fed to the HTTP parser in sequence order; the response is complete once
+              the parser has framed it, or at the last (short) packet if the server sent no Content-Length
     '''
     def __receiveResponse(self, socket):
         BUFFER_SIZE = 1024
@@ -166,36 +225,23 @@ class HTTPClientLibrary:
                 while True: 
                     if self.receiver.get_packet_count() >= packet_count: break 
 
-            if len(packet.payload) < PAYLOAD_SIZE:
+            if self.responses or len(packet.payload) < PAYLOAD_SIZE:
                 self.sender.stop()
                 break   # Last packet
         
-        #self.response = self.response.decode('utf-8')
+        if not self.responses:
+            self.responses.extend(self.parser.feedEOF())
 
-        '''If responseBody does not exists'''
-        if self.response.count('\r\n\r\n') < 1:
-            return self.response, ""
-        
-        else:
-            responseHeader, responseBody = self.response.split('\r\n\r\n', 1)
-            return responseHeader, responseBody
+        return self.responses.pop(0)
 
 
-    def __responseHeaderContainsRedirection(self, responseHeaderString):
-        HEADERS = responseHeaderString.split('\r\n')
-        return '302' in HEADERS[0]
+    def __responseContainsRedirection(self, response):
+        return response.statusCode == 302
 
 
-    def __findRedirectURL(self, responseHeaderString):
-        HEADERS = responseHeaderString.split('\r\n')
-
+    def __findRedirectURL(self, response):
         '''Find the Location header and get the redirect URL'''
-        for HEADER in HEADERS:
-            if 'location' in HEADER.lower():
-                key, value = HEADER.split(':', 1)                
-                return value.strip()
-                
-        return ""
+        return response.header('location', '').strip()
 
 
     def __handshake(self, connection_socket, server_addr, server_port):
@@ -101,9 +101,10 @@ class HTTPC:
     
     # Read data from file to send as data
     def __read_file_data(self, path):
-        txt_data = ''
+        txt_data = b''
         print(path)
-        with open(path, 'r') as reader:
+        # Binary mode so any file (not only UTF-8 text) can be sent as-is
+        with open(path, 'rb') as reader:
             # Read entire file
             txt_data = reader.read(-1)
         
@@ -17,7 +17,7 @@ def run_server():
             requestHeader, requestBody = receiveRequest(client_connection)
             print(requestHeader, requestBody)
 
-            response = 'HTTP/1.1 302 Found\r\nLocation: http://httpbin.org/status/418'
+            response = 'HTTP/1.1 302 Found\r\nLocation: http://httpbin.org/status/418\r\nContent-Length: 0\r\n\r\n'
             client_connection.sendall(response.encode())
             client_connection.close()
 
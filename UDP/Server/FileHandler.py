@@ -1,8 +1,13 @@
 import os
+import uuid
 import shutil
 import mimetypes
 from pathlib import Path
 from Modules.FileLock import FileLock
+from Modules.MappedFile import MAPPED_FILES
+
+# Files at least this large are sent from a shared memory map instead of being read into memory
+MAP_THRESHOLD = 64 * 1024
 
 class FileHandler:
 
@@ -49,17 +54,30 @@ class FileHandler:
                     'data': 'File does not exist.'
                 }
                 
-            with open(file_path) as f: 
-                file_data = f.read()
+            '''
+                Bytes, so binary files are sent as they are (the response builder takes bytes bodies).
+                A large file is a memoryview of its shared memory map (see Modules/MappedFile.py): the
+                datagrams are sliced from it without the file ever being read into the Python heap.
+                The caller must release() the returned 'mapped' once the response is sent.
+            '''
+            mapped = None
+            with open(file_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size >= MAP_THRESHOLD:
+                    mapped = MAPPED_FILES.open(f)
+                    file_data = mapped.view()
+                else:
+                    file_data = f.read()
 
-            CONTENT_TYPE = 'Content-Type: ' + mimetypes.guess_type(file_path)[0] 
+            CONTENT_TYPE = 'Content-Type: ' + (mimetypes.guess_type(file_path)[0] or 'application/octet-stream')
             CONTENT_DISPOSITION = 'Content-Disposition: inline; filename="' + filename + '"'
 
-            return {
+            response = {
                 'data': file_data,
                 'statusCode': 200,
                 'headers': [CONTENT_TYPE, CONTENT_DISPOSITION]
             }
+            if mapped is not None: response['mapped'] = mapped
+            return response
         except Exception as e:
             return {
                 'statusCode': 500,
@@ -76,18 +94,47 @@ class FileHandler:
             
         filename = self.defaultDirectory + '/' + filename
 
-        # Locking the file to perform the write operation
+        # Locking the file to perform the write operation. The new content is written next to the file and
+        # renamed over it: truncating a file in place would crash readers that have it mapped
         with FileLock(filename):
             try:
-                f = open(filename, "w")
-                f.write(filecontent)
-                f.close()
+                temporary_path = filename + '.' + uuid.uuid4().hex + '.upload'
+                with open(temporary_path, "wb") as f:
+                    f.write(filecontent)
+                os.replace(temporary_path, filename)
                 return {
                     'data': 'Successfully wrote file content.',
                     'statusCode': 200
                 }
             except Exception as e:
+                if os.path.exists(temporary_path): os.unlink(temporary_path)
                 return {
                     'statusCode': 500,
                     'data': f'Error getting file content: {e}'
-                }
\ No newline at end of file
+                }
+
+    def appendToFile(self, filename, filecontent):
+        # If user tries to access outside of default directory
+        if '..' in filename:
+            return {
+                'statusCode': 403,
+                'data': 'Forbidden access.'
+            }
+
+        filename = self.defaultDirectory + '/' + filename
+
+        # Only the new bytes are written (the file is created if missing). The file never shrinks, so
+        # readers that have it mapped are safe
+        with FileLock(filename):
+            try:
+                with open(filename, "ab") as f:
+                    f.write(filecontent)
+                return {
+                    'data': 'Successfully appended file content.',
+                    'statusCode': 200
+                }
+            except Exception as e:
+                return {
+                    'statusCode': 500,
+                    'data': f'Error appending file content: {e}'
+                }
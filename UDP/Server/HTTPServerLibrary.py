@@ -1,9 +1,11 @@
 import socket
 import threading
 import ipaddress
+from urllib.parse import urlsplit, parse_qs
 from queue import Queue, Empty
-from http.client import responses
 from FileHandler import FileHandler
+from Modules.HTTPParser import HTTPParser, HTTPParseError
+from Modules.ResponseBuilder import ResponseBuilder
 from packet import Packet
 from packetType import PacketType
 from selectiveRepeatServer import SRReceiver
@@ -14,6 +16,9 @@ from selectiveRepeatServer import SRReceiver
     VERBOSE:    Boolean     > Print debugging information 
 '''
 
+# One request per connection: HTTP/1.0 responses, which end the connection without a Connection header
+RESPONSE_BUILDER = ResponseBuilder('HTTP/1.0')
+
 class HTTPServerLibrary:
 
     def __init__(self): 
@@ -62,7 +67,9 @@ class UDPRequest(threading.Thread):
         self.clientIPAddress = clientIPAddress
         self.clientPort = clientPort
 
-        self.requestPayload = ''
+        # Reassembled request bytes are parsed as they arrive
+        self.parser = HTTPParser()
+        self.requests = []
         self.fileHandler.setDefaultDirectory(directory)
         self.receiver = SRReceiver(self.connection_socket, self.append_packet_payload, self.clientIPAddress,\
                                      self.clientPort, (self.router_addr, self.router_port), window_size, VERBOSE=verbose)
@@ -97,22 +104,24 @@ class UDPRequest(threading.Thread):
                 # All packets received, break
                 #if self.has_no_more_packets(): break
                 
-                # Last packet
-                if len(packet.payload) < MAX_PAYLOAD_SIZE: break
+                # Full request parsed, or last (short) packet
+                if self.requests or len(packet.payload) < MAX_PAYLOAD_SIZE: break
 
 
-        '''If requestBody does not exists'''
-        if self.requestPayload.count('\r\n\r\n') < 1:
-            responseHeader, responseBody = self.requestPayload, ""
-        
-        else:
-            responseHeader, responseBody = self.requestPayload.split('\r\n\r\n', 1)
-        
+        if not self.requests:
+            self.__convertToPacketsAndSend(self.__prepareResponse({
+                'statusCode': 400,
+                'data': 'Bad request: incomplete request'
+            }), PacketType.DATA)
+            return
 
-        self.__handleRequest(responseHeader, responseBody)
+        self.__handleRequest(self.requests[0])
     
     def append_packet_payload(self, packet):
-        self.requestPayload += packet.payload.decode("utf-8")
+        try:
+            self.requests.extend(self.parser.feed(packet.payload))
+        except HTTPParseError as e:
+            if self.verbose: print('Bad request: ', e)
     
     def has_no_more_packets(self):
         return self.receiver.get_packet_count() == self.total_packets
@@ -132,37 +141,38 @@ class UDPRequest(threading.Thread):
             self.connection_socket.sendto(packet.to_bytes(), (self.router_addr, self.router_port))
 
 
-    def __handleRequest(self, requestHeader, requestBody):
+    def __handleRequest(self, request):
         if self.verbose:
             print('Request from: ', self.clientIPAddress, self.clientPort)
-            print('Request Data: ', requestHeader.strip(), requestBody.strip())
+            print('Request Data: ', request.rawHeader.strip(), request.text().strip())
             print('\n')
 
         # Mimicking slow response
         # time.sleep(10)
 
-        filehandlerResponse = self.__processRequest(requestHeader, requestBody)
-        response = self.__prepareResponse(filehandlerResponse)
+        filehandlerResponse = self.__processRequest(request)
+        try:
+            response = self.__prepareResponse(filehandlerResponse)
 
-        if self.verbose:
-            print('Response Data: ', response)
-            print('\n')
-        
-        self.__convertToPacketsAndSend(response, PacketType.DATA)
+            if self.verbose:
+                print('Response Data: ', response)
+                print('\n')
+
+            self.__convertToPacketsAndSend(response, PacketType.DATA)
+        finally:
+            # A large file was sent from its memory map (see FileHandler.getFileContent)
+            if 'mapped' in filehandlerResponse: filehandlerResponse['mapped'].release()
 
 
     '''
         Processes a incoming request.
-        1) Parses the HTTPHeader and extracts the METHOD and PATH
+        1) Reads the METHOD and PATH from the parsed request
         2) Call the respective fileHandler method depending on the METHOD and PATH
     '''
-    def __processRequest(self, requestHeader, requestBody):
+    def __processRequest(self, request):
 
-        HEADERS = requestHeader.split('\r\n')
-        HTTP_META_INFORMATION = HEADERS[0].split(' ')
-
-        METHOD = HTTP_META_INFORMATION[0].strip()
-        PATH = HTTP_META_INFORMATION[1].strip()
+        METHOD = request.method
+        PATH = request.path
 
         if METHOD != 'GET' and METHOD != 'POST':
             return {
@@ -184,30 +194,27 @@ class UDPRequest(threading.Thread):
                     'data': 'FileName is null'
                 }
             
+            # POST /FILE?append=1 adds the body to the end of the file instead of replacing it
+            URL = urlsplit(PATH)
+            if parse_qs(URL.query).get('append') == ['1']:
+                return self.fileHandler.appendToFile(URL.path[1:], bytes(request.body))
+
             else:
-                return self.fileHandler.writeToFile(PATH[1:], requestBody)
+                return self.fileHandler.writeToFile(PATH[1:], bytes(request.body))
 
 
+    '''
+        Encodes the response with a Content-Length, so the client knows where it ends whatever
+        the body holds. Returns the head and the body as a list of buffers, which the packets are
+        cut from without joining them (the body may be a large memory-mapped file).
+    '''
     def __prepareResponse(self, RESPONSEDATA):
 
         STATUS_CODE = RESPONSEDATA.get('statusCode')
         HEADERS = RESPONSEDATA.get('headers', [])
-        BODY = RESPONSEDATA.get('data', "")
-
-        request = ''
-
-        request += 'HTTP/1.0 '
-        request += str(STATUS_CODE) + ' ' + responses[STATUS_CODE]
-        
-        for HEADER in HEADERS:
-            request += '\r\n' + HEADER
+        BODY = RESPONSEDATA.get('data', b'')
 
-        request += '\r\n\r\n'
-        request += BODY
-
-        request += '\r\n'
-
-        return request.encode()
+        return RESPONSE_BUILDER.response(STATUS_CODE, HEADERS, BODY)
 
 
     '''
@@ -218,7 +225,7 @@ class UDPRequest(threading.Thread):
     '''
     def __convertToPacketsAndSend(self, requestData, packet_type):
         
-        for chunk in self.__chunkstring(requestData, 1013):
+        for chunk in self.__chunkBuffers(requestData, 1013):
             packet = Packet(packet_type = PacketType.DATA.value,
                             seq_num = self.curr_seq_num,
                             peer_ip_addr = ipaddress.ip_address(socket.gethostbyname(self.clientIPAddress)),
@@ -240,5 +247,28 @@ class UDPRequest(threading.Thread):
             self.__convertToPacketsAndSend(requestData, packet_type)
 
 
-    def __chunkstring(self, string, length):
-        return (string[0+i:length+i] for i in range(0, len(string), length))
\ No newline at end of file
+    '''
+        Cuts a list of buffers into payloads of LENGTH bytes, as if they were one buffer. A payload
+        inside one buffer is a memoryview slice of it; only one straddling two buffers is copied.
+    '''
+    def __chunkBuffers(self, buffers, length):
+        pending = bytearray()
+
+        for buffer in buffers:
+            view = memoryview(buffer)
+            position = 0
+
+            if pending:
+                position = length - len(pending)
+                pending += view[:position]
+                if len(pending) < length: continue
+                yield bytes(pending)
+                pending = bytearray()
+
+            while len(view) - position >= length:
+                yield view[position:position + length]
+                position += length
+
+            pending += view[position:]
+
+        if pending: yield bytes(pending)
@@ -0,0 +1,118 @@
+import os
+import mmap
+import threading
+
+class MappedFile(object):
+    """ A read-only memory map of one version of a file, shared by every
+        request reading that version. view() hands out memoryview slices of
+        it: the pages are read in by the OS as they are touched and never
+        copied into the Python heap.
+
+        Get one from MappedFiles.open() and release() it (or use it as a
+        context manager) once done; the map is closed when its last reader
+        releases it.
+    """
+
+    def __init__(self, registry, key, fileno, size):
+        self.registry = registry
+        self.key = key
+        self.size = size
+        self.readers = 0
+        # mmap can't map an empty file
+        self.map = mmap.mmap(fileno, size, access=mmap.ACCESS_READ) if size else None
+
+
+    def view(self, start=0, end=None):
+        """ memoryview of bytes [start, end) of the file. The OS is asked to
+            start reading those pages in, so whoever touches them first (the
+            socket write, most of the time) does not wait for each one.
+        """
+        if self.map is None: return memoryview(b'')
+
+        end = self.size if end is None else min(end, self.size)
+        if hasattr(mmap, 'MADV_WILLNEED') and end > start:
+            page = start - start % mmap.PAGESIZE
+            self.map.madvise(mmap.MADV_WILLNEED, page, end - page)
+
+        return memoryview(self.map)[start:end]
+
+
+    def release(self):
+        self.registry.release(self)
+
+
+    def close(self):
+        if self.map is None: return
+        try:
+            self.map.close()
+        except BufferError:
+            # Views are still held somewhere: the map is unmapped when the last one is collected
+            pass
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class MappedFiles(object):
+    """ The files currently mapped, by version: device, inode, modification
+        time and size. A file replaced by a rename is a new inode and gets a
+        map of its own, while readers of the old version keep theirs.
+        Thread safe.
+
+        Files must not be truncated in place while mapped: touching a page
+        past the new end of the file kills the process with SIGBUS.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.opened = 0
+        self.shared = 0
+
+
+    def open(self, f):
+        """ The MappedFile of the version of `f` (an open file object or
+            descriptor) that is on disk now, mapped if no reader has it yet.
+        """
+        fileno = f if isinstance(f, int) else f.fileno()
+        file_stat = os.fstat(fileno)
+        key = (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+
+        with self.lock:
+            mapped = self.files.get(key)
+            if mapped is None:
+                mapped = MappedFile(self, key, fileno, file_stat.st_size)
+                self.files[key] = mapped
+                self.opened += 1
+            else:
+                self.shared += 1
+
+            mapped.readers += 1
+            return mapped
+
+
+    def release(self, mapped):
+        with self.lock:
+            mapped.readers -= 1
+            if mapped.readers > 0: return
+            del self.files[mapped.key]
+
+        mapped.close()
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'files': len(self.files),
+                'bytes': sum(mapped.size for mapped in self.files.values()),
+                'opened': self.opened,
+                'shared': self.shared
+            }
+
+
+MAPPED_FILES = MappedFiles()
@@ -0,0 +1,106 @@
+from http.client import responses
+
+CRLF = b'\r\n'
+CHUNKED = b'Transfer-Encoding: chunked\r\n'
+CONNECTION_CLOSE = b'Connection: close\r\n'
+
+
+class ResponseBuilder(object):
+    """ Encodes responses as a list of buffers: the head (status line and
+        header block) in a bytearray, followed by the body as it was given.
+
+        Status lines are encoded once for every known status code, and the
+        head is appended to a single bytearray instead of concatenating
+        strings. The body is never copied into the head: send_buffers()
+        writes head and body with one scatter-gather sendmsg call.
+    """
+
+    def __init__(self, version='HTTP/1.1', keep_alive_timeout=5):
+        self.version = version
+        self.status_lines = {
+            code: ('%s %d %s\r\n' % (version, code, reason)).encode()
+            for code, reason in responses.items()
+        }
+        self.keep_alive = ('Connection: keep-alive\r\nKeep-Alive: timeout=%g, max=' % keep_alive_timeout).encode()
+
+
+    def head(self, status_code, headers=(), content_length=None, chunked=False, keep_alive=None, remaining=0):
+        """ The status line and header block, ending with the blank line.
+
+            `headers` are "Name: value" strings. The body is framed by
+            `content_length`, or by chunked encoding if `chunked`, or neither
+            (a 304, or a body that ends when the connection closes).
+            `keep_alive` True adds Connection: keep-alive with a Keep-Alive
+            header allowing `remaining` more requests, False adds
+            Connection: close, and None leaves it to the protocol version.
+        """
+        line = self.status_lines.get(status_code)
+        if line is None:
+            line = ('%s %d %s\r\n' % (self.version, status_code, 'Unknown')).encode()
+
+        head = bytearray(line)
+        if headers:
+            head += '\r\n'.join(headers).encode()
+            head += CRLF
+
+        if content_length is not None:
+            head += b'Content-Length: %d\r\n' % content_length
+        elif chunked:
+            head += CHUNKED
+
+        if keep_alive:
+            head += self.keep_alive
+            head += b'%d\r\n' % remaining
+        elif keep_alive is not None:
+            head += CONNECTION_CLOSE
+
+        head += CRLF
+        return head
+
+
+    def response(self, status_code, headers=(), body=b'', keep_alive=None, remaining=0, include_body=True):
+        """ [head, body] for a body held in memory (str, bytes, bytearray or
+            memoryview), always framed by its Content-Length. Without
+            `include_body` (a HEAD request) the head still announces the
+            body's length but the body is left out.
+        """
+        if isinstance(body, str): body = body.encode()
+
+        head = self.head(status_code, headers, len(body), keep_alive=keep_alive, remaining=remaining)
+        if not include_body or not body:
+            return [head]
+
+        return [head, body]
+
+
+def buffers_length(buffers):
+    return sum(len(buffer) for buffer in buffers)
+
+
+def send_buffers(connection, buffers):
+    """ Write every buffer to a blocking socket, resuming after partial
+        writes, with as few sendmsg calls as the kernel allows. Falls back to
+        one sendall per buffer where sendmsg is not available (Windows).
+        Returns the number of bytes sent.
+    """
+    if not hasattr(connection, 'sendmsg'):
+        for buffer in buffers:
+            connection.sendall(buffer)
+        return buffers_length(buffers)
+
+    views = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    total = 0
+    first = 0
+
+    while first < len(views):
+        sent = connection.sendmsg(views[first:])
+        total += sent
+
+        # Skip what went out and send the rest of a partly written buffer on the next call
+        while first < len(views) and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
+
+    return total